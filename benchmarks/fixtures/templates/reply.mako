@@ -0,0 +1,10 @@
+% for importer_display, export_results, info in export_table:
+${importer_display.get('header', '')}\
+% for export_result in export_results:
+${export_result.get('link_display', '')}\
+% endfor
+${importer_display.get('footer', '')}\
+% endfor
+
+---
+^(Lapis Mirror ${version}) ^| ^[Maintainer](/u/${maintainer}) ^| ^[Original](${import_info.get('source', submission.url)})
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Microbenchmarks for the HTML/JSON extraction done by each importer.
+
+Each benchmark runs a plugin's extraction logic over every saved page in
+its fixtures directory, without touching the network. For each one, we
+report how many pages per second it gets through, the peak memory
+allocated while parsing a page, and how many blocks (and KiB) of what was
+allocated are still alive once it returns, results included.
+
+    python3 benchmarks/parsers.py                  # run and compare to the baseline
+    python3 benchmarks/parsers.py --save-baseline  # run and make this the new baseline
+    python3 benchmarks/parsers.py --import-cassette cassettes/session.jsonl.gz
+    python3 benchmarks/parsers.py --check-pool     # parse every fixture in worker processes
+
+`--import-cassette` copies real pages out of a cassette recorded by Lapis
+(see the README) into the fixtures directory. `--check-pool` starts the
+parser pool (`lapislib.parsing`) and checks that every fixture parses to
+the same thing in a worker as it does in-process.
+
+The exit status is 1 if any benchmark got slower, or used more memory,
+than its baseline by more than the threshold, or if there is no baseline
+to compare to. The baseline in benchmarks/baseline.json is committed, and
+should be saved again whenever a parser is meant to change.
+"""
+
+import argparse
+import base64
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from lapislib import cassette, extract, parsing
+from lapislib.embed import CHUNK_SIZE, parse_opengraph
+from plugins.deviantart import DeviantArtPlugin
+from plugins.furaffinity import FurAffinityPlugin
+from plugins.tinypic import TinypicPlugin
+from plugins.tumblr import TumblrPlugin
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+
+
+def tumblr_post(markup: str) -> list:
+    """Everything the Tumblr importer parses locally out of an API response."""
+    post = json.loads(markup)['response']['posts'][0]
+    return TumblrPlugin.find_inline_images(
+        post.get('caption') or post.get('body') or post.get('answer', ''))
+
+
+def furaffinity_submission(markup: str) -> dict:
+    return FurAffinityPlugin.parse_submission_page(
+        markup, 'https://www.furaffinity.net/view/1/')
+
+
+def opengraph_stream(markup: str) -> dict:
+    """OpenGraph scraping as the embed engine does it, over a downloaded page."""
+    data = markup.encode('utf-8')
+    chunks = (data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE))
+    return extract.stream_meta_properties(chunks, 'og:', {'og:image', 'og:title'})
+
+
+# name: (fixture glob, extraction function)
+BENCHMARKS = {
+    'tumblr': ('tumblr/*.json', tumblr_post),
+    'deviantart': ('deviantart/*.html', DeviantArtPlugin.parse_deviation_page),
+    'furaffinity.submission': ('furaffinity/submission-*.html', furaffinity_submission),
+    'furaffinity.gallery': ('furaffinity/gallery-*.html', FurAffinityPlugin.parse_gallery_page),
+    'tinypic': ('tinypic/*.html', TinypicPlugin.parse_page),
+    'drawcrowd': ('drawcrowd/*.html', parse_opengraph),
+    'artstation': ('artstation/*.html', parse_opengraph),
+    'opengraph.stream': ('*/*.html', opengraph_stream),
+}
+
+# Which recorded URLs are fixtures for which benchmark, and what to call them.
+CASSETTE_SOURCES = [
+    (re.compile(r'api\.tumblr\.com/v2/blog/.+/posts'), 'tumblr/post-{}.json'),
+    (re.compile(r'deviantart\.com/art/'), 'deviantart/deviation-{}.html'),
+    (re.compile(r'furaffinity\.net/view/'), 'furaffinity/submission-{}.html'),
+    (re.compile(r'furaffinity\.net/gallery/'), 'furaffinity/gallery-{}.html'),
+    (re.compile(r'tinypic\.com/view\.php'), 'tinypic/view-{}.html'),
+    (re.compile(r'drawcrowd\.com/'), 'drawcrowd/page-{}.html'),
+    (re.compile(r'artstation\.com/artwork/'), 'artstation/artwork-{}.html'),
+]
+
+
+def load_fixtures(pattern: str) -> list:
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, pattern))):
+        with open(path, encoding='utf-8') as f:
+            fixtures.append(f.read())
+    return fixtures
+
+
+def measure(func, fixtures: list, min_time: float, repeat: int) -> dict:
+    """Time a function over a set of fixtures.
+
+    :param func: The extraction function. Takes the page text.
+    :param fixtures: The pages to run it over.
+    :param min_time: The minimum number of seconds to spend in each timing run.
+    :param repeat: How many timing runs to do. The best one is kept.
+    :return: A dictionary with ops_per_sec, and per page on average,
+    peak_kib, blocks and kib, the allocations still alive afterwards.
+    """
+    # Warm up, and make sure the extraction actually works on these pages.
+    for fixture in fixtures:
+        func(fixture)
+
+    best = 0.0
+    for _ in range(repeat):
+        ops = 0
+        start = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < min_time:
+            for fixture in fixtures:
+                func(fixture)
+            ops += len(fixtures)
+            elapsed = time.perf_counter() - start
+        best = max(best, ops / elapsed)
+
+    peak = blocks = size = 0
+    snapshot_filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    tracemalloc.start()
+    try:
+        for fixture in fixtures:
+            tracemalloc.clear_traces()
+            result = func(fixture)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            # Taken while the result is still referenced, so it counts too.
+            stats = tracemalloc.take_snapshot().filter_traces(
+                snapshot_filters).statistics('filename')
+            blocks += sum(stat.count for stat in stats)
+            size += sum(stat.size for stat in stats)
+            del result
+    finally:
+        tracemalloc.stop()
+    return {'ops_per_sec': round(best, 2), 'peak_kib': round(peak / 1024, 1),
+            'blocks': round(blocks / len(fixtures), 1),
+            'kib': round(size / len(fixtures) / 1024, 1)}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """:return: A list of messages describing every regression past the threshold."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+            regressions.append('{}: {:.1f} ops/sec, baseline {:.1f}'.format(
+                name, result['ops_per_sec'], base['ops_per_sec']))
+        if result['peak_kib'] > base['peak_kib'] * (1 + threshold):
+            regressions.append('{}: {:.1f} KiB peak, baseline {:.1f}'.format(
+                name, result['peak_kib'], base['peak_kib']))
+        # Baselines saved before blocks were measured don't have them.
+        if 'blocks' in base and result['blocks'] > base['blocks'] * (1 + threshold):
+            regressions.append('{}: {:.1f} blocks kept, baseline {:.1f}'.format(
+                name, result['blocks'], base['blocks']))
+    return regressions
+
+
+def import_cassette(path: str) -> int:
+    """Copy every successful response that's a known fixture type out of a cassette.
+
+    :param path: The cassette file.
+    :return: The number of fixtures written.
+    """
+    written = 0
+    for entry in cassette.read_entries(path):
+        if entry['method'] != 'GET' or entry['status'] != 200:
+            continue
+        for regex, name in CASSETTE_SOURCES:
+            if regex.search(entry['url']):
+                break
+        else:
+            continue
+        body = base64.b64decode(entry['body'])
+        fixture = os.path.join(FIXTURES_DIR, name.format(hashlib.sha1(body).hexdigest()[:10]))
+        os.makedirs(os.path.dirname(fixture), exist_ok=True)
+        with open(fixture, 'wb') as f:
+            f.write(body)
+        written += 1
+    return written
+
+
+def check_pool(workers: int=2) -> list:
+    """Parse every fixture through the parser pool, and compare to parsing in-process.
+
+    :param workers: How many worker processes to start.
+    :return: A list of messages describing every mismatch.
+    """
+    mismatches = []
+    parsing.start(workers, min_bytes=0, modules=('plugins.deviantart', 'plugins.furaffinity',
+                                                 'plugins.tinypic', 'plugins.tumblr'))
+    try:
+        pids = set(parsing._pool.map(parsing._ping, range(workers * 4)))
+        if os.getpid() in pids:
+            mismatches.append('the pool ran in this process')
+        for name, (pattern, func) in sorted(BENCHMARKS.items()):
+            for i, fixture in enumerate(load_fixtures(pattern)):
+                if parsing.parse(func, fixture) != func(fixture):
+                    mismatches.append('{}: fixture {} parsed differently in a worker'.format(
+                        name, i))
+        if not parsing.running():
+            mismatches.append('the pool was discarded')
+    finally:
+        parsing.stop()
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', help='Only run these benchmarks.')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='Seconds to spend in each timing run.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Timing runs per benchmark; the best is kept.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed regression against the baseline, as a fraction.')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save these results as the new baseline.')
+    parser.add_argument('--import-cassette', metavar='PATH',
+                        help='Add the pages recorded in a cassette to the fixtures, then exit.')
+    parser.add_argument('--check-pool', action='store_true',
+                        help='Check that the fixtures parse the same in the parser pool, then exit.')
+    args = parser.parse_args()
+
+    if args.import_cassette:
+        print('Wrote {} fixtures'.format(import_cassette(args.import_cassette)))
+        return 0
+
+    if args.check_pool:
+        mismatches = check_pool()
+        for mismatch in mismatches:
+            print('MISMATCH ' + mismatch)
+        print('Parser pool: {}'.format('failed' if mismatches else 'ok'))
+        return 1 if mismatches else 0
+
+    results = {}
+    for name, (pattern, func) in sorted(BENCHMARKS.items()):
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        fixtures = load_fixtures(pattern)
+        if not fixtures:
+            print('{:<24} no fixtures'.format(name))
+            continue
+        results[name] = measure(func, fixtures, args.min_time, args.repeat)
+        print('{:<24} {:>10.1f} ops/sec {:>10.1f} KiB peak {:>8.1f} blocks '
+              '{:>8.1f} KiB kept  ({} fixtures)'.format(
+                  name, results[name]['ops_per_sec'], results[name]['peak_kib'],
+                  results[name]['blocks'], results[name]['kib'], len(fixtures)))
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print('No baseline at {}; run with --save-baseline first.'.format(args.baseline))
+        return 1
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# END OF LINE.
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Benchmarks for rendering the post template.
+
+Renders a reply template with export tables of increasing size, and
+reports how long each render takes. Also times compiling the template
+from scratch against loading it from the compiled module cache, which
+is what a restart costs.
+
+    python3 benchmarks/templates.py                  # run and compare to the baseline
+    python3 benchmarks/templates.py --save-baseline  # run and make this the new baseline
+    python3 benchmarks/templates.py --template my_template.mako
+
+Results share a baseline file with benchmarks/parsers.py.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from lapislib import templates
+from parsers import BASELINE_FILE, FIXTURES_DIR, compare, measure
+
+TEMPLATE_FILE = os.path.join(FIXTURES_DIR, 'templates', 'reply.mako')
+# How many imports to put in the export table, each with a few exports.
+TABLE_SIZES = (1, 10, 100)
+EXPORTS_PER_IMPORT = 3
+
+
+def render_options(imports: int) -> dict:
+    """The keyword arguments process_submission would render a reply with."""
+    submission = SimpleNamespace(url='https://example.com/image.png',
+                                 permalink='https://www.reddit.com/r/test/comments/abc/_/')
+    export_table = []
+    for i in range(imports):
+        import_info = {'author': 'artist {}'.format(i),
+                       'source': 'https://example.com/{}'.format(i),
+                       'import_urls': ['https://example.com/{}.png'.format(i)],
+                       'importer_display': {'header': 'Mirrored image {} by artist:\n\n'.format(i)}}
+        export_results = [{'exporter': 'ImgurPlugin',
+                           'link_display': '[Imgur mirror {}](https://i.imgur.com/{}.png)  \n'.format(
+                               j, i * EXPORTS_PER_IMPORT + j),
+                           'delete_info': 'deletehash'}
+                          for j in range(EXPORTS_PER_IMPORT)]
+        export_table.append((import_info['importer_display'], export_results, import_info))
+    links_parts = []
+    for importer_display, export_results, _ in export_table:
+        links_parts.append(importer_display.get('header', ''))
+        links_parts.extend(r['link_display'] for r in export_results)
+        links_parts.append(importer_display.get('footer', ''))
+    return {'submission': submission,
+            'links': ''.join(links_parts),
+            'links_parts': links_parts,
+            'import_info': export_table[-1][2],
+            'export_table': export_table,
+            'version': '0.7',
+            'maintainer': 'malachite',
+            'subreddit': 'test'}
+
+
+def time_loading(path: str) -> dict:
+    """Time compiling a template cold, then loading it from a warm module cache.
+
+    :return: compile_ms and cached_load_ms.
+    """
+    module_directory = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        templates.get_template(path, module_directory)
+        compile_ms = (time.perf_counter() - start) * 1000
+        # A new process has no lookup yet, but does have the compiled module.
+        templates._lookups.clear()
+        start = time.perf_counter()
+        templates.get_template(path, module_directory)
+        cached_ms = (time.perf_counter() - start) * 1000
+    finally:
+        templates._lookups.clear()
+        shutil.rmtree(module_directory)
+    return {'compile_ms': round(compile_ms, 2), 'cached_load_ms': round(cached_ms, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--template', default=TEMPLATE_FILE)
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='Seconds to spend in each timing run.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Timing runs per benchmark; the best is kept.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed regression against the baseline, as a fraction.')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save these results as the new baseline.')
+    args = parser.parse_args()
+
+    loading = time_loading(args.template)
+    print('{:<24} {:>10.2f} ms cold, {:.2f} ms from the module cache'.format(
+        'template.load', loading['compile_ms'], loading['cached_load_ms']))
+
+    template = templates.get_template(args.template)
+    results = {}
+    for size in TABLE_SIZES:
+        name = 'template.render.{}'.format(size)
+        results[name] = measure(lambda options: template.render(**options),
+                                [render_options(size)], args.min_time, args.repeat)
+        print('{:<24} {:>10.1f} us/render {:>10.1f} KiB peak'.format(
+            name, 1e6 / results[name]['ops_per_sec'], results[name]['peak_kib']))
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print('No baseline at {}; run with --save-baseline first.'.format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# END OF LINE.
@@ -23,17 +23,32 @@
 
 import os
 import sys
+import collections
+import functools
 import importlib
 import inspect
 import pkgutil
 import itertools
 import logging
 import json
+import sqlite3
 import time
 import traceback
 
 import praw
-from mako.template import Template
+import requests
+from mako.exceptions import MakoException
+
+from lapislib import cassette, coordination, parsing, resultcache, templates
+from lapislib.isolation import IsolatedPlugin
+from lapislib.images import Preflight
+from lapislib.jobs import JobQueue
+from lapislib.outbox import Outbox, Retry
+from lapislib.pipeline import Pipeline
+from lapislib.profiling import Profiler
+from lapislib.store import Store
+from lapislib.transform import Transformer
+from lapislib.urls import Canonicalizer
 
 __author__ = 'kupiakos'
 __version__ = '0.7'
@@ -56,6 +71,11 @@ class LapisLazuli:
     - import_display: A dictionary with the possible values header and footer.
     It defines what to put above and below the export links.
     - import_urls: A list of URLs to be exported. The most important field.
+    - media: Added by the preflight stage, if on. A dictionary of import URLs
+    to what `lapislib.images.Preflight.probe` found out about them, such as
+    size and oversize.
+    - local_files: Added by the transform stage, if on. A dictionary of
+    oversize import URLs to smaller copies of their images on disk.
 
     "Export" means to take an imported image, video, etc., and upload it to a specific
     site to host as a mirror. This includes sites such as imgur, vid.me, or gyfcat.
@@ -64,6 +84,8 @@ class LapisLazuli:
     - exporter: The name of the class that exported this. Used for deletion.
     - link_display: The raw Markup text to represent the link.
     - delete_info: The information required to delete this image.
+    - failed: Set by an exporter that gave up partway. The export isn't
+    shown, and what it uploaded is queued for deletion using delete_info.
 
     ### The Lapis Process ###
 
@@ -88,10 +110,25 @@ class LapisLazuli:
     - `delete_export` - This is used to delete uploads already made.
     - `login` - In case our service needs to perform one login at start.
     - `verify_options` - Ensure that the configuration contains valid info.
+    - `prepare_submissions` - Called with the list of new submissions in each
+    scan before any of them are imported, so that lookups can be batched.
+    - `canonicalize_url` - Called with a canonical URL (see `lapislib.urls`);
+    returns another for links to the same thing in a site-specific form,
+    like short links, or None.
+    - `close` - Called when Lapis shuts down or restarts, to stop any
+    threads or processes the plugin started.
 
     Generally, plugin functions should accept a kwargs argument to absorb any
     extraneous options that will inevitably be passed in.
 
+    Plugins that want to remember things across restarts can keep
+    a `lapislib.store.Store` in the `cache_dir` option, which is always an
+    absolute path.
+
+    Plugins named in the isolate option run in processes of their own (see
+    `lapislib.isolation`). Instead of Reddit submissions, they are given
+    stubs with only the id, url, permalink and title.
+
     """
 
     sr = None
@@ -103,8 +140,22 @@ class LapisLazuli:
     use_oauth = False
     access_information = None
     username = None
-    use_mako = False
-    mako_template = None
+    subreddits = None
+    canonicalize = None
+    preflight = None
+    transformer = None
+    # template file: the last Template that compiled from it
+    mako_templates = None
+    profiler = None
+    state = None
+    # Kept on the class, so that queued replies survive a restart in main().
+    reply_queue = None
+    deletion_queue = None
+    coordinator = None
+    pipeline = None
+    import_cache = None
+    # plugin class name: IsolatedPlugin
+    isolated_plugins = {}
 
     def __init__(self, **kwargs):
         """Initialize the Lapis Lazuli Mirroring System.
@@ -132,12 +183,28 @@ class LapisLazuli:
             self.log.addHandler(logfile)
         self.log.info(' --- STARTING LAPIS MIRROR --- ')
         self.verify_options()
+        # What Lapis itself needs to remember across restarts.
+        self.state = Store.in_dir(self.options['cache_dir'], 'lapis')
+        self.load_cassette()
+        self.load_profiler()
+        self.load_reply_queue()
+        self.load_coordinator()
+        self.load_import_cache()
         self.login()
         self.load_plugins()
+        self.load_url_rules()
+        self.load_parser_pool()
+        self.load_preflight()
+        self.load_transformer()
+        self.load_deletion_queue()
+        self.load_pipeline()
         self.call_plugin_function('verify_options', self.options)
         self.call_plugin_function('login')
+        # Deleting needs the plugins logged in, including for jobs left over
+        # from before a restart.
+        self.deletion_queue.start()
 
-    def call_plugin_function(self, func_name: str, *args, **kwargs) -> list:
+    def call_plugin_function(self, func_name: str, *args, plugins: list=None, **kwargs) -> list:
         """Call all registered plugins with function <func_name>.
 
         For example, if you have three proper import plugins, and
@@ -150,20 +217,21 @@ class LapisLazuli:
 
         :param func_name: The name of the function to call for each plugin.
         :param args: The positional arguments with which to call the function.
+        :param plugins: The plugins to call. Defaults to all of them.
         :param kwargs: The named arguments with which to call the function.
         :return: A list of the values returned from the plugins with the function.
         """
         self.log.debug('Calling %s() on plugins', func_name)
         returns = []
-        for plugin in itertools.chain(self.plugins):
-            display_name = '%s.%s()' % (plugin.__class__.__name__, func_name)
+        for plugin in itertools.chain(self.plugins if plugins is None else plugins):
+            display_name = '%s.%s()' % (plugin_class(plugin).__name__, func_name)
             try:
                 if hasattr(plugin, func_name):
                     # self.log.debug('Calling %s', display_name)
                     import_data = getattr(plugin, func_name)(*args, **kwargs)
                     if import_data:
                         self.log.info('Successfully imported data from %s.%s()',
-                                      plugin.__class__.__name__, func_name)
+                                      plugin_class(plugin).__name__, func_name)
                         returns.append(import_data)
                 # else:
                 #     self.log.debug('%s does not have a display_name() function',
@@ -173,20 +241,73 @@ class LapisLazuli:
                                display_name, traceback.format_exc())
         return returns
 
-    def forward_reply(self, item):
+    def forward_replies(self) -> None:
+        """Forward new replies and messages to the maintainer.
+
+        Unread items are fetched and marked as read in batches, and only the
+        ones that were marked are forwarded; the rest stay unread and are
+        tried again next time. Being unread is what makes them new, so no
+        cursor is needed. Rather than a message per reply, the maintainer
+        gets a digest at most every forward_interval seconds (15 minutes by
+        default). The digest waits in the state store until it is sent.
+        """
+        items = self.mark_as_read(list(self.reddit.get_unread(limit=100)))
+        if items:
+            digest = self.state.get('forward_digest', [])
+            # The inbox is newest first.
+            for item in reversed(items):
+                author = item.author.name if getattr(item, 'author', None) else '[deleted]'
+                self.log.info('Forwarding a reply from {}:  \n{}'.format(author, item.body))
+                digest.append({'author': author,
+                               'body': item.body,
+                               'context': getattr(item, 'context', None)})
+            self.state.set('forward_digest', digest)
+        self.send_digest()
+
+    def mark_as_read(self, items: list) -> list:
+        """Mark inbox items as read, a hundred to a request.
+
+        :return: The items that were marked.
+        """
+        marked = []
+        for start in range(0, len(items), 100):
+            batch = items[start:start + 100]
+            try:
+                self.reddit._mark_as_read([item.fullname for item in batch])
+            except (praw.errors.PRAWException, requests.RequestException):
+                self.log.warning('Could not mark messages as read:\n%s', traceback.format_exc())
+                continue
+            marked.extend(batch)
+        return marked
+
+    def send_digest(self) -> None:
+        """Send the maintainer the replies forwarded since the last digest, if it's time."""
+        digest = self.state.get('forward_digest')
+        if not digest:
+            return
+        if time.time() - self.state.get('forward_digest_sent', 0) < self.options.get(
+                'forward_interval', 15 * 60):
+            return
+        parts = []
+        for entry in digest:
+            quoted = '\n'.join('> ' + line for line in entry['body'].splitlines())
+            parts.append('**/u/{}**:\n\n{}{}\n\n---\n\n'.format(
+                entry['author'], quoted,
+                '\n\n[Context]({})'.format(entry['context']) if entry['context'] else '')[:8000])
+        # Reddit messages can't be longer than 10000 characters.
+        messages = ['']
+        for part in parts:
+            if len(messages[-1]) + len(part) > 9000:
+                messages.append('')
+            messages[-1] += part
+        subject = '{} forwarded {} replies'.format(self.username, len(digest))
         try:
-            item.mark_as_read()
-            response = '{}{}'.format(
-                item.body,
-                '  \n[Context]({})'.format(item.context)
-                if hasattr(item, 'context') else '')
-            self.log.info('Forwarding a reply from {}:  \n{}'.format(
-                item.author.name, item.body))
-            self.reddit.send_message(self.options['maintainer'],
-                                     '{} forward from {}'.format(self.username, item.author.name),
-                                     response)
-        except (AttributeError, praw.errors.PRAWException):
-            pass
+            for message in messages:
+                self.reddit.send_message(self.options['maintainer'], subject, message)
+        except praw.errors.PRAWException:
+            self.log.warning('Could not send the reply digest:\n%s', traceback.format_exc())
+            return
+        self.state.update({'forward_digest': [], 'forward_digest_sent': time.time()})
 
     def get_submission_by_id(self, sub_id: str) -> praw.objects.Submission:
         """Given a submission ID, load the actual submission object.
@@ -196,7 +317,8 @@ class LapisLazuli:
         :param sub_id: The submission ID
         :return:
         """
-        url = 'https://www.reddit.com/r/{0}/comments/{1}/_/'.format(self.options['subreddit'], sub_id)
+        url = 'https://www.reddit.com/r/{0}/comments/{1}/_/'.format(
+            next(iter(self.subreddits.values()))['name'], sub_id)
         return self.reddit.get_submission(url=url)
 
     def load_plugins(self) -> None:
@@ -206,6 +328,7 @@ class LapisLazuli:
         define __plugin__ as the plugin class somewhere in the module.
         """
         self.plugins = []
+        isolate = self.options.get('isolate', {})
         if 'plugins_dir' not in self.options:
             self.options['plugins_dir'] = 'plugins'
             self.log.warning('plugins_dir not defined, using ' + self.options['plugins_dir'])
@@ -228,10 +351,277 @@ class LapisLazuli:
             if inspect.isclass(plugin):
                 self.log.info('Initializing plugin %s', plugin.__name__)
                 try:
-                    self.plugins.append(plugin(**self.options))
+                    if plugin.__name__ in isolate.get('plugins', ()):
+                        self.plugins.append(self.load_isolated_plugin(plugin, isolate))
+                    else:
+                        self.plugins.append(plugin(**self.options))
                 except Exception:
                     self.log.warning('Could not initialize plugin %s', plugin.__name__)
 
+    def load_isolated_plugin(self, plugin: type, isolate: dict) -> IsolatedPlugin:
+        """Start a plugin in a process of its own, or reuse the one already running.
+
+        The isolate option is a dictionary with plugins, the names of the
+        plugin classes to isolate, and any `lapislib.isolation.IsolatedPlugin`
+        arguments, like max_rss_mb, max_tasks and ping_interval.
+        """
+        running = self.isolated_plugins.get(plugin.__name__)
+        if running is not None and not running.closed:
+            # We're being restarted. The plugin was fine, so keep it.
+            return running
+        settings = {key: value for key, value in isolate.items() if key != 'plugins'}
+        isolated = IsolatedPlugin(plugin, self.options, **settings)
+        self.isolated_plugins[plugin.__name__] = isolated
+        return isolated
+
+    def load_url_rules(self) -> None:
+        """Set up URL canonicalization, with every plugin's own rules.
+
+        Extra host aliases can be given in the host_aliases option, as a
+        dictionary of alias to host.
+        """
+        self.canonicalize = Canonicalizer(host_aliases=self.options.get('host_aliases'))
+        for plugin in self.plugins:
+            if hasattr(plugin, 'canonicalize_url'):
+                self.canonicalize.add_rule(plugin.canonicalize_url)
+
+    def load_preflight(self) -> None:
+        """Check image sizes before exporting if preflight is set.
+
+        The preflight option is either true or a dictionary of
+        `lapislib.images.Preflight` arguments, like max_image_mb and
+        max_animated_mb. The default limits are Imgur's.
+        """
+        # Shrinking images needs to know which are too big.
+        config = self.options.get('preflight') or bool(self.options.get('transform'))
+        if not config:
+            return
+        try:
+            self.preflight = Preflight(self.options['useragent'],
+                                       **(config if isinstance(config, dict) else {}))
+        except TypeError as e:
+            raise LapisError('Invalid preflight configuration: {}'.format(e))
+
+    def load_transformer(self) -> None:
+        """Shrink oversize images before exporting them if transform is set.
+
+        The transform option is either true or a dictionary of
+        `lapislib.transform.Transformer` arguments, like workers,
+        budget_seconds and max_dimension. Images are shrunk to fit the
+        preflight limits, size and pixels both, which turns the preflight on
+        too. Needs Pillow.
+        """
+        config = self.options.get('transform')
+        if not config:
+            return
+        if self.transformer is not None:
+            # We're being restarted. Keep the worker processes we have.
+            return
+        try:
+            LapisLazuli.transformer = Transformer(
+                self.options['useragent'], os.path.join(self.options['cache_dir'], 'transformed'),
+                self.preflight.max_image, self.preflight.max_animated, self.preflight.max_pixels,
+                **(config if isinstance(config, dict) else {}))
+        except ImportError:
+            raise LapisError('The transform option needs Pillow; run pip install Pillow')
+        except (TypeError, OSError) as e:
+            raise LapisError('Invalid transform configuration: {}'.format(e))
+
+    def load_parser_pool(self) -> None:
+        """Parse big pages in worker processes if parse_processes is set.
+
+        The parse_processes option is the number of processes (true means
+        one per CPU), or a dictionary of `lapislib.parsing.start` arguments,
+        like workers and min_bytes. It is only worth it when imports run
+        at the same time, as with the pipeline option.
+        """
+        config = self.options.get('parse_processes')
+        if not config or parsing.running():
+            return
+        if isinstance(config, dict):
+            config = dict(config)
+        elif config is True:
+            config = {}
+        else:
+            config = {'workers': config}
+        config['modules'] = [plugin.__class__.__module__ for plugin in self.plugins
+                             if not isinstance(plugin, IsolatedPlugin)]
+        try:
+            parsing.start(**config)
+        except (ValueError, TypeError, OSError) as e:
+            raise LapisError('Could not start the parser processes: {}'.format(e))
+
+    def load_cassette(self) -> None:
+        """Record or replay all HTTP traffic if a cassette is configured.
+
+        The cassette option is a dictionary with these values:
+        - path: The cassette file, relative to the script directory.
+        - mode: "record" to capture live traffic, "replay" to serve it back.
+        - latency: "original" to replay with recorded timings, "none" for none.
+        """
+        config = self.options.get('cassette')
+        if not config:
+            return
+        path = os.path.join(get_script_dir(), config['path'])
+        current = cassette.active()
+        if current is not None and current.path == path:
+            # We're being restarted. Keep the cassette we already have.
+            return
+        try:
+            tape = cassette.Cassette(path,
+                                     mode=config.get('mode', 'replay'),
+                                     latency=config.get('latency', 'original'))
+        except (OSError, ValueError) as e:
+            raise LapisError('Could not load cassette: {}'.format(e))
+        cassette.install(tape)
+
+    def load_reply_queue(self) -> None:
+        """Post replies from a background thread if async_replies is set.
+
+        Replies are then posted oldest submission first, and retried when
+        Reddit rate limits us, without holding up the next import.
+        The async_replies option is either true or a dictionary of
+        `lapislib.outbox.Outbox` arguments, like max_attempts and backoff.
+        """
+        config = self.options.get('async_replies')
+        if not config:
+            return
+        if self.reply_queue is not None and self.reply_queue.is_alive():
+            # We're being restarted. Keep the replies we have queued, but
+            # post them with this instance, not the one that failed.
+            self.reply_queue.handler = self.send_queued_reply
+            self.reply_queue.on_failure = self.drop_queued_reply
+            return
+        LapisLazuli.reply_queue = Outbox(
+            self.send_queued_reply, self.drop_queued_reply, name='lapis-replies',
+            **(config if isinstance(config, dict) else {}))
+
+    def load_deletion_queue(self) -> None:
+        """Set up the background queue that deletes exports we couldn't use.
+
+        Its workers are started at the end of __init__, once the plugins
+        have logged in.
+
+        Deletions are kept in cache_dir/jobs.sqlite3 until they succeed, so
+        none are forgotten across restarts. Failures are retried with
+        backoff, and given up on deletions are kept as dead jobs. The
+        deletion_queue option is a dictionary of `lapislib.jobs.JobQueue`
+        arguments, like workers and max_attempts.
+        """
+        if self.deletion_queue is not None and self.deletion_queue.is_alive():
+            # We're being restarted. Keep the queue we have, but run it
+            # with this instance's plugins, not the ones that failed.
+            self.deletion_queue.handler = self.delete_export
+            return
+        LapisLazuli.deletion_queue = JobQueue(
+            os.path.join(self.options['cache_dir'], 'jobs.sqlite3'), 'delete_export',
+            self.delete_export, **self.options.get('deletion_queue', {}))
+
+    def load_coordinator(self) -> None:
+        """Set up how submissions are shared with other Lapis processes.
+
+        The coordination option is a dictionary with a backend, local
+        (the default: this process is the only one) or sqlite, and that
+        backend's arguments; see `lapislib.coordination`. The sqlite
+        backend's path defaults to cache_dir/coordination.sqlite3, and
+        every process mirroring the same subreddits must use the same one.
+        """
+        if self.coordinator is not None:
+            # We're being restarted. Keep what we've done and the leases we hold.
+            return
+        config = dict(self.options.get('coordination', {}))
+        if config.get('backend') == 'sqlite':
+            if 'path' in config:
+                config['path'] = os.path.join(get_script_dir(), config['path'])
+            else:
+                config['path'] = os.path.join(self.options['cache_dir'], 'coordination.sqlite3')
+        try:
+            LapisLazuli.coordinator = coordination.create(**config)
+        except (ValueError, TypeError, OSError) as e:
+            raise LapisError('Could not set up coordination: {}'.format(e))
+
+    def load_pipeline(self) -> None:
+        """Run each stage of processing on its own workers if pipeline is set.
+
+        The stages are import, preflight, transform, export and post, and each
+        has a bounded queue in front of it; see `lapislib.pipeline`. The
+        pipeline option is either true or a dictionary of stage names to their
+        workers and queue_size, so that slow stages (usually export) can be
+        given more workers than the rest. How each stage is doing is logged
+        every scan.
+        """
+        config = self.options.get('pipeline')
+        if not config:
+            return
+        stages = (('import', self.run_imports, 2),
+                  ('preflight', self.run_preflight, 2),
+                  ('transform', self.run_transform, 1),
+                  ('export', self.run_exports, 4),
+                  ('post', self.post_links, 1))
+        if self.pipeline is not None and self.pipeline.is_alive():
+            # We're being restarted. Let what's in the pipeline finish, but
+            # with this instance and its plugins, not the ones that failed.
+            handlers = {name: handler for name, handler, _ in stages}
+            for stage in self.pipeline.stages:
+                stage.handler = functools.partial(self.profiler.call, handlers[stage.name])
+            self.pipeline.on_done = self.finish_submission
+            return
+        if not isinstance(config, dict):
+            config = {}
+        pipeline = Pipeline(self.finish_submission, name='lapis')
+        for name, handler, workers in stages:
+            stage = dict(config.get(name, {}))
+            try:
+                pipeline.add_stage(name, functools.partial(self.profiler.call, handler),
+                                   workers=stage.pop('workers', workers),
+                                   queue_size=stage.pop('queue_size', 8), **stage)
+            except (ValueError, TypeError) as e:
+                raise LapisError('Invalid pipeline configuration: {}'.format(e))
+        pipeline.start()
+        LapisLazuli.pipeline = pipeline
+
+    def load_import_cache(self) -> None:
+        """Remember import results by URL if import_cache is set.
+
+        The import_cache option is either true or a dictionary with a
+        backend, memory (the default) or sqlite, and that backend's
+        arguments, like maxsize and ttl; see `lapislib.resultcache`. The
+        memory backend snapshots itself to cache_dir/import_cache.json every
+        snapshot_interval seconds (default 600), and the sqlite backend
+        uses cache_dir/import_cache.sqlite3, unless given another path.
+        """
+        config = self.options.get('import_cache')
+        if not config or self.import_cache is not None:
+            return
+        config = dict(config) if isinstance(config, dict) else {}
+        config.pop('snapshot_interval', None)
+        extension = 'sqlite3' if config.get('backend') == 'sqlite' else 'json'
+        if 'path' in config:
+            config['path'] = os.path.join(get_script_dir(), config['path'])
+        else:
+            config['path'] = os.path.join(self.options['cache_dir'], 'import_cache.' + extension)
+        try:
+            LapisLazuli.import_cache = resultcache.create(**config)
+        except (ValueError, TypeError, OSError, sqlite3.Error) as e:
+            raise LapisError('Could not set up the import cache: {}'.format(e))
+
+    def load_profiler(self) -> None:
+        """Set up on-demand profiling.
+
+        Profiles are written next to the log file. See `lapislib.profiling`
+        for the values the profiling option can have. Even without it,
+        SIGUSR1 profiles the next 10 submissions and SIGUSR2 samples stacks
+        for 30 seconds.
+        """
+        output_dir = os.path.dirname(os.path.join(
+            get_script_dir(), self.options.get('logfile') or 'lapis.log'))
+        self.profiler = Profiler(output_dir, **self.options.get('profiling', {}))
+        try:
+            self.profiler.install_signals()
+        except ValueError:
+            # Signals can only be handled from the main thread.
+            self.log.warning('Could not install profiling signal handlers')
+
     def login(self) -> None:
         """Log into required services, like Reddit."""
         self.log.info('Logging into Reddit...')
@@ -242,7 +632,9 @@ class LapisLazuli:
             self.username = self.options['reddit_user']
             self.reddit.login(username=self.username,
                               password=self.options['reddit_password'])
-        self.sr = self.reddit.get_subreddit(self.options['subreddit'])
+        # One listing for every subreddit we serve: /r/a+b+c
+        self.sr = self.reddit.get_subreddit('+'.join(
+            entry['name'] for entry in self.subreddits.values()))
 
     def oauth_authorize(self):
         oauth = self.options['reddit_oauth']
@@ -262,10 +654,31 @@ class LapisLazuli:
         self.access_information = self.reddit.refresh_access_information(
             refresh_token=self.access_information['refresh_token'])
 
-    def process_submission(self, submission: praw.objects.Submission) -> None:
+    def process_submission(self, submission: praw.objects.Submission) -> bool:
         """Process a single submission, replying with a mirror if needed.
 
+        This runs every stage of the pipeline in turn; with the pipeline
+        option, each stage runs on its own workers instead.
+
         :param submission: The Reddit submission to process.
+        :return: True if a reply was queued, as from `post_links`.
+        """
+        job = self.run_imports(submission)
+        if job is not None:
+            job = self.run_preflight(job)
+        if job is not None:
+            job = self.run_transform(job)
+        if job is not None:
+            job = self.run_exports(job)
+        if job is not None:
+            return self.post_links(job)
+        return False
+
+    def run_imports(self, submission: praw.objects.Submission) -> dict:
+        """The import stage: check a submission needs a mirror, and import it.
+
+        :param submission: The Reddit submission to process.
+        :return: The job for the export stage, or None if there's nothing to export.
         """
         self.log.debug('Processing submission\n'
                        '        permalink:%s\n'
@@ -273,23 +686,118 @@ class LapisLazuli:
                        submission.permalink, submission.url)
         if not hasattr(submission, 'comments'):
             self.log.warning('Submission has no comments, skipping')
-            return
+            return None
         if any(comment.author.name == self.username
                for comment in submission.comments if comment.author):
             self.log.debug('Have already commented here--moving on.')
-            return
-
-        import_results = self.call_plugin_function('import_submission', submission=submission)
+            return None
+        if self.reply_queue is not None and submission.id in self.reply_queue:
+            self.log.debug('Already have a reply queued here--moving on.')
+            return None
+
+        settings = self.subreddit_settings(submission.subreddit.display_name)
+        plugins = self.enabled_plugins(settings)
+        url = self.canonicalize(submission.url)
+        import_results = self.import_submission(submission, plugins, url)
         if not any(import_results):
             self.log.debug('No processing done on "%s"', submission.url)
-            return
+            return None
         self.log.info('\n\nImported data from submission "%s"', submission.url)
+        return {'submission': submission, 'url': url, 'settings': settings, 'plugins': plugins,
+                'import_results': import_results}
+
+    def import_submission(self, submission: praw.objects.Submission, plugins: list,
+                          url: str) -> list:
+        """Call the importers on a submission, unless the same URL was imported recently.
+
+        :param submission: The Reddit submission.
+        :param plugins: The plugins enabled for its subreddit.
+        :param url: The submission's canonical URL.
+        :return: The import results.
+        """
+        if self.import_cache is None:
+            return self.call_plugin_function('import_submission', submission=submission,
+                                             plugins=plugins)
+        key = url
+        if plugins is not self.plugins:
+            # Other plugins might find something else.
+            key += ' ' + ','.join(sorted(plugin_class(plugin).__name__ for plugin in plugins))
+        import_results = self.import_cache.get(key)
+        if import_results is not None:
+            self.log.info('Reusing the import of "%s"', submission.url)
+            return import_results
+        import_results = self.call_plugin_function('import_submission', submission=submission,
+                                                   plugins=plugins)
+        # Failures aren't remembered; they may well work next time.
+        if any(import_results):
+            try:
+                self.import_cache.set(key, import_results)
+            except (TypeError, ValueError) as e:
+                self.log.debug('Could not cache the import of "%s": %s', submission.url, e)
+        return import_results
+
+    def run_preflight(self, job: dict) -> dict:
+        """The preflight stage: check imported images against size limits.
+
+        Only the first few kilobytes of each image are read. What's found
+        is added to each import info as media, so that exporters can skip
+        oversize images rather than fail on them.
+
+        :param job: The job from the import stage.
+        :return: The job for the export stage.
+        """
+        if self.preflight is None:
+            return job
+        for import_info in filter(None, job['import_results']):
+            if import_info.get('video') or not import_info.get('import_urls'):
+                continue
+            media = self.preflight.probe_all(import_info['import_urls'])
+            import_info['media'] = media
+            for url, info in media.items():
+                if info['oversize']:
+                    self.log.info('%s is over the size limits: %s, %s bytes, %sx%s, %d frames',
+                                  url, info.get('format'), info['size'], info.get('width'),
+                                  info.get('height'), info.get('frames', 1))
+        return job
+
+    def run_transform(self, job: dict) -> dict:
+        """The transform stage: shrink oversize images so that they can be exported.
+
+        :param job: The job from the preflight stage.
+        :return: The job for the export stage.
+        """
+        if self.transformer is None:
+            return job
+        for import_info in filter(None, job['import_results']):
+            local_files = {}
+            for url, info in import_info.get('media', {}).items():
+                if info['oversize']:
+                    path = self.transformer.shrink(url, info)
+                    if path:
+                        local_files[url] = path
+            if local_files:
+                import_info['local_files'] = local_files
+        return job
+
+    def run_exports(self, job: dict) -> dict:
+        """The export stage: export everything imported.
+
+        :param job: The job from the import stage.
+        :return: The job for the post stage, with export_table and
+        import_info added, or None if nothing was exported.
+        """
         export_table = []
         import_info = None
-        for import_info in filter(None, import_results):
-            self.log.debug('Import info: %s', str(import_results))
+        for import_info in filter(None, job['import_results']):
+            self.log.debug('Import info: %s', str(job['import_results']))
             # export_results.append((import_info.get('importer_display', ''),
-            export_results = self.call_plugin_function('export_submission', **import_info)
+            export_results = self.call_plugin_function('export_submission',
+                                                       plugins=job['plugins'], **import_info)
+            failed = [result for result in export_results if result.get('failed')]
+            if failed:
+                self.queue_deletions(failed)
+                export_results = [result for result in export_results
+                                  if not result.get('failed')]
             if not any(export_results):
                 continue
             importer_display = import_info.get('importer_display', {})
@@ -297,8 +805,20 @@ class LapisLazuli:
 
         if not any(export_table):
             self.log.warning('Imports done, but no exports.')
-            return
+            return None
+        job['export_table'] = export_table
+        job['import_info'] = import_info
+        return job
 
+    def post_links(self, job: dict) -> bool:
+        """The post stage: render the reply and post or queue it.
+
+        :param job: The job from the export stage.
+        :return: True if the reply was queued, in which case the submission
+        is only done once the reply queue has posted it or given up.
+        """
+        submission, settings = job['submission'], job['settings']
+        export_table = job['export_table']
         links_display_parts = []
         for importer_display, export_results, _ in export_table:
             links_display_parts.append(importer_display.get('header', ''))
@@ -307,67 +827,257 @@ class LapisLazuli:
             links_display_parts.append(importer_display.get('footer', ''))
         if not links_display_parts:
             self.log.warning('Exports done, but no links')
-            return
+            return False
         links_display = ''.join(links_display_parts)
 
-        if self.use_mako:
-            text = self.mako_template.render(
+        if 'post_template_file' in settings:
+            template_name = os.path.join(get_script_dir(), settings['post_template_file'])
+            try:
+                self.mako_templates[template_name] = self.load_template(template_name)
+            except LapisError as e:
+                # Don't die over a bad edit; keep using the last good template.
+                self.log.error('%s', e)
+            text = self.mako_templates[template_name].render(
                 submission=submission,
                 links=links_display,
                 links_parts=links_display_parts,
-                import_info=import_info,
+                import_info=job['import_info'],
                 export_table=export_table,
-                **self.options)
+                **settings)
         else:
-            text = self.options.get('post_template',
-                                    '{links}\n\n---\n^(Lapis Mirror {version})').format(
-                links=links_display, **self.options)
+            text = settings.get('post_template',
+                                '{links}\n\n---\n^(Lapis Mirror {version})').format(
+                links=links_display, **settings)
+        if self.reply_queue is not None:
+            # Oldest first, so that nothing gets pushed back forever.
+            self.reply_queue.put((submission, text, export_table),
+                                 priority=submission.created_utc, key=submission.id)
+            self.log.debug('Queued reply to %s', submission.permalink)
+            return True
         try:
-            comment = submission.add_comment(text)
-            self.log.info('Replied comment to %s', submission.permalink)
-            self.sticky_comment(comment)
+            self.post_reply(submission, text)
         except Exception:
             self.log.error('Had an error posting to Reddit! Attempting cleanup:\n%s', traceback.format_exc())
-            try:
-                for _, export_results, _ in export_table:
-                    for export_result in export_results:
-                        if 'delete_info' in export_result and 'exporter' in export_result:
-                            matched = [i for i in self.plugins
-                                       if i.__class__.__name__ == export_result['exporter'] and
-                                       hasattr(i, 'delete_export')]
-                            for match in matched:
-                                match.delete_export(**export_result)
-            except Exception:
-                self.log.error('Error while attempting to delete exports:\n%s', traceback.format_exc())
-            return
+            self.delete_exports(export_table)
             # TODO: Implement SQLite log
             # submission_id = submission.id
             # comment_id = comment.id
+        return False
+
+    def post_reply(self, submission: praw.objects.Submission, text: str):
+        """Reply to a submission and sticky the reply.
+
+        :return: The new comment.
+        """
+        comment = submission.add_comment(text)
+        self.log.info('Replied comment to %s', submission.permalink)
+        self.sticky_comment(comment)
+        return comment
+
+    def send_queued_reply(self, reply: tuple) -> None:
+        """Post a reply from the reply queue, asking for a retry if Reddit is busy.
+
+        :param reply: The submission, the text, and the export table.
+        """
+        submission, text, _ = reply
+        try:
+            self.post_reply(submission, text)
+            self.coordinator.complete(submission.id)
+        except praw.errors.RateLimitExceeded as e:
+            self.log.warning('Rate limited by Reddit for %s seconds', e.sleep_time)
+            raise Retry(e.sleep_time, pause=True)
+        except praw.errors.HTTPException as e:
+            # Forbidden and NotFound (locked, archived or removed threads)
+            # won't get any better, so only retry Reddit being overloaded.
+            status = e._raw.status_code
+            if status != 429 and status < 500:
+                raise
+            self.log.warning('Reddit returned %d, retrying', status)
+            raise Retry()
+        except (requests.ConnectionError, requests.Timeout):
+            self.log.warning('Could not reach Reddit:\n%s', traceback.format_exc())
+            raise Retry()
+
+    def drop_queued_reply(self, reply: tuple, exception: Exception) -> None:
+        """Clean up after a reply that couldn't be posted."""
+        submission, _, export_table = reply
+        self.log.error('Had an error posting to Reddit on %s! Attempting cleanup: %r',
+                       submission.permalink, exception)
+        self.delete_exports(export_table)
+        self.coordinator.complete(submission.id)
+
+    def delete_exports(self, export_table: list) -> None:
+        """Queue every deletable export in an export table for deletion.
+
+        Deleting happens in the background; see `load_deletion_queue`.
+        """
+        self.queue_deletions([export_result
+                              for _, export_results, _ in export_table
+                              for export_result in export_results])
+
+    def queue_deletions(self, export_results: list) -> None:
+        """Queue the deletable exports among some export results for deletion."""
+        deletions = [export_result for export_result in export_results
+                     if 'delete_info' in export_result and 'exporter' in export_result]
+        if not deletions:
+            return
+        try:
+            self.deletion_queue.put_many(deletions)
+            self.log.info('Queued %d exports for deletion', len(deletions))
+        except Exception:
+            self.log.error('Could not queue exports for deletion:\n%s\n%s',
+                           deletions, traceback.format_exc())
+
+    def delete_export(self, export_result: dict) -> bool:
+        """Delete one export with the plugin that made it. Run by the deletion queue.
+
+        :param export_result: The export info dictionary.
+        :return: Whether it was deleted.
+        """
+        matched = [i for i in self.plugins
+                   if plugin_class(i).__name__ == export_result['exporter'] and
+                   hasattr(i, 'delete_export')]
+        if not matched:
+            raise LapisError('No plugin can delete exports from {}'.format(
+                export_result['exporter']))
+        return all([match.delete_export(**export_result) for match in matched])
+
+    def get_new_submissions(self) -> list:
+        """Get the newest submissions of every subreddit, in one listing.
+
+        The listing is as long as all the subreddits' scan limits put
+        together, and no subreddit gets more than its own scan limit.
+        """
+        limits = {key: self.subreddit_settings(key).get('scan_limit', 50)
+                  for key in self.subreddits}
+        counts = dict.fromkeys(limits, 0)
+        submissions = []
+        for submission in self.sr.get_new(limit=sum(limits.values())):
+            key = submission.subreddit.display_name.lower()
+            if key in counts:
+                counts[key] += 1
+                if counts[key] > limits[key]:
+                    continue
+            submissions.append(submission)
+        return submissions
+
+    def subreddit_settings(self, name: str) -> dict:
+        """The options to use for a subreddit: the global ones, with its overrides.
+
+        :param name: The subreddit's name.
+        :return: The options, with subreddit set to the subreddit's name.
+        """
+        overrides = self.subreddits.get(name.lower(), {'name': name})
+        settings = dict(self.options)
+        # A subreddit's own template beats a global one of the other kind.
+        if 'post_template' in overrides:
+            settings.pop('post_template_file', None)
+        if 'post_template_file' in overrides:
+            settings.pop('post_template', None)
+        settings.update(overrides)
+        settings['subreddit'] = overrides['name']
+        return settings
+
+    def enabled_plugins(self, settings: dict) -> list:
+        """:return: The plugins a subreddit's settings enable. All of them by default."""
+        if settings.get('plugins') is None:
+            return self.plugins
+        return [plugin for plugin in self.plugins
+                if plugin_class(plugin).__name__ in settings['plugins']]
 
     def scan_submissions(self, delay: bool=False) -> None:
         """Scan the most recent submissions continually.
 
         :param delay: Whether to delay in-between each submission scanned.
         """
-        done = []
+        prepared = set()
+        cache_config = self.options.get('import_cache')
+        snapshot_interval = (cache_config.get('snapshot_interval', 600)
+                             if isinstance(cache_config, dict) else 600)
+        next_snapshot = time.monotonic() + snapshot_interval
         while True:
             if self.options.get('forward_replies'):
-                for item in self.reddit.get_unread():
-                    self.forward_reply(item)
-            for submission in self.sr.get_new(limit=self.options.get('scan_limit', 50)):
+                self.forward_replies()
+            submissions = self.get_new_submissions()
+            new_submissions = [s for s in submissions if s.id not in prepared]
+            if new_submissions:
+                self.call_plugin_function('prepare_submissions', new_submissions)
+            prepared = {s.id for s in submissions}
+            for submission in submissions:
+                if self.pipeline is not None and submission.id in self.pipeline:
+                    continue
+                # Skip anything done already, here or by another process.
+                if not self.coordinator.claim(submission.id):
+                    continue
+                if self.pipeline is not None:
+                    # Waits while the import stage is backed up.
+                    self.pipeline.put(submission, key=submission.id)
+                    continue
+                queued = False
                 try:
-                    if submission.id not in done:
-                        self.process_submission(submission)
+                    queued = self.profiler.call(self.process_submission, submission)
                 except Exception:
                     self.log.error('Ran into error on submission {}'.format(submission.id))
-                done.append(submission.id)
+                finally:
+                    # A queued reply completes the submission once it's posted.
+                    if not queued:
+                        self.coordinator.complete(submission.id)
                 if delay:
                     input()
+            if self.pipeline is not None:
+                self.log.info('Pipeline stages since the last scan:\n%s', self.pipeline.report())
+            self.profiler.end_cycle()
+            if self.import_cache is not None and time.monotonic() > next_snapshot:
+                try:
+                    self.import_cache.save()
+                except OSError as e:
+                    self.log.error('Could not save the import cache: %s', e)
+                next_snapshot = time.monotonic() + snapshot_interval
+            if self.profiler.restart_requested:
+                raise LapisRestart('Memory use is over the limit')
             # self.log.debug('Waiting before next check')
             time.sleep(self.options.get('delay_interval', 30))
             if self.use_oauth:
                 self.oauth_refresh()
 
+    def shutdown(self) -> None:
+        """Let work in progress finish, then let go of everything shared.
+
+        Used before a warm restart. Waits up to restart_drain_seconds
+        (default 120) for the pipeline and reply queue to empty. Anything
+        still claimed after that is released, so it will be picked up again.
+        """
+        deadline = time.monotonic() + self.options.get('restart_drain_seconds', 120)
+        if self.pipeline is not None and not self.pipeline.join(deadline - time.monotonic()):
+            self.log.warning('Restarting with %d submissions still being processed',
+                             len(self.pipeline))
+        if self.reply_queue is not None and not self.reply_queue.join(
+                max(0, deadline - time.monotonic())):
+            self.log.warning('Restarting with %d replies still queued', len(self.reply_queue))
+        self.coordinator.close()
+        if self.import_cache is not None:
+            self.import_cache.close()
+        for plugin in self.isolated_plugins.values():
+            plugin.close()
+        self.call_plugin_function('close', plugins=[
+            plugin for plugin in self.plugins if not isinstance(plugin, IsolatedPlugin)])
+        if self.transformer is not None:
+            self.transformer.close()
+        parsing.stop()
+        if cassette.active() is not None:
+            cassette.uninstall()
+        self.state.close()
+
+    def finish_submission(self, key: str, result, error: Exception) -> None:
+        """Called by the pipeline once a submission has left it."""
+        if error is not None:
+            self.log.error('Ran into error on submission {}'.format(key))
+        elif result is True:
+            # The reply is queued. Until it's posted, our lease on the
+            # submission keeps being renewed, and lapses if we die first.
+            return
+        self.coordinator.complete(key)
+
     def sticky_comment(self, comment) -> bool:
         """Attempt to sticky a comment, failing silently.
 
@@ -397,8 +1107,18 @@ class LapisLazuli:
         """Ensure that the provided options supply us with enough information."""
         if 'version' not in self.options:
             self.options['version'] = __version__
-        if 'subreddit' not in self.options:
+        subreddits = self.options.get('subreddits') or (
+            [self.options['subreddit']] if 'subreddit' in self.options else [])
+        if not subreddits:
             raise LapisError('You must define a subreddit!')
+        # subreddit name in lowercase: that subreddit's overrides
+        self.subreddits = collections.OrderedDict()
+        for entry in subreddits:
+            if isinstance(entry, str):
+                entry = {'name': entry}
+            if not entry.get('name'):
+                raise LapisError('Every subreddit must have a name!')
+            self.subreddits[entry['name'].lower()] = entry
         if 'reddit_oauth' in self.options:
             oauth = self.options['reddit_oauth']
             if not all(oauth.get(k)
@@ -417,19 +1137,39 @@ class LapisLazuli:
                 raise LapisError('You must define a password!')
         if 'maintainer' not in self.options:
             raise LapisError('You must define a maintainer!')
-        if 'post_template_file' in self.options:
-            if 'post_template' in self.options:
-                raise LapisError('Both a template file and template field were provided!')
-            template_name = os.path.join(get_script_dir(), self.options['post_template_file'])
+        # Where plugins keep what they've learned between runs.
+        self.options['cache_dir'] = os.path.join(
+            get_script_dir(), self.options.get('cache_dir', 'cache'))
+        if 'post_template_file' in self.options and 'post_template' in self.options:
+            raise LapisError('Both a template file and template field were provided!')
+        self.mako_templates = {}
+        for name in self.subreddits:
+            settings = self.subreddit_settings(name)
+            if 'post_template_file' not in settings:
+                continue
+            template_name = os.path.join(get_script_dir(), settings['post_template_file'])
             if not os.path.isfile(template_name):
                 raise LapisError('A template file was specified, but the file does not exist!')
-            self.use_mako = True
-            self.mako_template = Template(filename=template_name)
+            self.mako_templates[template_name] = self.load_template(template_name)
 
         self.options['useragent'] = self.options.get(
             'useragent', '{name}/{version} by {maintainer}'
         ).format(name='LapisMirror', **self.options)
 
+    def load_template(self, template_name: str):
+        """Get a post template, recompiling it only if the file has changed.
+
+        Compiled templates are kept in cache_dir, and shared by every
+        LapisLazuli in this process.
+
+        :param template_name: The path of the template file.
+        """
+        try:
+            return templates.get_template(
+                template_name, os.path.join(self.options['cache_dir'], 'templates'))
+        except MakoException as e:
+            raise LapisError('Could not compile the post template: {}'.format(e))
+
 
 def get_script_dir():
     """Try to reliably get the directory of the current script."""
@@ -439,10 +1179,19 @@ def get_script_dir():
         return os.path.dirname(os.path.realpath(sys.argv[0]))
 
 
+def plugin_class(plugin) -> type:
+    """The class of a plugin, even if it runs in another process."""
+    return plugin.plugin_class if isinstance(plugin, IsolatedPlugin) else plugin.__class__
+
+
 class LapisError(Exception):
     """Good job, you made Lapis cry."""
 
 
+class LapisRestart(Exception):
+    """Raised between scan cycles to have main() start Lapis over in a fresh process."""
+
+
 def main():
     config_path = os.path.join(get_script_dir(), 'lapis.conf')
     if not os.path.isfile(config_path):
@@ -457,6 +1206,12 @@ def main():
             # LapisError happens when there's something configured wrong,
             # or a critical error occurs. We should leave the program.
             break
+        except LapisRestart as e:
+            # Memory that has leaked can only be given back by a new process.
+            lapis.log.warning('Restarting: %s', e)
+            lapis.shutdown()
+            logging.shutdown()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
         except Exception:
             lapis.log.error('Error while scanning submission! %s', traceback.format_exc())
             time.sleep(10)
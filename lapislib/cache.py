@@ -0,0 +1,112 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Small in-process caches.
+
+`TTLCache` is a thread-safe dictionary that forgets entries after a while,
+and forgets the least recently used entries once it grows too big.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries expire."""
+
+    def __init__(self, maxsize: int=1024, ttl: float=3600):
+        """Create an empty cache.
+
+        :param maxsize: The most entries to keep. The least recently used go first.
+        :param ttl: How many seconds an entry is good for. None means forever.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Look up a key, counting a hit or miss.
+
+        :param key: The key to look up.
+        :param default: What to return if it isn't there or has expired.
+        """
+        with self.lock:
+            entry = self.data.get(key, _missing)
+            if entry is not _missing:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float=_missing) -> None:
+        """Store a value.
+
+        :param key: The key to store it under.
+        :param value: The value.
+        :param ttl: Overrides the cache's TTL for this entry.
+        """
+        ttl = self.ttl if ttl is _missing else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, _missing)
+        return default if entry is _missing else entry[1]
+
+    def items(self) -> list:
+        """Every entry that hasn't expired, least recently used first.
+
+        :return: A list of (key, value, seconds left) tuples. Seconds left
+        is None for entries that never expire.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return [(key, value, None if expires is None else expires - now)
+                    for key, (expires, value) in self.data.items()
+                    if expires is None or expires > now]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+# END OF LINE.
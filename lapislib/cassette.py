@@ -0,0 +1,299 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""HTTP record/replay cassettes.
+
+A cassette is a gzipped file of JSON lines, one line per HTTP exchange.
+In record mode, every request that goes through `requests` (our shared
+session, but also praw, tweepy and imgurpython, which all use `requests`
+underneath) is sent for real and written to the cassette.
+In replay mode, nothing touches the network: responses are served from
+the cassette, either with the latency they were recorded with or instantly.
+
+Credentials are scrubbed before anything is written. Query parameters in
+`SECRET_PARAMS` are blanked out of recorded URLs and out of JSON and form
+response bodies (OAuth token responses), and the headers in
+`SECRET_HEADERS` are never stored. Request bodies are only kept as a
+hash, taken after the same scrubbing, so that login and token requests
+match on replay and no fingerprint of a secret is written. The same
+scrubbing is applied when matching during replay, so the recording still
+matches.
+"""
+
+import base64
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.response import HTTPResponse
+
+SECRET_PARAMS = frozenset(('api_key', 'access_token', 'client_secret',
+                           'client_id', 'password', 'passwd', 'refresh_token',
+                           'nonce'))
+SECRET_HEADERS = frozenset(('authorization', 'cookie', 'set-cookie',
+                            'proxy-authorization'))
+# Headers that no longer describe a body we've already decoded.
+STALE_HEADERS = frozenset(('content-encoding', 'transfer-encoding'))
+
+log = logging.getLogger('lapis.cassette')
+
+_active = None
+_original_send = HTTPAdapter.send
+
+
+class CassetteMiss(requests.ConnectionError):
+    """A replayed request has no recording.
+
+    This derives from ConnectionError so plugins treat it exactly like
+    the site being unreachable.
+    """
+
+
+class Cassette:
+    """A set of recorded HTTP exchanges, backed by a file."""
+
+    def __init__(self, path: str, mode: str='replay', latency: str='original'):
+        """Open a cassette.
+
+        :param path: Where the cassette lives on disk.
+        :param mode: Either "record" or "replay".
+        :param latency: When replaying, "original" to wait as long as the
+        recorded response took, or "none" to answer immediately.
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError('Unknown cassette mode {!r}'.format(mode))
+        if latency not in ('original', 'none'):
+            raise ValueError('Unknown cassette latency {!r}'.format(latency))
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.recordings = defaultdict(deque)
+        self.file = None
+        if mode == 'replay':
+            for entry in read_entries(path):
+                self.recordings[entry_key(entry)].append(entry)
+            log.info('Loaded %d recorded requests from %s',
+                     sum(map(len, self.recordings.values())), path)
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = gzip.open(path, 'at', encoding='utf-8')
+
+    def record(self, request: requests.PreparedRequest,
+               response: requests.Response, elapsed: float) -> None:
+        """Write a live exchange to the cassette.
+
+        :param request: The request that was sent.
+        :param response: The response that came back. Its body is read.
+        :param elapsed: How long the exchange took, in seconds.
+        """
+        entry = {
+            'method': request.method,
+            'url': scrub_url(request.url),
+            'body_hash': body_hash(request.body, request.headers.get('Content-Type', '')),
+            'request_headers': scrub_headers(request.headers),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': scrub_headers(response.headers),
+            'body': base64.b64encode(scrub_body(
+                response.content, response.headers.get('Content-Type', ''))).decode('ascii'),
+            'elapsed': round(elapsed, 4),
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.file.flush()
+
+    def play(self, adapter: HTTPAdapter,
+             request: requests.PreparedRequest) -> requests.Response:
+        """Answer a request from the recordings.
+
+        Repeated identical requests are answered in the order they were
+        recorded. Once those run out, the last one keeps being served.
+
+        :param adapter: The adapter the request was sent through.
+        :param request: The request to answer.
+        :return: The recorded response.
+        """
+        key = (request.method, scrub_url(request.url),
+               body_hash(request.body, request.headers.get('Content-Type', '')))
+        with self.lock:
+            queue = self.recordings.get(key)
+            if not queue:
+                raise CassetteMiss('No recording for {} {}'.format(
+                    request.method, scrub_url(request.url)), request=request)
+            entry = queue.popleft() if len(queue) > 1 else queue[0]
+        if self.latency == 'original':
+            time.sleep(entry['elapsed'])
+        headers = {k: v for k, v in entry['headers'].items()
+                   if k.lower() not in STALE_HEADERS}
+        raw = HTTPResponse(body=io.BytesIO(base64.b64decode(entry['body'])),
+                           headers=headers,
+                           status=entry['status'],
+                           reason=entry['reason'],
+                           preload_content=False,
+                           decode_content=False)
+        return adapter.build_response(request, raw)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_entries(path: str) -> list:
+    """Read every entry in a cassette file.
+
+    A cassette cut short by a crash is read up to the damage.
+
+    :param path: The cassette to read.
+    :return: A list of entry dictionaries, in recorded order.
+    """
+    entries = []
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+    except (EOFError, ValueError):
+        log.warning('Cassette %s is truncated; using %d entries', path, len(entries))
+    return entries
+
+
+def entry_key(entry: dict) -> tuple:
+    return entry['method'], entry['url'], entry['body_hash']
+
+
+def scrub_url(url: str) -> str:
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+    query = [(k, '' if k.lower() in SECRET_PARAMS else v)
+             for k, v in parse_qsl(parts.query, keep_blank_values=True)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def scrub_headers(headers) -> dict:
+    return {k: v for k, v in headers.items() if k.lower() not in SECRET_HEADERS}
+
+
+def _scrub_json(value):
+    if isinstance(value, dict):
+        return {k: '' if k.lower() in SECRET_PARAMS else _scrub_json(v)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [_scrub_json(v) for v in value]
+    return value
+
+
+def scrub_body(body: bytes, content_type: str) -> bytes:
+    """Blank out `SECRET_PARAMS` keys in a JSON or form-encoded body.
+
+    :param body: The body as sent over the wire.
+    :param content_type: Its Content-Type header.
+    :return: The body, untouched unless it had something to scrub.
+    """
+    content_type = content_type.lower()
+    try:
+        if 'json' in content_type:
+            data = json.loads(body.decode('utf-8'))
+            scrubbed = _scrub_json(data)
+            if scrubbed != data:
+                return json.dumps(scrubbed).encode('utf-8')
+        elif 'application/x-www-form-urlencoded' in content_type:
+            query = parse_qsl(body.decode('utf-8'), keep_blank_values=True)
+            if any(k.lower() in SECRET_PARAMS for k, _ in query):
+                return urlencode([(k, '' if k.lower() in SECRET_PARAMS else v)
+                                  for k, v in query]).encode('utf-8')
+    except ValueError:
+        pass
+    return body
+
+
+def body_hash(body, content_type: str='') -> str:
+    """A fingerprint of a request body to match recordings on.
+
+    :param body: The body, as sent.
+    :param content_type: Its Content-Type header, so secrets can be scrubbed first.
+    """
+    if not body:
+        return ''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    elif not isinstance(body, bytes):
+        # Streamed uploads can't be matched on content.
+        return 'stream'
+    return hashlib.sha1(scrub_body(body, content_type)).hexdigest()
+
+
+def _send(adapter: HTTPAdapter, request: requests.PreparedRequest, **kwargs):
+    cassette = _active
+    if cassette is None:
+        return _original_send(adapter, request, **kwargs)
+    if cassette.mode == 'replay':
+        return cassette.play(adapter, request)
+    start = time.monotonic()
+    response = _original_send(adapter, request, **kwargs)
+    # Reading the content here means streamed responses get buffered
+    # while recording, but requests serves them from the buffer fine.
+    response.content
+    cassette.record(request, response, time.monotonic() - start)
+    return response
+
+
+def install(cassette: Cassette) -> None:
+    """Route all `requests` traffic in this process through a cassette.
+
+    :param cassette: The cassette to record to or replay from.
+    """
+    global _active
+    if _active is not None and _active is not cassette:
+        _active.close()
+    _active = cassette
+    HTTPAdapter.send = _send
+    log.info('Cassette %s installed in %s mode', cassette.path, cassette.mode)
+
+
+def uninstall() -> None:
+    """Go back to talking to the network directly."""
+    global _active
+    HTTPAdapter.send = _original_send
+    if _active is not None:
+        _active.close()
+        _active = None
+
+
+def active() -> Cassette:
+    """:return: The installed cassette, or None."""
+    return _active
+
+# END OF LINE.
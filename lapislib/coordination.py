@@ -0,0 +1,216 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Making sure each submission is handled by exactly one worker.
+
+Workers claim a submission before processing it, and mark it done once
+they have. A coordinator has four methods:
+- claim(key): Try to take a key. False if it's done, or someone else has it.
+- renew(): Keep every key we hold from expiring.
+- complete(key): The key is done. Nobody will get it again.
+- release(key): Give a key back without finishing it, so someone else can.
+
+`LocalCoordinator` is for a single process, and just remembers what's
+done. `SQLiteCoordinator` lets any number of processes on a machine share
+work through a database file. Claims there are leases that run out, so
+if a worker dies, whatever it held goes to someone else once the lease
+expires. While a worker is alive, a background thread renews its leases.
+Another backend (say, Redis for workers on several machines) only needs
+to provide the same methods.
+"""
+
+import collections
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class LocalCoordinator:
+    """Coordinates the workers in one process. Nothing is shared or persisted."""
+
+    def __init__(self, remember: int=10000, **_):
+        """:param remember: How many done keys to remember. The oldest are forgotten first."""
+        self.remember = remember
+        self.lock = threading.Lock()
+        self.held = set()
+        self.done = collections.OrderedDict()
+
+    def claim(self, key: str) -> bool:
+        with self.lock:
+            if key in self.done or key in self.held:
+                return False
+            self.held.add(key)
+            return True
+
+    def renew(self) -> None:
+        pass
+
+    def complete(self, key: str) -> None:
+        with self.lock:
+            self.held.discard(key)
+            self.done[key] = True
+            while len(self.done) > self.remember:
+                self.done.popitem(last=False)
+
+    def release(self, key: str) -> None:
+        with self.lock:
+            self.held.discard(key)
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteCoordinator:
+    """Coordinates workers in several processes with leases in an SQLite file."""
+
+    def __init__(self, path: str, lease_seconds: float=300, keep_done: float=7 * 24 * 60 * 60,
+                 worker: str=None, **_):
+        """Open the lease database and start renewing leases.
+
+        :param path: The database file. Every worker must use the same one.
+        :param lease_seconds: How long a claim lasts without being renewed.
+        Leases are renewed every third of this.
+        :param keep_done: How long to remember done keys, in seconds.
+        :param worker: A name for this worker. Defaults to host:pid:random.
+        """
+        self.log = logging.getLogger('lapis.coordination')
+        self.lease_seconds = lease_seconds
+        self.keep_done = keep_done
+        self.worker = worker or '{}:{}:{}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lock = threading.Lock()
+        self.held = set()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # We manage transactions ourselves, so that claims can be BEGIN IMMEDIATE.
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS leases ('
+                            'key TEXT PRIMARY KEY, '
+                            'worker TEXT, '
+                            'expires REAL, '
+                            'done INTEGER NOT NULL DEFAULT 0, '
+                            'updated REAL NOT NULL)')
+        self.closed = threading.Event()
+        self.renewer = threading.Thread(target=self.keep_renewing, name='lapis-leases',
+                                        daemon=True)
+        self.renewer.start()
+
+    def _transaction(self, func, *args):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def claim(self, key: str) -> bool:
+        def claim():
+            now = time.time()
+            row = self.db.execute('SELECT worker, expires, done FROM leases WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is not None:
+                worker, expires, done = row
+                if done or (worker != self.worker and expires > now):
+                    return False
+                if worker != self.worker:
+                    self.log.info('Taking over %s from %s, whose lease ran out', key, worker)
+            self.db.execute('INSERT OR REPLACE INTO leases (key, worker, expires, done, updated) '
+                            'VALUES (?, ?, ?, 0, ?)',
+                            (key, self.worker, now + self.lease_seconds, now))
+            return True
+
+        claimed = self._transaction(claim)
+        if claimed:
+            self.held.add(key)
+        return claimed
+
+    def renew(self) -> None:
+        held = list(self.held)
+        if not held:
+            return
+        now = time.time()
+
+        def renew():
+            self.db.executemany('UPDATE leases SET expires = ?, updated = ? '
+                                'WHERE key = ? AND worker = ? AND done = 0',
+                                [(now + self.lease_seconds, now, key, self.worker)
+                                 for key in held])
+
+        self._transaction(renew)
+
+    def complete(self, key: str) -> None:
+        now = time.time()
+        self._transaction(lambda: self.db.execute(
+            'UPDATE leases SET done = 1, expires = NULL, updated = ? WHERE key = ? AND worker = ?',
+            (now, key, self.worker)))
+        self.held.discard(key)
+
+    def release(self, key: str) -> None:
+        self._transaction(lambda: self.db.execute(
+            'DELETE FROM leases WHERE key = ? AND worker = ? AND done = 0', (key, self.worker)))
+        self.held.discard(key)
+
+    def prune(self) -> None:
+        """Forget keys that were done long enough ago."""
+        self._transaction(lambda: self.db.execute(
+            'DELETE FROM leases WHERE done = 1 AND updated < ?', (time.time() - self.keep_done,)))
+
+    def keep_renewing(self) -> None:
+        last_prune = 0
+        while not self.closed.wait(self.lease_seconds / 3):
+            try:
+                self.renew()
+                if time.time() - last_prune > 60 * 60:
+                    self.prune()
+                    last_prune = time.time()
+            except sqlite3.Error as e:
+                self.log.warning('Could not renew leases: %s', e)
+
+    def close(self) -> None:
+        """Stop renewing, and give back everything we hold."""
+        self.closed.set()
+        for key in list(self.held):
+            self.release(key)
+
+
+def create(backend: str='local', **options):
+    """Create a coordinator from the coordination option.
+
+    :param backend: local or sqlite.
+    :param options: The coordinator's arguments.
+    :return: The coordinator.
+    """
+    backends = {'local': LocalCoordinator, 'sqlite': SQLiteCoordinator}
+    if backend not in backends:
+        raise ValueError('Unknown coordination backend {!r}'.format(backend))
+    return backends[backend](**options)
+
+# END OF LINE.
@@ -0,0 +1,263 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""A table-driven importer for sites with oEmbed or OpenGraph data.
+
+Most image sites tell us everything we need in one response: either an
+oEmbed endpoint, or OpenGraph <meta> tags in the page itself. Rather than
+writing a module per site, each site is a provider entry, a dictionary
+with these values:
+- name: A short name for the site, used in logging.
+- hosts: A regex the URL's host must match.
+- oembed: The oEmbed endpoint. Leave it out to scrape OpenGraph tags instead.
+- oembed_params: Extra query parameters for the oEmbed endpoint.
+- types: The oEmbed types that are images. Defaults to photo and link.
+- fields: Maps our field names to oEmbed response fields, or to OpenGraph
+  properties. A list of names means the first one present is used.
+  `image` is required; `author`, `author_url` and `title` are used by the
+  display header if present.
+- defaults: Values for fields the response doesn't have.
+- direct: Whether a URL that ends in an image extension is taken as the
+  image itself, with no request at all. Defaults to true.
+- display_header: A template for the import display header. It is
+  formatted with the fields, plus url, the submitted URL.
+- request_headers: HTTP headers to send. They are formatted with useragent.
+- max_bytes: For OpenGraph, how much of a page to read at most. Pages are
+  streamed, and the download stops once every OpenGraph property named
+  in fields has been found, or <head> ends. Defaults to 256 KiB.
+
+Every lookup makes at most one request, and results are cached by URL.
+"""
+
+import html
+import logging
+import re
+from contextlib import closing
+from urllib.parse import urljoin, urlsplit
+
+from lapislib import extract, web
+from lapislib.cache import TTLCache
+
+DIRECT_IMAGE = re.compile(r'\.(jpe?g|png|gif|webp|bmp)$', re.IGNORECASE)
+CHUNK_SIZE = 8 * 1024
+
+PROVIDERS = [
+    {
+        'name': 'gyazo',
+        'hosts': r'^(.*?\.)?gyazo\.com$',
+        'oembed': 'https://api.gyazo.com/api/oembed/',
+        'types': ['photo'],
+        'fields': {'image': 'url'},
+        'defaults': {'author': 'a gyazo.com user'},
+        'display_header': 'Imported gyazo.com image:\n\n',
+    },
+    {
+        'name': 'flickr',
+        'hosts': r'^(.*?\.)?(flickr\.com|staticflickr\.com|flic\.kr)$',
+        'oembed': 'https://www.flickr.com/services/oembed/',
+        'oembed_params': {'format': 'json'},
+        'types': ['photo'],
+        'fields': {'image': 'url', 'author': 'author_name'},
+        'defaults': {'author': 'a flickr.com user'},
+        'display_header': 'Imported flickr.com image:\n\n',
+    },
+    {
+        'name': 'derpibooru',
+        'hosts': r'^(www\.)?(derpiboo\.ru|derpibooru\.org|trixiebooru\.org|derpicdn\.net)$',
+        'oembed': 'https://derpibooru.org/oembed.json',
+        # CDN links are looked up too, so that we can credit the artist.
+        'direct': False,
+        'fields': {'image': 'thumbnail_url', 'author': 'author_name',
+                   'provider_url': 'provider_url'},
+        'defaults': {'author': 'an unknown artist'},
+        'display_header': 'Mirrored [image]({provider_url}) by Derpibooru artist '
+                          '[{author}](https://derpibooru.org/tags/artist-colon-{author}):\n\n',
+    },
+    {
+        'name': 'drawcrowd',
+        'hosts': r'^(.*?\.)?drawcrowd\.com$',
+        'fields': {'image': 'og:image', 'author': 'og:title'},
+        'defaults': {'author': 'an unknown drawcrowd author'},
+        'display_header': 'Mirrored image from {author}:\n\n',
+    },
+    {
+        'name': 'artstation',
+        'hosts': r'^(.*?\.)?artstation\.com$',
+        'fields': {'image': 'og:image', 'author': 'og:title'},
+        'defaults': {'author': 'an unknown Artstation author'},
+        'display_header': 'Mirrored image from {author}:\n\n',
+    },
+]
+
+
+class EmbedEngine:
+    """Resolves URLs to images using a registry of providers."""
+
+    def __init__(self, providers: list, useragent: str,
+                 cache_size: int=1024, cache_ttl: float=24 * 60 * 60):
+        """Set up the engine.
+
+        :param providers: The provider entries, tried in order.
+        :param useragent: The useragent to fill request header templates with.
+        :param cache_size: How many lookups to remember.
+        :param cache_ttl: How long to remember a lookup, in seconds.
+        """
+        self.log = logging.getLogger('lapis.embed')
+        self.useragent = useragent
+        self.providers = [(re.compile(p['hosts'], re.IGNORECASE), p) for p in providers]
+        self.cache = TTLCache(cache_size, cache_ttl)
+
+    def match(self, url: str) -> dict:
+        """:return: The first provider that handles a URL, or None."""
+        host = urlsplit(url).netloc
+        for regex, provider in self.providers:
+            if regex.match(host):
+                return provider
+        return None
+
+    def lookup(self, url: str) -> dict:
+        """Find the image, and whatever else we can, for a URL.
+
+        :param url: The submitted URL.
+        :return: None if no provider handles it or it isn't an image.
+        Otherwise, a dictionary of the provider's fields, plus url,
+        provider (the provider's name) and display_header.
+        """
+        # Reddit hands us HTML-escaped URLs.
+        url = html.unescape(url)
+        provider = self.match(url)
+        if provider is None:
+            return None
+        key = (provider['name'], url)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.resolve(provider, url)
+            if result is None:
+                return None
+            self.cache.set(key, result)
+        return result
+
+    def resolve(self, provider: dict, url: str) -> dict:
+        """Do the one request a provider needs to resolve a URL.
+
+        :param provider: The provider entry.
+        :param url: The submitted URL.
+        :return: The result, as described in `lookup`, or None.
+        """
+        fields = dict(provider.get('defaults', {}))
+        if provider.get('direct', True) and DIRECT_IMAGE.search(urlsplit(url).path):
+            self.log.debug('%s is a direct %s image', url, provider['name'])
+            fields['image'] = url
+        elif provider.get('oembed'):
+            response = self.fetch_oembed(provider, url)
+            if response is None:
+                return None
+            fields.update(self.map_fields(provider, response))
+        else:
+            properties = self.fetch_opengraph(provider, url)
+            if properties is None:
+                return None
+            fields.update(self.map_fields(provider, properties))
+        if not fields.get('image'):
+            self.log.info('No %s image found for %s', provider['name'], url)
+            return None
+        # oEmbed responses sometimes have protocol-relative URLs.
+        fields['image'] = urljoin('https:', fields['image'])
+        fields['url'] = url
+        fields['provider'] = provider['name']
+        fields['display_header'] = provider.get('display_header', '').format_map(
+            _Blank(fields))
+        return fields
+
+    def request_headers(self, provider: dict) -> dict:
+        headers = provider.get('request_headers', {'User-Agent': '{useragent}'})
+        return {k: v.format(useragent=self.useragent) for k, v in headers.items()}
+
+    def fetch_oembed(self, provider: dict, url: str) -> dict:
+        """Query a provider's oEmbed endpoint.
+
+        :return: The oEmbed response, or None if it isn't an image.
+        """
+        params = dict(provider.get('oembed_params', {}), url=url)
+        self.log.debug('Querying %s oEmbed for %s', provider['name'], url)
+        r = web.session.get(provider['oembed'], params=params,
+                            headers=self.request_headers(provider))
+        if not r.ok:
+            self.log.info('%s oEmbed returned %d for %s', provider['name'], r.status_code, url)
+            return None
+        response = r.json()
+        if response.get('type') not in provider.get('types', ('photo', 'link')):
+            self.log.debug('%s oEmbed type %s is not an image', provider['name'],
+                           response.get('type'))
+            return None
+        return response
+
+    def fetch_opengraph(self, provider: dict, url: str) -> dict:
+        """Scrape the OpenGraph properties of a page.
+
+        :return: The properties, or None if the page couldn't be loaded.
+        """
+        self.log.debug('Scraping %s OpenGraph tags from %s', provider['name'], url)
+        r = web.session.get(url, headers=self.request_headers(provider), stream=True)
+        with closing(r):
+            if not r.ok:
+                self.log.info('%s returned %d for %s', provider['name'], r.status_code, url)
+                return None
+            content_type = r.headers.get('Content-Type', '')
+            if content_type.startswith('image/'):
+                return {'og:image': url}
+            wanted = set()
+            for sources in provider['fields'].values():
+                wanted.update([sources] if isinstance(sources, str) else sources)
+            return extract.stream_meta_properties(
+                r.iter_content(CHUNK_SIZE), 'og:', wanted,
+                provider.get('max_bytes', 256 * 1024), web.declared_encoding(r))
+
+    @staticmethod
+    def map_fields(provider: dict, response: dict) -> dict:
+        fields = {}
+        for field, sources in provider['fields'].items():
+            if isinstance(sources, str):
+                sources = [sources]
+            for source in sources:
+                if response.get(source):
+                    fields[field] = response[source]
+                    break
+        return fields
+
+
+class _Blank(dict):
+    """Fills in fields a template wants but a response didn't give us."""
+
+    def __missing__(self, key):
+        return ''
+
+
+def parse_opengraph(markup) -> dict:
+    """Read the OpenGraph properties of a page.
+
+    :param markup: The HTML of the page, as text or bytes.
+    :return: A dictionary of properties, like og:image.
+    """
+    return extract.meta_properties(markup, 'og:')
+
+# END OF LINE.
@@ -0,0 +1,234 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Fast extraction of a few values from an HTML page.
+
+Plugins rarely need more than a handful of nodes from a page, so building
+a whole BeautifulSoup tree for them is wasted work. There are two ways in:
+- `img_sources` and `meta_properties` stream the markup through lxml's
+  parser without building a tree at all, collecting just the tags they
+  want. `meta_properties` stops parsing as soon as `<head>` ends.
+  `stream_meta_properties` does the same over chunks as they arrive from
+  the network, so the rest of the page never has to be downloaded.
+- `document` and `xpath` build an lxml tree, which is still far faster
+  than bs4, for anything that needs real selectors. `has_class` helps
+  write them.
+
+Markup can be given as bytes, in which case lxml works out the encoding
+from the page itself, or as text. Bytes that don't declare an encoding
+near the top are read as UTF-8, not lxml's default of Latin-1.
+"""
+
+import re
+
+from lxml import etree, html as lxml_html
+
+# Where a page says what it's encoded in, if it says at all.
+CHARSET_DECLARATION = re.compile(rb'<meta[^>]+charset|<\?xml[^>]+encoding', re.IGNORECASE)
+UTF16_BOMS = (b'\xff\xfe', b'\xfe\xff')
+
+
+class _Done(Exception):
+    """Raised by a parser target to stop parsing early."""
+
+
+class _Collector:
+    """A parser target that hands each start tag to a callback.
+
+    Nothing else is kept, so no tree is built.
+    """
+
+    def __init__(self, on_start, stop_after: str=None):
+        self.on_start = on_start
+        self.stop_after = stop_after
+
+    def start(self, tag, attrib):
+        self.on_start(tag, attrib)
+
+    def end(self, tag):
+        if tag == self.stop_after:
+            raise _Done()
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def default_encoding(data: bytes) -> str:
+    """The encoding to parse some bytes with, unless the page declares its own.
+
+    :param data: The page, or at least its first few KiB.
+    :return: None if the page declares an encoding, for lxml to find, or UTF-8.
+    """
+    if data.startswith(UTF16_BOMS) or CHARSET_DECLARATION.search(data[:4096]):
+        return None
+    return 'utf-8'
+
+
+def _parser(markup, parser_class=etree.HTMLParser, **kwargs) -> etree.HTMLParser:
+    if isinstance(markup, str):
+        kwargs['encoding'] = 'utf-8'
+    else:
+        kwargs['encoding'] = default_encoding(markup)
+    return parser_class(**kwargs)
+
+
+def _as_bytes(markup) -> bytes:
+    return markup.encode('utf-8') if isinstance(markup, str) else markup
+
+
+def _close(parser: etree.HTMLParser) -> None:
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        # "No element found": the page was empty, or only whitespace.
+        pass
+
+
+def _stream(markup, target: _Collector) -> None:
+    parser = _parser(markup, target=target)
+    try:
+        parser.feed(_as_bytes(markup))
+        _close(parser)
+    except _Done:
+        pass
+
+
+def img_sources(markup) -> list:
+    """Find the source of every image in some HTML.
+
+    :param markup: The HTML, as text or bytes.
+    :return: The src attribute of each img tag that has one, in order.
+    """
+    sources = []
+
+    def on_start(tag, attrib):
+        if tag == 'img' and attrib.get('src'):
+            sources.append(attrib['src'])
+
+    if markup:
+        _stream(markup, _Collector(on_start))
+    return sources
+
+
+def _meta_collector(properties: dict, prefix: str, wanted: set) -> _Collector:
+    def on_start(tag, attrib):
+        if tag == 'meta':
+            name = attrib.get('property', '')
+            if name.startswith(prefix) and 'content' in attrib:
+                properties.setdefault(name, attrib['content'])
+                if wanted and wanted.issubset(properties):
+                    raise _Done()
+
+    return _Collector(on_start, stop_after='head')
+
+
+def meta_properties(markup, prefix: str='og:') -> dict:
+    """Read the <meta property=... content=...> tags of a page, like OpenGraph tags.
+
+    Parsing stops at the end of <head>.
+
+    :param markup: The HTML, as text or bytes.
+    :param prefix: Only properties starting with this are collected.
+    :return: A dictionary of property names to their content.
+    The first tag wins if a property appears twice.
+    """
+    properties = {}
+    if markup:
+        _stream(markup, _meta_collector(properties, prefix, set()))
+    return properties
+
+
+def stream_meta_properties(chunks, prefix: str='og:', wanted=(),
+                           max_bytes: int=256 * 1024, encoding: str=None) -> dict:
+    """Read the <meta property=...> tags of a page as it is downloaded.
+
+    Parsing stops at the end of <head>, once every wanted property has been
+    seen, or after max_bytes, whichever comes first. The caller should close
+    the connection afterwards rather than read the rest.
+
+    :param chunks: An iterable of byte strings, such as Response.iter_content().
+    :param prefix: Only properties starting with this are collected.
+    :param wanted: Stop as soon as all of these properties are found.
+    :param max_bytes: Give up after reading this much of the page.
+    :param encoding: The encoding the server declared, if any. Otherwise the
+    first chunk decides, as in `default_encoding`.
+    :return: A dictionary of property names to their content.
+    """
+    properties = {}
+    target = _meta_collector(properties, prefix, set(wanted))
+    parser = None
+    read = 0
+    try:
+        for chunk in chunks:
+            if parser is None:
+                parser = etree.HTMLParser(
+                    target=target, encoding=encoding or default_encoding(chunk))
+            parser.feed(chunk)
+            read += len(chunk)
+            if read >= max_bytes:
+                break
+        # An empty body never gets a parser at all.
+        if parser is not None:
+            _close(parser)
+    except _Done:
+        pass
+    return properties
+
+
+def document(markup) -> lxml_html.HtmlElement:
+    """Parse a whole page into an lxml tree.
+
+    :param markup: The HTML, as text or bytes.
+    :return: The root element, or None if there was no markup.
+    """
+    if not markup or not markup.strip():
+        return None
+    return lxml_html.document_fromstring(
+        _as_bytes(markup), parser=_parser(markup, lxml_html.HTMLParser))
+
+
+def xpath(markup, expression: str) -> list:
+    """Evaluate an XPath expression over a page.
+
+    :param markup: The HTML, as text or bytes.
+    :param expression: The XPath expression.
+    :return: The result: elements, attribute values, or strings.
+    """
+    root = document(markup)
+    return [] if root is None else root.xpath(expression)
+
+
+def has_class(name: str) -> str:
+    """An XPath predicate that matches elements with a CSS class.
+
+    For example, `'//img[{}]'.format(has_class('fullview'))` is the same as
+    the CSS selector `img.fullview`.
+
+    :param name: The class name.
+    :return: The predicate, without brackets.
+    """
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+# END OF LINE.
@@ -0,0 +1,282 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Finding out about an image from its first few kilobytes.
+
+Exporters have size limits, and asking one to fetch an image that is
+over them wastes an upload, and often a long wait, for nothing. A
+`Preflight` reads only the start of each image, with an HTTP Range
+request, and gets the file size from the Content-Range (or
+Content-Length) header and the format, dimensions and frame count from
+the image header. Images over the limits are flagged as oversize, so
+that exporters can skip them, or something can shrink them first.
+
+`parse_header` understands PNG (and APNG), GIF, JPEG and WebP. For GIF
+and animated WebP, frames are counted as far as the bytes read go, so
+the count is a lower bound unless `frames_complete` is true, and
+`maybe_animated` is what to go by when choosing a limit.
+"""
+
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from lapislib import web
+from lapislib.cache import TTLCache
+
+HEADER_BYTES = 16 * 1024
+MIB = 1024 * 1024
+
+
+def _png(data: bytes) -> dict:
+    width, height = struct.unpack('>II', data[16:24])
+    info = {'format': 'png', 'width': width, 'height': height,
+            'frames': 1, 'frames_complete': True}
+    offset = 8
+    # An animation control chunk, if any, comes before the image data.
+    while offset + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        if kind == b'acTL' and offset + 12 <= len(data):
+            info['frames'] = struct.unpack('>I', data[offset + 8:offset + 12])[0]
+            break
+        if kind == b'IDAT':
+            break
+        offset += 12 + length
+    return info
+
+
+def _skip_sub_blocks(data: bytes, offset: int) -> int:
+    while offset < len(data):
+        size = data[offset]
+        offset += 1 + size
+        if size == 0:
+            return offset
+    return len(data) + 1
+
+
+def _gif(data: bytes) -> dict:
+    width, height, flags = struct.unpack('<HHB', data[6:11])
+    offset = 13
+    if flags & 0x80:
+        offset += 3 << ((flags & 0x07) + 1)
+    frames = 0
+    complete = False
+    while offset < len(data):
+        block = data[offset]
+        if block == 0x3B:
+            complete = True
+            break
+        elif block == 0x21:
+            offset = _skip_sub_blocks(data, offset + 2)
+        elif block == 0x2C:
+            if offset + 10 > len(data):
+                break
+            frames += 1
+            flags = data[offset + 9]
+            offset += 10
+            if flags & 0x80:
+                offset += 3 << ((flags & 0x07) + 1)
+            # Skip the LZW minimum code size, then the image data.
+            offset = _skip_sub_blocks(data, offset + 1)
+        else:
+            break
+    return {'format': 'gif', 'width': width, 'height': height,
+            'frames': max(frames, 1), 'frames_complete': complete}
+
+
+def _jpeg(data: bytes) -> dict:
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            offset += 1
+            continue
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if offset + 9 > len(data):
+                break
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return {'format': 'jpeg', 'width': width, 'height': height,
+                    'frames': 1, 'frames_complete': True}
+        offset += 2 + length
+    return {'format': 'jpeg', 'width': None, 'height': None,
+            'frames': 1, 'frames_complete': True}
+
+
+def _webp(data: bytes) -> dict:
+    info = {'format': 'webp', 'width': None, 'height': None,
+            'frames': 1, 'frames_complete': True}
+    kind = data[12:16]
+    if kind == b'VP8 ' and len(data) >= 30:
+        width, height = struct.unpack('<HH', data[26:30])
+        info.update(width=width & 0x3FFF, height=height & 0x3FFF)
+    elif kind == b'VP8L' and len(data) >= 25:
+        bits = struct.unpack('<I', data[21:25])[0]
+        info.update(width=(bits & 0x3FFF) + 1, height=((bits >> 14) & 0x3FFF) + 1)
+    elif kind == b'VP8X' and len(data) >= 30:
+        info.update(width=int.from_bytes(data[24:27], 'little') + 1,
+                    height=int.from_bytes(data[27:30], 'little') + 1)
+        if data[20] & 0x02:
+            frames = 0
+            offset = 12
+            while offset + 8 <= len(data):
+                chunk, length = struct.unpack('<4sI', data[offset:offset + 8])
+                frames += chunk == b'ANMF'
+                offset += 8 + length + (length & 1)
+            info.update(frames=max(frames, 1), frames_complete=offset == len(data))
+    return info
+
+
+def maybe_animated(info: dict) -> bool:
+    """Whether an image is, or might be, animated.
+
+    A big GIF's second frame usually starts well past the bytes read, so
+    until the count is complete, a GIF or animated WebP might have more.
+
+    :param info: What `parse_header` returned.
+    """
+    return info.get('frames', 1) > 1 or not info.get('frames_complete', True)
+
+
+def parse_header(data: bytes) -> dict:
+    """Read an image's format, dimensions and frame count from its first bytes.
+
+    :param data: The start of the file. A few kilobytes are usually plenty.
+    :return: A dictionary with format (png, gif, jpeg or webp), width and
+    height (None if they weren't in the bytes given), frames and
+    frames_complete, or None if the format isn't one of those.
+    """
+    try:
+        if data.startswith(b'\x89PNG\r\n\x1a\n') and len(data) >= 24:
+            return _png(data)
+        if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 13:
+            return _gif(data)
+        if data.startswith(b'\xff\xd8'):
+            return _jpeg(data)
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            return _webp(data)
+    except (struct.error, IndexError):
+        pass
+    return None
+
+
+class Preflight:
+    """Checks images against size limits before anything is uploaded."""
+
+    def __init__(self, useragent: str, max_image_mb: float=20, max_animated_mb: float=200,
+                 max_pixels: int=None, header_bytes: int=HEADER_BYTES,
+                 workers: int=4, cache_size: int=4096, cache_ttl: float=60 * 60, **_):
+        """Set up the preflight checks. Matches the preflight configuration section.
+
+        The default limits are Imgur's.
+
+        :param useragent: The useragent to send.
+        :param max_image_mb: The largest still image allowed, in MiB.
+        :param max_animated_mb: The largest animated image allowed, in MiB.
+        :param max_pixels: The most pixels (width times height) allowed. None means any.
+        :param header_bytes: How much of each image to read.
+        :param workers: How many images to check at once.
+        :param cache_size: How many images to remember.
+        :param cache_ttl: How long to remember an image, in seconds.
+        """
+        self.log = logging.getLogger('lapis.images')
+        self.headers = {'User-Agent': useragent}
+        self.max_image = max_image_mb * MIB
+        self.max_animated = max_animated_mb * MIB
+        self.max_pixels = max_pixels
+        self.header_bytes = header_bytes
+        self.workers = workers
+        self.cache = TTLCache(cache_size, cache_ttl)
+
+    def probe(self, url: str) -> dict:
+        """Find out about the image at a URL, reading as little of it as possible.
+
+        :param url: The image URL.
+        :return: A dictionary with url, size (in bytes, or None if the server
+        didn't say), content_type, oversize and, if the header could be
+        parsed, the values from `parse_header`. None if it couldn't be loaded.
+        """
+        info = self.cache.get(url)
+        if info is not None:
+            return info
+        headers = dict(self.headers, Range='bytes=0-{}'.format(self.header_bytes - 1))
+        try:
+            r = web.session.get(url, headers=headers, stream=True, timeout=30)
+            with closing(r):
+                if r.status_code not in (200, 206):
+                    self.log.info('Preflight of %s returned %d', url, r.status_code)
+                    return None
+                data = b''
+                for chunk in r.iter_content(self.header_bytes):
+                    data += chunk
+                    if len(data) >= self.header_bytes:
+                        break
+        except Exception as e:
+            self.log.info('Could not preflight %s: %s', url, e)
+            return None
+        size = None
+        content_range = r.headers.get('Content-Range', '')
+        if r.status_code == 206 and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1]
+            size = int(total) if total.isdigit() else None
+        elif r.status_code == 200 and r.headers.get('Content-Length', '').isdigit():
+            size = int(r.headers['Content-Length'])
+        info = {'url': url, 'size': size, 'content_type': r.headers.get('Content-Type')}
+        info.update(parse_header(data[:self.header_bytes]) or {})
+        info['oversize'] = self.is_oversize(info)
+        self.cache.set(url, info)
+        return info
+
+    def is_oversize(self, info: dict) -> bool:
+        """:return: Whether what we know about an image puts it over a limit."""
+        limit = self.max_animated if maybe_animated(info) else self.max_image
+        if info.get('size') is not None and info['size'] > limit:
+            return True
+        if self.max_pixels and info.get('width') and info.get('height'):
+            return info['width'] * info['height'] > self.max_pixels
+        return False
+
+    def probe_all(self, urls: list) -> dict:
+        """Probe several images at once.
+
+        :param urls: The image URLs.
+        :return: A dictionary of URL to what `probe` returned, leaving out failures.
+        """
+        if len(urls) <= 1:
+            results = [self.probe(url) for url in urls]
+        else:
+            executor = ThreadPoolExecutor(max_workers=min(self.workers, len(urls)))
+            try:
+                results = list(executor.map(self.probe, urls))
+            finally:
+                executor.shutdown(wait=False)
+        return {url: info for url, info in zip(urls, results) if info is not None}
+
+# END OF LINE.
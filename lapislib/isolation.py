@@ -0,0 +1,301 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Running a plugin in a process of its own.
+
+An `IsolatedPlugin` stands in for a plugin: it has the same plugin
+functions, but each call is sent to a child process that holds the real
+plugin, and the result is sent back. If the plugin leaks memory, crashes
+the interpreter or hangs, only that child is lost. It is then started
+again, and everything else carries on. A child is also replaced:
+- when its RSS goes over `max_rss_mb` after a call,
+- after `max_tasks` calls, so slow leaks never get far,
+- when a call takes longer than `timeout`,
+- when it doesn't answer a health ping, sent every `ping_interval`
+  seconds while it is idle.
+A new child has `verify_options` and `login` called again with the
+arguments they were last called with.
+
+Everything sent over has to be picklable. Reddit submissions aren't, so
+they are sent as a `SubmissionStub` with their id, url, permalink and
+title, which is all plugins look at. Each child handles one call at a
+time, and HTTP traffic from children isn't recorded by cassettes.
+"""
+
+import functools
+import importlib
+import logging
+import os
+import signal
+import threading
+import time
+import traceback
+
+from lapislib.parsing import process_context
+from lapislib.profiling import rss
+
+# The plugin functions Lapis calls, and which are sent to the child.
+PLUGIN_FUNCTIONS = ('import_submission', 'export_submission', 'delete_export',
+                    'prepare_submissions', 'canonicalize_url', 'verify_options', 'login')
+# Calls to repeat whenever a new child is started.
+SETUP_FUNCTIONS = ('verify_options', 'login')
+_PING = '__ping__'
+
+
+class IsolationError(Exception):
+    """An isolated plugin failed, or its process did."""
+
+
+class SubmissionStub:
+    """What a plugin in another process gets instead of a Reddit submission."""
+
+    def __init__(self, id: str, url: str, permalink: str, title: str=''):
+        self.id = id
+        self.url = url
+        self.permalink = permalink
+        self.title = title
+
+    @classmethod
+    def from_submission(cls, submission) -> 'SubmissionStub':
+        return cls(submission.id, submission.url, submission.permalink,
+                   getattr(submission, 'title', ''))
+
+    def __repr__(self):
+        return '<SubmissionStub {} {}>'.format(self.id, self.url)
+
+
+def _stub(value):
+    """Replace Reddit submissions in an argument, including in lists, with stubs."""
+    if isinstance(value, list):
+        return [_stub(item) for item in value]
+    if hasattr(value, 'permalink') and hasattr(value, 'url') and hasattr(value, 'id'):
+        return SubmissionStub.from_submission(value)
+    return value
+
+
+def _serve(conn, module_name: str, class_name: str, options: dict, log_level: int) -> None:
+    """The child process: build the plugin, then answer calls until told to stop."""
+    logging.basicConfig(level=log_level,
+                        format='%(levelname)-5s - [{}] %(message)s'.format(class_name))
+    try:
+        plugin = getattr(importlib.import_module(module_name), class_name)(**options)
+    except Exception:
+        conn.send(('error', traceback.format_exc(), rss()))
+        return
+    conn.send(('ready', None, rss()))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        function, args, kwargs = request
+        if function == _PING:
+            conn.send(('ok', None, rss()))
+            continue
+        try:
+            response = ('ok', getattr(plugin, function)(*args, **kwargs), rss())
+        except Exception:
+            response = ('error', traceback.format_exc(), rss())
+        try:
+            conn.send(response)
+        except Exception:
+            conn.send(('error', 'Could not send the result back:\n' + traceback.format_exc(),
+                       rss()))
+
+
+class IsolatedPlugin:
+    """A plugin that runs in a child process, restarted whenever it misbehaves."""
+
+    def __init__(self, plugin_class: type, options: dict,
+                 max_rss_mb: float=512, max_tasks: int=1000,
+                 ping_interval: float=30, timeout: float=300, start_timeout: float=60):
+        """Start the child process.
+
+        :param plugin_class: The plugin's class. It must be importable by name.
+        :param options: The options to construct the plugin with.
+        :param max_rss_mb: Restart the child once it uses more memory than this.
+        :param max_tasks: Restart the child after this many calls. 0 means never.
+        :param ping_interval: Seconds between health pings. 0 means don't ping.
+        :param timeout: The longest a call, or an answer to a ping, can take.
+        :param start_timeout: The longest the plugin can take to start.
+        :raises IsolationError: If the plugin couldn't be started.
+        """
+        self.log = logging.getLogger('lapis.isolation')
+        self.plugin_class = plugin_class
+        self.name = plugin_class.__name__
+        self.options = options
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.max_tasks = max_tasks
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.functions = {name for name in PLUGIN_FUNCTIONS if hasattr(plugin_class, name)}
+        self.setup_calls = {}
+        self.context = process_context()
+        self.lock = threading.Lock()
+        self.process = None
+        self.conn = None
+        self.tasks = 0
+        self.restarts = 0
+        self.closed = False
+        with self.lock:
+            self.start()
+        if ping_interval:
+            threading.Thread(target=self.run_pings, args=(ping_interval,),
+                             name='lapis-ping-' + self.name, daemon=True).start()
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get('functions', ()):
+            return functools.partial(self.call, name)
+        raise AttributeError(name)
+
+    def start(self) -> None:
+        """Start a child process. Must be called with the lock held."""
+        conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_serve, name='lapis-' + self.name, daemon=True,
+            args=(child_conn, self.plugin_class.__module__, self.plugin_class.__qualname__,
+                  self.options, logging.getLogger('lapis').getEffectiveLevel()))
+        self.process.start()
+        child_conn.close()
+        self.conn = conn
+        self.tasks = 0
+        status, value, _ = self.receive(self.start_timeout)
+        if status != 'ready':
+            self.stop()
+            raise IsolationError('{} could not start:\n{}'.format(self.name, value))
+        self.log.info('Started %s in process %d', self.name, self.process.pid)
+        for function, (args, kwargs) in self.setup_calls.items():
+            self.send(function, args, kwargs)
+            status, value, _ = self.receive(self.timeout)
+            if status != 'ok':
+                self.log.error('%s.%s() failed after a restart:\n%s', self.name, function, value)
+
+    def stop(self) -> None:
+        """Stop the child process, killing it if need be. Must be called with the lock held."""
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        process.join(1)
+        if process.is_alive():
+            process.terminate()
+            process.join(1)
+        if process.is_alive():
+            # A child stuck in C code, or ignoring SIGTERM.
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        self.conn.close()
+
+    def restart(self, reason: str) -> None:
+        """Replace the child process. Must be called with the lock held."""
+        self.log.warning('Restarting %s: %s', self.name, reason)
+        self.restarts += 1
+        self.stop()
+        self.start()
+
+    def send(self, function: str, args: tuple, kwargs: dict) -> None:
+        try:
+            self.conn.send((function, args, kwargs))
+        except (OSError, ValueError) as e:
+            raise IsolationError('{} is gone: {}'.format(self.name, e))
+
+    def receive(self, timeout: float) -> tuple:
+        """:return: The child's answer: a status, a value and its RSS."""
+        try:
+            if self.conn.poll(timeout):
+                return self.conn.recv()
+        except (EOFError, OSError):
+            self.process.join(1)
+            return 'died', 'The process died with exit code {}'.format(
+                self.process.exitcode), None
+        return 'timeout', 'No answer in {} seconds'.format(timeout), None
+
+    def call(self, function: str, *args, **kwargs):
+        """Call a plugin function in the child process.
+
+        :raises IsolationError: If the plugin raised, or its process failed.
+        """
+        args, kwargs = _stub(list(args)), {k: _stub(v) for k, v in kwargs.items()}
+        with self.lock:
+            if self.closed:
+                raise IsolationError('{} has been closed'.format(self.name))
+            if self.process is None or not self.process.is_alive():
+                self.restart('its process is gone')
+            if function in SETUP_FUNCTIONS:
+                self.setup_calls[function] = (args, kwargs)
+            self.send(function, args, kwargs)
+            status, value, child_rss = self.receive(self.timeout)
+            self.tasks += 1
+            if status in ('died', 'timeout'):
+                self.restart(value)
+            elif child_rss and child_rss > self.max_rss:
+                self.restart('it is using {:.0f} MiB'.format(child_rss / 1024 / 1024))
+            elif self.max_tasks and self.tasks >= self.max_tasks:
+                self.restart('it has handled {} calls'.format(self.tasks))
+        if status != 'ok':
+            raise IsolationError('{}.{}() failed: {}'.format(self.name, function, value))
+        return value
+
+    def ping(self) -> bool:
+        """Check that an idle child still answers, and restart it if not.
+
+        :return: False if the child is busy, so it wasn't pinged.
+        """
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            if self.closed:
+                return False
+            if self.process is None or not self.process.is_alive():
+                self.restart('its process is gone')
+                return True
+            self.send(_PING, (), {})
+            status, value, child_rss = self.receive(self.timeout)
+            if status != 'ok':
+                self.restart(value)
+            elif child_rss and child_rss > self.max_rss:
+                self.restart('it is using {:.0f} MiB'.format(child_rss / 1024 / 1024))
+            return True
+        finally:
+            self.lock.release()
+
+    def run_pings(self, interval: float) -> None:
+        while not self.closed:
+            time.sleep(interval)
+            try:
+                self.ping()
+            except Exception:
+                self.log.exception('Could not check on %s', self.name)
+
+    def close(self) -> None:
+        """Stop the child process for good."""
+        with self.lock:
+            self.closed = True
+            self.stop()
+
+# END OF LINE.
@@ -0,0 +1,200 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""A persistent queue of background jobs.
+
+A `JobQueue` keeps its jobs in SQLite, so nothing queued is lost when the
+process dies, and runs them on a few worker threads. A job is any JSON
+value, handed to the queue's handler. If the handler raises or returns a
+false value, the job is retried later with exponential backoff. Once it
+has used up its attempts it isn't deleted but marked dead, with the last
+error, so that it can be looked at or retried by hand:
+
+    sqlite3 cache/jobs.sqlite3 "SELECT * FROM delete_export WHERE state = 'dead'"
+    sqlite3 cache/jobs.sqlite3 "UPDATE delete_export SET state = 'pending', attempts = 0"
+
+Jobs that were running when the process died are run again on start.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+PENDING = 'pending'
+RUNNING = 'running'
+DEAD = 'dead'
+
+
+class JobQueue:
+    """Runs persistent jobs on background threads, with retries."""
+
+    def __init__(self, path: str, name: str, handler, workers: int=2,
+                 max_attempts: int=8, backoff: float=60, max_backoff: float=6 * 60 * 60,
+                 poll_interval: float=30):
+        """Open the queue. Nothing is run until `start` is called.
+
+        :param path: The SQLite file.
+        :param name: The queue's name. Used for its table and worker threads.
+        :param handler: Called with each job. Returns a true value on success.
+        :param workers: How many jobs to run at once.
+        :param max_attempts: How many times to try a job before it's dead.
+        :param backoff: How long to wait after the first failure, in seconds.
+        It doubles with each attempt.
+        :param max_backoff: The longest to wait between attempts.
+        :param poll_interval: How often idle workers look for jobs that are due.
+        """
+        self.log = logging.getLogger('lapis.jobs')
+        self.name = name
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS "{}" ('
+                            'id INTEGER PRIMARY KEY, '
+                            'payload TEXT NOT NULL, '
+                            'state TEXT NOT NULL, '
+                            'attempts INTEGER NOT NULL DEFAULT 0, '
+                            'not_before REAL NOT NULL, '
+                            'created REAL NOT NULL, '
+                            'last_error TEXT)'.format(name))
+            # Whatever was running when we last stopped never finished.
+            self.db.execute('UPDATE "{}" SET state = ? WHERE state = ?'.format(name),
+                            (PENDING, RUNNING))
+        self.threads = [threading.Thread(target=self.run, name='{}-{}'.format(name, i),
+                                         daemon=True)
+                        for i in range(workers)]
+
+    def start(self) -> None:
+        """Start the workers, if they haven't been already.
+
+        Jobs can be queued before this, but none are run, so a handler can
+        wait for whatever it needs, like logging in, to be set up first.
+        """
+        for thread in self.threads:
+            if not thread.is_alive() and thread.ident is None:
+                thread.start()
+
+    def put(self, payload) -> None:
+        self.put_many([payload])
+
+    def put_many(self, payloads: list) -> None:
+        """Queue several jobs in one transaction."""
+        now = time.time()
+        rows = [(json.dumps(payload), PENDING, now, now) for payload in payloads]
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO "{}" (payload, state, not_before, created) '
+                                'VALUES (?, ?, ?, ?)'.format(self.name), rows)
+        self.wake.set()
+
+    def counts(self) -> dict:
+        """:return: How many jobs are in each state."""
+        with self.lock:
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM "{}" GROUP BY state'.format(
+                self.name)).fetchall())
+
+    def dead(self) -> list:
+        """:return: The dead jobs, as (payload, attempts, last error) tuples."""
+        with self.lock:
+            rows = self.db.execute('SELECT payload, attempts, last_error FROM "{}" '
+                                   'WHERE state = ?'.format(self.name), (DEAD,)).fetchall()
+        return [(json.loads(payload), attempts, error) for payload, attempts, error in rows]
+
+    def is_alive(self) -> bool:
+        return any(thread.is_alive() for thread in self.threads)
+
+    def claim(self) -> tuple:
+        """Take the next job that's due, if there is one.
+
+        :return: (id, payload, attempts) or None.
+        """
+        with self.lock, self.db:
+            row = self.db.execute('SELECT id, payload, attempts FROM "{}" '
+                                  'WHERE state = ? AND not_before <= ? '
+                                  'ORDER BY not_before, id LIMIT 1'.format(self.name),
+                                  (PENDING, time.time())).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE "{}" SET state = ? WHERE id = ?'.format(self.name),
+                            (RUNNING, row[0]))
+        return row[0], json.loads(row[1]), row[2]
+
+    def run(self) -> None:
+        while True:
+            try:
+                job = self.claim()
+            except Exception:
+                self.log.error('Could not read the %s queue:\n%s', self.name,
+                               traceback.format_exc())
+                job = None
+            if job is None:
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+                continue
+            job_id, payload, attempts = job
+            try:
+                ok = self.handler(payload)
+                error = None if ok else 'Handler returned {!r}'.format(ok)
+            except Exception:
+                error = traceback.format_exc()
+            try:
+                self.finish(job_id, attempts + 1, error)
+            except Exception:
+                self.log.error('Could not update the %s queue:\n%s', self.name,
+                               traceback.format_exc())
+
+    def finish(self, job_id: int, attempts: int, error: str=None) -> None:
+        """Record the outcome of a job.
+
+        :param job_id: The job.
+        :param attempts: How many times it's been tried, including this one.
+        :param error: Why it failed, or None if it succeeded.
+        """
+        with self.lock, self.db:
+            if error is None:
+                self.db.execute('DELETE FROM "{}" WHERE id = ?'.format(self.name), (job_id,))
+                return
+            if attempts >= self.max_attempts:
+                self.log.error('Giving up on %s job %d after %d attempts: %s',
+                               self.name, job_id, attempts, error)
+                self.db.execute('UPDATE "{}" SET state = ?, attempts = ?, last_error = ? '
+                                'WHERE id = ?'.format(self.name),
+                                (DEAD, attempts, error, job_id))
+                return
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            self.log.warning('%s job %d failed, retrying in %.1f seconds: %s',
+                             self.name, job_id, delay, error)
+            self.db.execute('UPDATE "{}" SET state = ?, attempts = ?, last_error = ?, '
+                            'not_before = ? WHERE id = ?'.format(self.name),
+                            (PENDING, attempts, error, time.time() + delay, job_id))
+
+# END OF LINE.
@@ -0,0 +1,178 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""A background worker for slow, outbound work.
+
+An `Outbox` hands items to a handler one at a time on its own thread, in
+priority order (lowest first), so that whoever queues them never waits on
+the handler. A handler that can't deal with an item yet raises `Retry`,
+and the item is tried again once its wait is over, either as long as the
+handler asked or with exponential backoff. Other items are handled in the
+meantime, unless the Retry asks to pause the whole outbox, as for a rate
+limit that applies to everything queued. Items that fail for good are
+passed to `on_failure`.
+"""
+
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+
+class Retry(Exception):
+    """Raised by an outbox handler to have its item tried again later."""
+
+    def __init__(self, delay: float=None, pause: bool=False):
+        """Ask for a retry.
+
+        :param delay: How many seconds to wait. None means back off exponentially.
+        :param pause: Whether the rest of the outbox waits too.
+        """
+        super().__init__(delay)
+        self.delay = delay
+        self.pause = pause
+
+
+class Outbox:
+    """Handles queued items in priority order on a worker thread."""
+
+    def __init__(self, handler, on_failure=None, name: str='outbox',
+                 max_attempts: int=5, backoff: float=10, max_backoff: float=600):
+        """Start the worker.
+
+        :param handler: Called with each item. May raise `Retry`.
+        :param on_failure: Called with an item and the exception, once the
+        handler has raised something other than `Retry`, or has run out of
+        attempts.
+        :param name: The name of the worker thread.
+        :param max_attempts: How many times to try an item.
+        :param backoff: The first wait, in seconds, when a Retry has no delay.
+        It doubles with each attempt.
+        :param max_backoff: The longest to wait between attempts.
+        """
+        self.log = logging.getLogger('lapis.outbox')
+        self.handler = handler
+        self.on_failure = on_failure
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue = queue.PriorityQueue()
+        # Ties are broken by the order items were put in.
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.keys = set()
+        # (when, order, entry) for items waiting to be retried
+        self.delayed = []
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, item, priority: float=0, key=None) -> None:
+        """Queue an item.
+
+        :param item: The item to pass to the handler.
+        :param priority: Lower priorities are handled first.
+        :param key: If given, `key in outbox` is true until the item is done with.
+        """
+        if key is not None:
+            with self.lock:
+                self.keys.add(key)
+        self.queue.put((priority, next(self.counter), 0, key, item))
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            return key in self.keys
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.queue.qsize() + len(self.delayed)
+
+    def is_alive(self) -> bool:
+        return self.thread.is_alive()
+
+    def join(self, timeout: float=None) -> bool:
+        """Wait until everything queued has been handled or given up on.
+
+        :param timeout: The longest to wait, in seconds. None means forever.
+        :return: False if the timeout ran out first.
+        """
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(
+                lambda: not self.queue.unfinished_tasks and not self.delayed, timeout)
+
+    def release_delayed(self) -> float:
+        """Queue the delayed items whose wait is over.
+
+        :return: Seconds until the next one is due, or None if there are none.
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.delayed and self.delayed[0][0] <= now:
+                self.queue.put(heapq.heappop(self.delayed)[2])
+            return self.delayed[0][0] - now if self.delayed else None
+
+    def run(self) -> None:
+        while True:
+            try:
+                entry = self.queue.get(timeout=self.release_delayed())
+            except queue.Empty:
+                continue
+            priority, order, attempt, key, item = entry
+            try:
+                self.handler(item)
+            except Retry as e:
+                attempt += 1
+                if attempt < self.max_attempts:
+                    delay = e.delay
+                    if delay is None:
+                        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                    self.log.warning('Retrying in %.1f seconds (attempt %d of %d)',
+                                     delay, attempt + 1, self.max_attempts)
+                    entry = (priority, order, attempt, key, item)
+                    if e.pause:
+                        time.sleep(delay)
+                        self.queue.put(entry)
+                    else:
+                        # Queued before task_done, so join() keeps waiting for it.
+                        with self.lock:
+                            heapq.heappush(self.delayed,
+                                           (time.monotonic() + delay, order, entry))
+                    continue
+                self.fail(item, e)
+            except Exception as e:
+                self.fail(item, e)
+            finally:
+                self.queue.task_done()
+            if key is not None:
+                with self.lock:
+                    self.keys.discard(key)
+
+    def fail(self, item, exception: Exception) -> None:
+        self.log.error('Giving up on %r: %r', item, exception)
+        if self.on_failure is not None:
+            try:
+                self.on_failure(item, exception)
+            except Exception:
+                self.log.exception('Error while handling a failed item')
+
+# END OF LINE.
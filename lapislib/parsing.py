@@ -0,0 +1,140 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""An optional process pool for parsing pages.
+
+Parsing HTML is CPU work, and in threads it all waits on the GIL, however
+many imports run at once. Plugins hand their parsing to `parse` instead of
+calling their parse functions directly. Once `start` has been called, big
+pages are parsed in worker processes, so parsing scales with cores; until
+then, or for small pages where sending the page over costs more than
+parsing it, `parse` just calls the function.
+
+A parse function must be picklable, which means a module-level function
+or a static method, and should take the page (bytes or text) and return
+something small, like a dictionary of the few values it found.
+Workers are started, and have imported the plugin modules and lxml,
+before `start` returns, so the first parse doesn't pay for that.
+"""
+
+import importlib
+import logging
+import multiprocessing
+import os
+
+log = logging.getLogger('lapis.parsing')
+
+# How long to wait for a worker's result before giving up on the pool.
+PARSE_TIMEOUT = 120
+
+_pool = None
+_min_bytes = 0
+
+
+def _warm(modules: tuple) -> None:
+    """Runs once in each worker, before any parsing."""
+    from lapislib import extract
+    extract.document(b'<html><body><p>Warming up</p></body></html>')
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            log.warning('Could not import %s in a parser process', name)
+
+
+def _ping(_) -> int:
+    return os.getpid()
+
+
+def _discard(pool) -> None:
+    global _pool
+    if _pool is pool:
+        _pool = None
+    pool.terminate()
+
+
+def process_context():
+    """The multiprocessing context to start worker processes with.
+
+    Forking a process with threads running (ours has several) can copy
+    held locks into the child, so workers come from a clean process:
+    the forkserver where there is one, or a fresh interpreter.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def start(workers: int=None, min_bytes: int=16 * 1024, modules=()) -> None:
+    """Start the worker processes, and wait until they are ready.
+
+    :param workers: How many processes. Defaults to the number of CPUs.
+    :param min_bytes: Pages smaller than this are parsed in-process.
+    :param modules: Modules to import in each worker up front, usually
+    the plugins whose parse functions will be sent there.
+    """
+    global _pool, _min_bytes
+    if _pool is not None:
+        return
+    workers = workers or os.cpu_count() or 1
+    pool = process_context().Pool(workers, initializer=_warm, initargs=(tuple(modules),))
+    # A task only runs once its worker's initializer has.
+    pool.map(_ping, range(workers), chunksize=1)
+    _pool, _min_bytes = pool, min_bytes
+    log.info('Started %d parser processes', workers)
+
+
+def stop() -> None:
+    """Stop the worker processes. Parsing then happens in-process again."""
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def running() -> bool:
+    return _pool is not None
+
+
+def parse(func, markup, *args):
+    """Call a parse function, in a worker process if it's worth it.
+
+    :param func: The parse function. Called as `func(markup, *args)`.
+    :param markup: The page, as bytes or text.
+    :param args: Anything else the function takes. Must be picklable.
+    :return: Whatever the function returns.
+    """
+    pool = _pool
+    if pool is None or not markup or len(markup) < _min_bytes:
+        return func(markup, *args)
+    try:
+        return pool.apply_async(func, (markup,) + args).get(PARSE_TIMEOUT)
+    except multiprocessing.TimeoutError:
+        # The pool replaces a worker that dies, maybe killed for its memory,
+        # but what it was parsing never comes back. Don't lose the page over it.
+        log.error('No result from the parser pool in %d seconds; parsing in-process from now on',
+                  PARSE_TIMEOUT)
+        _discard(pool)
+        return func(markup, *args)
+
+# END OF LINE.
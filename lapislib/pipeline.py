@@ -0,0 +1,234 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Stages of work joined by bounded queues.
+
+A `Pipeline` is a chain of stages. Each stage has its own pool of worker
+threads and a queue in front of it that holds at most `queue_size` items.
+A stage's handler takes an item and returns what to hand the next stage,
+or None if the item needs nothing more. A stage that falls behind fills
+its queue, and the stage before it then waits to hand anything over:
+that backpressure reaches all the way back to `put`, so work piles up in
+front of the slow stage instead of in memory everywhere.
+
+Every stage counts how long its handler takes and how long items waited
+in its queue, so `report` shows which stage is the bottleneck.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+
+class Stage:
+    """One step of a pipeline, and what it has done since the last report."""
+
+    def __init__(self, name: str, handler, workers: int=1, queue_size: int=16):
+        """Set up the stage. Its workers are started by the pipeline.
+
+        :param name: The name of the stage, used for its threads and in reports.
+        :param handler: Called with each item. Returns the item for the next stage, or None.
+        :param workers: How many items to handle at once.
+        :param queue_size: How many items can wait for this stage.
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(queue_size)
+        self.busy = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.handled = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_wait = 0.0
+
+    def metrics(self) -> dict:
+        handled = self.handled or 1
+        return {
+            'depth': self.queue.qsize(),
+            'queue_size': self.queue.maxsize,
+            'workers': self.workers,
+            'busy': self.busy,
+            'handled': self.handled,
+            'errors': self.errors,
+            'latency': self.total_time / handled,
+            'max_latency': self.max_time,
+            'wait': self.total_wait / handled,
+        }
+
+
+class Pipeline:
+    """Passes items through a chain of stages, each on its own threads."""
+
+    def __init__(self, on_done=None, name: str='pipeline'):
+        """Set up an empty pipeline. Add stages to it, then `start` it.
+
+        :param on_done: Called with an item's key, the last result and the
+        exception (or None) once the item leaves the pipeline, for whatever reason.
+        :param name: The prefix of the worker threads' names.
+        """
+        self.log = logging.getLogger('lapis.pipeline')
+        self.on_done = on_done
+        self.name = name
+        self.stages = []
+        self.threads = []
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.keys = set()
+        self.pending = 0
+
+    def add_stage(self, name: str, handler, workers: int=1, queue_size: int=16) -> Stage:
+        """Add a stage to the end of the pipeline. See `Stage` for the arguments."""
+        if self.threads:
+            raise RuntimeError('Stages must be added before the pipeline is started')
+        if workers < 1 or queue_size < 1:
+            raise ValueError('The {} stage needs at least one worker and a queue '
+                             'of at least one item'.format(name))
+        stage = Stage(name, handler, workers, queue_size)
+        self.stages.append(stage)
+        return stage
+
+    def start(self) -> None:
+        for index, stage in enumerate(self.stages):
+            for number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.run, args=(index,), daemon=True,
+                    name='{}-{}-{}'.format(self.name, stage.name, number))
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, item, key=None, timeout: float=None) -> None:
+        """Hand an item to the first stage, waiting while its queue is full.
+
+        :param item: The item.
+        :param key: If given, `key in pipeline` is true until the item leaves
+        the pipeline, and it is what `on_done` is called with.
+        :param timeout: The longest to wait, in seconds. None means forever.
+        :raises queue.Full: If the timeout ran out.
+        """
+        with self.lock:
+            self.pending += 1
+            if key is not None:
+                self.keys.add(key)
+        try:
+            self.stages[0].queue.put((key, item, time.monotonic()), timeout=timeout)
+        except queue.Full:
+            with self.lock:
+                self.pending -= 1
+                self.keys.discard(key)
+            raise
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            return key in self.keys
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.keys)
+
+    def is_alive(self) -> bool:
+        return bool(self.threads) and all(thread.is_alive() for thread in self.threads)
+
+    def join(self, timeout: float=None) -> bool:
+        """Wait until every item put in has left the pipeline.
+
+        :param timeout: The longest to wait, in seconds. None means forever.
+        :return: False if the timeout ran out first.
+        """
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.pending, timeout)
+
+    def run(self, index: int) -> None:
+        stage = self.stages[index]
+        following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            key, item, queued = stage.queue.get()
+            started = time.monotonic()
+            with self.lock:
+                stage.busy += 1
+            result = error = None
+            try:
+                result = stage.handler(item)
+            except Exception as e:
+                self.log.exception('Error in the %s stage', stage.name)
+                error = e
+            finished = time.monotonic()
+            with self.lock:
+                stage.busy -= 1
+                stage.handled += 1
+                stage.errors += error is not None
+                stage.total_time += finished - started
+                stage.max_time = max(stage.max_time, finished - started)
+                stage.total_wait += started - queued
+            stage.queue.task_done()
+            if result is not None and following is not None:
+                # Blocks while the next stage is backed up.
+                following.queue.put((key, result, finished))
+            else:
+                self.finish(key, result, error)
+
+    def finish(self, key, result, error: Exception) -> None:
+        with self.lock:
+            self.keys.discard(key)
+        if self.on_done is not None:
+            try:
+                self.on_done(key, result, error)
+            except Exception:
+                self.log.exception('Error while finishing %r', key)
+        with self.lock:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
+
+    def metrics(self, reset: bool=False) -> dict:
+        """What each stage has done since the last reset.
+
+        :param reset: Whether to start counting again afterwards.
+        :return: A dictionary of stage names to dictionaries with depth
+        (items queued), queue_size, workers, busy (workers handling an item),
+        handled, errors, latency and max_latency (seconds in the handler)
+        and wait (average seconds queued).
+        """
+        with self.lock:
+            metrics = {stage.name: stage.metrics() for stage in self.stages}
+            if reset:
+                for stage in self.stages:
+                    stage.reset()
+        return metrics
+
+    def report(self, reset: bool=True) -> str:
+        """:return: One line per stage summarizing `metrics`."""
+        lines = []
+        for name, m in self.metrics(reset).items():
+            lines.append('{}: {}/{} queued, {}/{} busy, {} handled ({} errors), '
+                         '{:.2f}s avg ({:.2f}s max), {:.2f}s avg wait'.format(
+                             name, m['depth'], m['queue_size'], m['busy'], m['workers'],
+                             m['handled'], m['errors'], m['latency'], m['max_latency'],
+                             m['wait']))
+        return '\n'.join(lines)
+
+# END OF LINE.
@@ -0,0 +1,314 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""On-demand profiling for a running Lapis process.
+
+There are three tools here, all off until asked for:
+- cProfile around the next N calls to some function (process_submission),
+  written out as a .pstats file once the Nth call finishes.
+- A sampling profiler that looks at every thread's stack every few
+  milliseconds for a while, and writes the collapsed stacks in the format
+  flamegraph.pl and speedscope understand.
+- tracemalloc snapshots taken every few scan cycles, with the biggest
+  differences from the previous snapshot appended to a log.
+
+Memory use is always watched: every few cycles, the RSS is appended to
+lapis-memory.log, a warning is logged each time it has grown by another
+`memory_warn_mb` since the first reading, and once it passes
+`restart_rss_mb`, `restart_requested` is set so that the process can
+restart itself between cycles rather than be killed in the middle of one.
+
+Each one can be started from the configuration or with a signal,
+since a process on a dyno can't have a debugger attached to it.
+All output goes into a single directory, normally the one lapis.log is in.
+"""
+
+import cProfile
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+class Profiler:
+    """The profiling surface of one Lapis process."""
+
+    def __init__(self, output_dir: str,
+                 submissions: int=0,
+                 signal_submissions: int=10,
+                 sample_seconds: float=30,
+                 sample_interval: float=0.005,
+                 sample_at_start: bool=False,
+                 tracemalloc: bool=False,
+                 tracemalloc_frames: int=10,
+                 tracemalloc_top: int=25,
+                 memory_cycles: int=10,
+                 memory_warn_mb: float=None,
+                 restart_rss_mb: float=None,
+                 **_):
+        """Set up the profiler. Matches the "profiling" configuration section.
+
+        :param output_dir: The directory to write all profiles into.
+        :param submissions: Profile this many calls right from the start.
+        :param signal_submissions: How many calls to profile after a SIGUSR1.
+        :param sample_seconds: How long to sample for after a SIGUSR2.
+        :param sample_interval: Seconds between stack samples.
+        :param sample_at_start: Whether to start sampling right away.
+        :param tracemalloc: Whether to diff memory allocations.
+        :param tracemalloc_frames: How many frames of traceback to keep per allocation.
+        :param tracemalloc_top: How many of the biggest differences to log.
+        :param memory_cycles: Record the RSS, and diff allocations, every this many cycles.
+        :param memory_warn_mb: Warn each time the RSS grows by this much more.
+        :param restart_rss_mb: Ask for a restart once the RSS is over this.
+        """
+        self.log = logging.getLogger('lapis.profiling')
+        self.output_dir = output_dir
+        self.signal_submissions = signal_submissions
+        self.sample_seconds = sample_seconds
+        self.sample_interval = sample_interval
+        self.tracemalloc_top = tracemalloc_top
+        self.memory_cycles = max(1, memory_cycles)
+        self.memory_warn = memory_warn_mb and memory_warn_mb * 1024 * 1024
+        self.restart_rss = restart_rss_mb and restart_rss_mb * 1024 * 1024
+        self.first_rss = None
+        self.next_warning = self.memory_warn
+        self.restart_requested = False
+        self.lock = threading.Lock()
+        self.profile = None
+        self.remaining = 0
+        # Only the signal handler writes signals, without the lock, which
+        # it can't take. Everything else is read and written under the lock.
+        self.signals = 0
+        self.signals_seen = 0
+        self.sampler = None
+        self.last_snapshot = None
+        self.cycle = 0
+        if submissions:
+            self.profile_next(submissions)
+        if sample_at_start:
+            self.start_sampling()
+        if tracemalloc:
+            self.start_tracemalloc(tracemalloc_frames)
+
+    def output_path(self, kind: str, extension: str) -> str:
+        return os.path.join(self.output_dir, 'lapis-{}-{}.{}'.format(
+            kind, time.strftime('%Y%m%d-%H%M%S'), extension))
+
+    def install_signals(self) -> None:
+        """Start cProfile on SIGUSR1 and the sampler on SIGUSR2, where supported."""
+        if hasattr(signal, 'SIGUSR1'):
+            # Handlers run on the main thread, which may be holding the lock
+            # in call(), so this just leaves a note for call() to pick up.
+            signal.signal(signal.SIGUSR1, lambda *_: self.note_signal())
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, lambda *_: self.start_sampling())
+
+    def profile_next(self, count: int) -> None:
+        """Run the next `count` calls made through `call` under cProfile.
+
+        :param count: The number of calls to profile.
+        """
+        with self.lock:
+            self.add_profiled(count)
+        self.log.info('Profiling the next %d submissions', count)
+
+    def add_profiled(self, count: int) -> None:
+        """Profile `count` more calls. The lock must be held."""
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+        self.remaining += count
+
+    def note_signal(self) -> None:
+        self.signals += 1
+
+    def call(self, func, *args, **kwargs):
+        """Call a function, profiling it if we've been asked to."""
+        signalled = 0
+        with self.lock:
+            signals = self.signals
+            if signals != self.signals_seen:
+                # Several threads call this at once; only one gets to count them.
+                signalled = (signals - self.signals_seen) * self.signal_submissions
+                self.signals_seen = signals
+                self.add_profiled(signalled)
+            profile = self.profile if self.remaining > 0 else None
+            if profile is not None:
+                # cProfile can only follow one thread at a time.
+                self.remaining -= 1
+                self.profile = None
+        if signalled:
+            self.log.info('Profiling the next %d submissions', signalled)
+        if profile is None:
+            return func(*args, **kwargs)
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self.lock:
+                self.profile = profile
+                finished = self.remaining <= 0
+                if finished:
+                    self.profile = None
+            if finished:
+                path = self.output_path('profile', 'pstats')
+                profile.dump_stats(path)
+                self.log.info('Wrote cProfile stats to %s', path)
+
+    def start_sampling(self, seconds: float=None) -> bool:
+        """Start sampling every thread's stack in the background.
+
+        :param seconds: How long to sample for. Defaults to `sample_seconds`.
+        :return: False if the sampler was already running.
+        """
+        if self.sampler is not None and self.sampler.is_alive():
+            return False
+        self.sampler = threading.Thread(
+            target=self.sample, args=(seconds or self.sample_seconds,),
+            name='lapis-sampler', daemon=True)
+        self.sampler.start()
+        return True
+
+    def sample(self, seconds: float) -> None:
+        """Sample stacks for a while, then write them out as collapsed stacks.
+
+        :param seconds: How long to sample for.
+        """
+        self.log.info('Sampling stacks for %s seconds', seconds)
+        stacks = Counter()
+        me = threading.get_ident()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+        path = self.output_path('stacks', 'txt')
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        self.log.info('Wrote %d samples to %s', sum(stacks.values()), path)
+
+    def start_tracemalloc(self, frames: int=10) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.last_snapshot = tracemalloc.take_snapshot()
+        self.log.info('Tracing memory allocations')
+
+    def end_cycle(self) -> None:
+        """Note the end of a scan cycle. Every memory_cycles cycles, records memory use."""
+        self.cycle += 1
+        if self.cycle % self.memory_cycles:
+            return
+        self.check_memory()
+        if self.last_snapshot is None or not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot()
+        lines = diff_snapshots(self.last_snapshot, snapshot, self.tracemalloc_top)
+        self.last_snapshot = snapshot
+        path = os.path.join(self.output_dir, 'lapis-tracemalloc.log')
+        with open(path, 'a') as f:
+            f.write('--- Cycle {} at {} ---\n'.format(
+                self.cycle, time.strftime('%Y-%m-%d %H:%M:%S')))
+            f.writelines(line + '\n' for line in lines)
+
+    def check_memory(self) -> None:
+        """Record the RSS, warning about growth and asking for a restart if need be."""
+        current = rss()
+        if current is None:
+            return
+        if self.first_rss is None:
+            self.first_rss = current
+        growth = current - self.first_rss
+        path = os.path.join(self.output_dir, 'lapis-memory.log')
+        with open(path, 'a') as f:
+            f.write('{} cycle {} rss {:.1f} MiB growth {:+.1f} MiB\n'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S'), self.cycle,
+                current / 1024 / 1024, growth / 1024 / 1024))
+        if self.memory_warn and growth >= self.next_warning:
+            self.log.warning('Memory use has grown by %.1f MiB, to %.1f MiB',
+                             growth / 1024 / 1024, current / 1024 / 1024)
+            while self.next_warning <= growth:
+                self.next_warning += self.memory_warn
+        if self.restart_rss and current >= self.restart_rss and not self.restart_requested:
+            self.log.warning('Memory use is %.1f MiB, over the %.1f MiB limit; '
+                             'asking for a restart', current / 1024 / 1024,
+                             self.restart_rss / 1024 / 1024)
+            self.restart_requested = True
+
+
+def rss() -> int:
+    """The resident memory of this process, in bytes.
+
+    Read from /proc where there is one. Elsewhere, this is the peak RSS
+    instead, which is still enough to notice a process that has grown.
+
+    :return: The RSS, or None if it can't be found out.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in KiB, macOS in bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def diff_snapshots(old: tracemalloc.Snapshot, new: tracemalloc.Snapshot,
+                   top: int) -> list:
+    """Describe the biggest differences between two tracemalloc snapshots.
+
+    :param old: The earlier snapshot.
+    :param new: The later snapshot.
+    :param top: How many differences to describe.
+    :return: A list of lines, the total first.
+    """
+    snapshot_filters = (tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'))
+    old = old.filter_traces(snapshot_filters)
+    new = new.filter_traces(snapshot_filters)
+    stats = new.compare_to(old, 'traceback')
+    total = sum(stat.size_diff for stat in stats)
+    lines = ['Total change: {:+.1f} KiB'.format(total / 1024)]
+    for stat in stats[:top]:
+        lines.append('{:+.1f} KiB in {:+d} blocks, from:'.format(
+            stat.size_diff / 1024, stat.count_diff))
+        lines.extend('    ' + line for line in stat.traceback.format())
+    return lines
+
+# END OF LINE.
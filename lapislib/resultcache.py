@@ -0,0 +1,181 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Remembering what importers found, so reposts don't import again.
+
+The same image is often posted more than once: crossposts, reposts, and
+the same post in several subreddits. Lapis looks each submission's URL up
+here before calling any importer, and on a hit uses the import results
+as they were last time, without calling the importers at all.
+
+There are two backends, with the same methods:
+- get(key): The value, or None if it isn't there or has expired.
+- set(key, value): Remember a value. It must be JSON-serializable.
+- save(): Write what's remembered to disk, if it isn't there already.
+- close(): Save, and let go of any files.
+
+`MemoryCache` keeps entries in this process, and saves a snapshot file
+that is loaded again at startup, so a restart doesn't start cold.
+`SQLiteCache` keeps them in a database file that any number of processes
+can share. Both forget entries after `ttl` seconds, and the least
+recently used ones once there are more than `maxsize`.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from lapislib.cache import TTLCache
+
+
+class MemoryCache:
+    """Import results kept in this process, with a snapshot on disk."""
+
+    def __init__(self, maxsize: int=5000, ttl: float=24 * 60 * 60, path: str=None, **_):
+        """Create the cache, loading the snapshot if there is one.
+
+        :param maxsize: The most entries to keep.
+        :param ttl: How many seconds an entry is good for.
+        :param path: The snapshot file. None means no snapshots.
+        """
+        self.log = logging.getLogger('lapis.resultcache')
+        self.cache = TTLCache(maxsize, ttl)
+        self.path = path
+        if path is not None:
+            self.load()
+
+    def get(self, key: str):
+        value = self.cache.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key: str, value) -> None:
+        # Kept as JSON, so every hit gets its own copy and the snapshot can't fail.
+        self.cache.set(key, json.dumps(value))
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.log.warning('Could not load the import cache snapshot %s: %s', self.path, e)
+            return
+        age = time.time() - snapshot['saved']
+        loaded = 0
+        for key, value, left in snapshot['entries']:
+            if left is None or left > age:
+                self.cache.set(key, value, None if left is None else left - age)
+                loaded += 1
+        self.log.info('Loaded %d import results from %s', loaded, self.path)
+
+    def save(self) -> None:
+        """Write a snapshot, replacing the last one in a single step."""
+        if self.path is None:
+            return
+        snapshot = {'saved': time.time(), 'entries': self.cache.items()}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temporary, self.path)
+
+    def close(self) -> None:
+        self.save()
+
+
+class SQLiteCache:
+    """Import results kept in an SQLite file, shared by every process using it."""
+
+    def __init__(self, path: str, maxsize: int=50000, ttl: float=24 * 60 * 60, **_):
+        """Open (or create) the cache.
+
+        :param path: The database file.
+        :param maxsize: The most entries to keep.
+        :param ttl: How many seconds an entry is good for.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS import_results ('
+                            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                            'expires REAL NOT NULL, used REAL NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS import_results_used '
+                            'ON import_results (used)')
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute('SELECT value FROM import_results WHERE key = ? AND expires > ?',
+                                  (key, now)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE import_results SET used = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO import_results (key, value, expires, used) '
+                            'VALUES (?, ?, ?, ?)', (key, json.dumps(value), now + self.ttl, now))
+            self.writes += 1
+            # Pruning needs a count of the whole table, so it isn't done on every write.
+            if self.writes % 100 == 0:
+                self.prune(now)
+
+    def prune(self, now: float) -> None:
+        """Forget expired entries, then the least recently used. Must hold the lock."""
+        self.db.execute('DELETE FROM import_results WHERE expires <= ?', (now,))
+        self.db.execute('DELETE FROM import_results WHERE key IN ('
+                        'SELECT key FROM import_results ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                        (self.maxsize,))
+
+    def save(self) -> None:
+        pass
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+def create(backend: str='memory', **options):
+    """Create a cache from the import_cache option.
+
+    :param backend: memory or sqlite.
+    :param options: The cache's arguments.
+    :return: The cache.
+    """
+    backends = {'memory': MemoryCache, 'sqlite': SQLiteCache}
+    if backend not in backends:
+        raise ValueError('Unknown import cache backend {!r}'.format(backend))
+    return backends[backend](**options)
+
+# END OF LINE.
@@ -0,0 +1,103 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Small persistent stores.
+
+`Store` is a dictionary of JSON values kept in an SQLite file, so that
+what plugins learn about other sites survives restarts. Each user gets
+its own table, and any number of threads can share one Store.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+_missing = object()
+
+
+class Store:
+    """A persistent, thread-safe dictionary of JSON values."""
+
+    def __init__(self, path: str=None, table: str='store'):
+        """Open (or create) a store.
+
+        :param path: The SQLite file. None keeps the store in memory only.
+        :param table: The table to keep this store's values in.
+        """
+        if path is None:
+            path = ':memory:'
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.table = table
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            if path != ':memory:':
+                self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS "{}" ('
+                            'key TEXT PRIMARY KEY, value TEXT NOT NULL)'.format(table))
+
+    @classmethod
+    def in_dir(cls, directory: str, name: str) -> 'Store':
+        """Open the store called `name` in a cache directory.
+
+        :param directory: The cache directory. None keeps the store in memory.
+        :param name: The file name, without extension. Also used as the table.
+        """
+        if directory is None:
+            return cls(None, name)
+        return cls(os.path.join(directory, name + '.sqlite3'), name)
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM "{}" WHERE key = ?'.format(self.table),
+                                  (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        self.update({key: value})
+
+    def update(self, values: dict) -> None:
+        """Store several values in one transaction."""
+        rows = [(key, json.dumps(value)) for key, value in values.items()]
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO "{}" (key, value) VALUES (?, ?)'.format(
+                self.table), rows)
+
+    def delete(self, key: str) -> None:
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM "{}" WHERE key = ?'.format(self.table), (key,))
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM "{}"'.format(self.table)).fetchone()[0]
+
+# END OF LINE.
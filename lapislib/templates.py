@@ -0,0 +1,65 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Cached Mako templates.
+
+Compiling a Mako template means generating and compiling a Python module,
+which is slow enough to notice every time Lapis restarts after an error.
+Templates loaded through `get_template` are compiled once:
+- Their generated modules are written to a module directory, so a new
+  process only has to import them.
+- The lookups are kept at module level, so a restarted LapisLazuli in the
+  same process gets the very same Template objects back.
+Each call checks the template file's mtime, and recompiles it if it has
+been edited since, so a running Lapis picks up template changes by itself.
+"""
+
+import os
+import threading
+
+from mako.lookup import TemplateLookup
+from mako.template import Template
+
+# (template directory, module directory): TemplateLookup
+_lookups = {}
+_lock = threading.Lock()
+
+
+def get_template(path: str, module_directory: str=None) -> Template:
+    """Load a template file, compiling it only if it's new or has changed.
+
+    :param path: The template file.
+    :param module_directory: Where to keep the compiled modules. None keeps
+    them in memory only.
+    :return: The template.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    key = (directory, module_directory)
+    with _lock:
+        lookup = _lookups.get(key)
+        if lookup is None:
+            lookup = _lookups[key] = TemplateLookup(directories=[directory],
+                                                    module_directory=module_directory,
+                                                    filesystem_checks=True)
+        return lookup.get_template('/' + name)
+
+# END OF LINE.
@@ -0,0 +1,350 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Shrinking images that are too big to export.
+
+When the preflight finds an image over the export limits, a `Transformer`
+can download it and re-encode it until it fits:
+- Still images without real transparency become JPEGs, at the highest
+  quality (from `quality` down to `min_quality`) that fits.
+- Images with transparency stay PNGs, optimized.
+- Animated GIFs are re-saved optimized, and if that's not enough, have
+  every other frame dropped (keeping the timing the same).
+- Anything still too big is scaled down a step at a time. Images wider
+  or taller than `max_dimension`, or with more than `max_pixels` pixels,
+  are scaled down first regardless.
+- Animated WebP and PNG (APNG) images are left alone, rather than
+  flattened into a single frame.
+
+Re-encoding is CPU work, so it happens in a process pool, and each image
+has a time budget. The worker stops itself once the budget is spent, and
+if it doesn't, the pool is killed and started again. Results are kept as
+files in a directory, named by the hash of the original, so the same image
+is never shrunk twice.
+
+This needs Pillow, which is optional: `pip install Pillow`.
+"""
+
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from contextlib import closing
+
+from lapislib import web
+from lapislib.cache import TTLCache
+from lapislib.images import maybe_animated, parse_header
+from lapislib.parsing import process_context
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = ImageSequence = None
+
+# How much smaller to make an image each time it still doesn't fit.
+SCALE_STEP = 0.75
+ATTEMPTS = 6
+MIB = 1024 * 1024
+# How much longer than the budget to wait for a worker to stop itself.
+GRACE_SECONDS = 10
+
+
+class OutOfTime(Exception):
+    """Raised in a worker process once an image has used up its budget."""
+
+
+def _save(image, image_format: str, **options) -> bytes:
+    output = io.BytesIO()
+    image.save(output, image_format, **options)
+    return output.getvalue()
+
+
+def _scaled(size: tuple, scale: float) -> tuple:
+    return max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+
+
+def _has_transparency(image) -> bool:
+    if image.mode not in ('RGBA', 'LA', 'PA') and 'transparency' not in image.info:
+        return False
+    return image.convert('RGBA').split()[-1].getextrema()[0] < 255
+
+
+def _shrink_still(image, max_bytes: int, scale: float, quality: int, min_quality: int):
+    transparent = _has_transparency(image)
+    image = image.convert('RGBA' if transparent else 'RGB')
+    for _ in range(ATTEMPTS):
+        resized = image if scale >= 1 else image.resize(_scaled(image.size, scale), Image.LANCZOS)
+        if transparent:
+            data = _save(resized, 'PNG', optimize=True)
+            if len(data) <= max_bytes:
+                return data, 'png'
+        else:
+            for jpeg_quality in range(quality, min_quality - 1, -10):
+                data = _save(resized, 'JPEG', quality=jpeg_quality, optimize=True,
+                             progressive=True)
+                if len(data) <= max_bytes:
+                    return data, 'jpg'
+        scale *= SCALE_STEP
+    return None
+
+
+def _shrink_gif(image, max_bytes: int, scale: float):
+    frames = []
+    durations = []
+    for frame in ImageSequence.Iterator(image):
+        frames.append(frame.convert('RGBA'))
+        durations.append(frame.info.get('duration', 100))
+    loop = image.info.get('loop', 0)
+    step = 1
+    for attempt in range(ATTEMPTS):
+        kept = frames[::step]
+        kept_durations = [sum(durations[i:i + step]) for i in range(0, len(durations), step)]
+        if scale < 1:
+            kept = [frame.resize(_scaled(frame.size, scale), Image.LANCZOS) for frame in kept]
+        data = _save(kept[0], 'GIF', save_all=True, append_images=kept[1:],
+                     duration=kept_durations, loop=loop, optimize=True, disposal=2)
+        if len(data) <= max_bytes:
+            return data, 'gif'
+        if step == 1 and len(frames) > 2:
+            step = 2
+        else:
+            scale *= SCALE_STEP
+    return None
+
+
+def recompress(data: bytes, max_bytes: int, max_dimension: int=None, max_pixels: int=None,
+               quality: int=85, min_quality: int=50):
+    """Re-encode an image until it is no bigger than max_bytes.
+
+    Runs in a worker process, so it must stay a module-level function.
+
+    :param data: The original image.
+    :param max_bytes: The most the result can be.
+    :param max_dimension: Scale down anything wider or taller than this.
+    :param max_pixels: Scale down anything with more pixels (width times height) than this.
+    :param quality: The JPEG quality to try first.
+    :param min_quality: The lowest JPEG quality to try.
+    :return: A tuple of the new image and its extension (jpg, png or gif),
+    or None if it couldn't be made small enough.
+    """
+    image = Image.open(io.BytesIO(data))
+    if image.format != 'GIF' and getattr(image, 'is_animated', False):
+        raise ValueError('animated {} images are not supported'.format(image.format))
+    scale = 1.0
+    if max_dimension and max(image.size) > max_dimension:
+        scale = max_dimension / max(image.size)
+    pixels = image.size[0] * image.size[1]
+    if max_pixels and pixels > max_pixels:
+        scale = min(scale, (max_pixels / pixels) ** 0.5)
+    if image.format == 'GIF' and getattr(image, 'n_frames', 1) > 1:
+        return _shrink_gif(image, max_bytes, scale)
+    return _shrink_still(image, max_bytes, scale, quality, min_quality)
+
+
+def _out_of_time(*_):
+    raise OutOfTime()
+
+
+def recompress_within(seconds: float, data: bytes, max_bytes: int, **options):
+    """Run `recompress`, giving up with `OutOfTime` after a number of seconds.
+
+    Runs in a worker process, where it has the main thread, and so SIGALRM,
+    to itself. Without SIGALRM, the Transformer's own timeout is all there is.
+    """
+    if not hasattr(signal, 'setitimer'):
+        return recompress(data, max_bytes, **options)
+    previous = signal.signal(signal.SIGALRM, _out_of_time)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        return recompress(data, max_bytes, **options)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class Transformer:
+    """Shrinks oversize images in worker processes, remembering the results."""
+
+    def __init__(self, useragent: str, output_dir: str, max_image_bytes: int,
+                 max_animated_bytes: int, max_pixels: int=None, workers: int=2,
+                 budget_seconds: float=60, max_download_mb: float=None,
+                 max_dimension: int=None, quality: int=85, min_quality: int=50, keep_files: int=500, **_):
+        """Start the worker processes.
+
+        :param useragent: The useragent to download with.
+        :param output_dir: Where to keep shrunk images.
+        :param max_image_bytes: The size a still image must get under.
+        :param max_animated_bytes: The size an animated image must get under.
+        :param max_pixels: The most pixels (width times height) an image may have.
+        :param workers: How many images to re-encode at once.
+        :param budget_seconds: The longest to spend re-encoding one image.
+        :param max_download_mb: Don't even try images bigger than this, in MiB.
+        Defaults to twice max_animated_bytes, since an animated image is only
+        shrunk once it's over that.
+        :param max_dimension: Scale down anything wider or taller than this.
+        :param quality: The JPEG quality to try first.
+        :param min_quality: The lowest JPEG quality to try.
+        :param keep_files: How many shrunk images to keep. The oldest go first.
+        :raises ImportError: If Pillow isn't installed.
+        """
+        if Image is None:
+            raise ImportError('Shrinking images needs Pillow')
+        self.log = logging.getLogger('lapis.transform')
+        self.headers = {'User-Agent': useragent}
+        self.output_dir = output_dir
+        self.max_image_bytes = max_image_bytes
+        self.max_animated_bytes = max_animated_bytes
+        self.budget = budget_seconds
+        self.max_download = max_download_mb * MIB if max_download_mb else 2 * max_animated_bytes
+        self.options = {'max_dimension': max_dimension, 'max_pixels': max_pixels,
+                        'quality': quality, 'min_quality': min_quality}
+        self.keep_files = keep_files
+        self.workers = workers
+        # Only as many images are handed over as there are workers, so none
+        # spends its budget waiting in the pool's queue.
+        self.slots = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        # URL: the shrunk file, or False if it couldn't be shrunk
+        self.results = TTLCache(1024, 60 * 60)
+        os.makedirs(output_dir, exist_ok=True)
+        self.pool = None
+        self.start()
+
+    def start(self) -> None:
+        self.pool = process_context().Pool(self.workers)
+
+    def restart(self, pool) -> None:
+        """Kill the worker processes, whatever they're doing, and start new ones.
+
+        :param pool: The pool that went wrong. If another thread has
+        already replaced it, there's nothing left to do.
+        """
+        with self.lock:
+            if self.pool is not pool:
+                return
+            self.start()
+        # Kill the workers first: Pool.terminate() blocks for good if one
+        # died holding the task queue's lock, so it runs on its own thread.
+        for process in list(getattr(pool, '_pool', None) or ()):
+            process.terminate()
+        threading.Thread(target=pool.terminate, name='transform-terminate',
+                         daemon=True).start()
+
+    def download(self, url: str) -> bytes:
+        r = web.session.get(url, headers=self.headers, stream=True, timeout=30)
+        with closing(r):
+            r.raise_for_status()
+            data = bytearray()
+            for chunk in r.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > self.max_download:
+                    raise ValueError('over {:.0f} MiB'.format(self.max_download / MIB))
+        return bytes(data)
+
+    def shrink(self, url: str, info: dict) -> str:
+        """Download an oversize image and shrink it.
+
+        :param url: The image URL.
+        :param info: What the preflight found out about it.
+        :return: The path of the shrunk image, or None if it couldn't be shrunk in time.
+        """
+        path = self.results.get(url)
+        if path is False:
+            return None
+        if path is not None and os.path.isfile(path):
+            return path
+        if info.get('format') in ('png', 'webp') and maybe_animated(info):
+            self.log.info('Not shrinking %s: animated %s images are not supported',
+                          url, info['format'])
+            self.results.set(url, False)
+            return None
+        try:
+            data = self.download(url)
+        except Exception as e:
+            self.log.info('Could not download %s to shrink it: %s', url, e)
+            return None
+        # Now that we have all of it, we know for sure whether it's animated.
+        full_info = parse_header(data) or info
+        max_bytes = self.max_animated_bytes if maybe_animated(full_info) else self.max_image_bytes
+        name = '{}-{}'.format(hashlib.sha256(data).hexdigest()[:32], max_bytes)
+        for extension in ('jpg', 'png', 'gif'):
+            path = os.path.join(self.output_dir, '{}.{}'.format(name, extension))
+            if os.path.isfile(path):
+                self.results.set(url, path)
+                return path
+        with self.slots:
+            pool = self.pool
+            try:
+                result = pool.apply_async(recompress_within, (self.budget, data, max_bytes),
+                                          self.options).get(self.budget + GRACE_SECONDS)
+            except multiprocessing.TimeoutError:
+                # The worker either ran over its budget or died, probably of a
+                # huge image; the pool replaces a dead worker but not its task.
+                self.log.warning('No result from a worker shrinking %s in time; restarting them',
+                                 url)
+                self.results.set(url, False)
+                self.restart(pool)
+                return None
+            except OutOfTime:
+                self.log.warning('Gave up shrinking %s after %s seconds', url, self.budget)
+                self.results.set(url, False)
+                return None
+            except Exception as e:
+                self.log.warning('Could not shrink %s: %r', url, e)
+                self.results.set(url, False)
+                return None
+        if result is None:
+            self.log.info('Could not shrink %s under %.1f MiB', url, max_bytes / MIB)
+            self.results.set(url, False)
+            return None
+        shrunk, extension = result
+        path = os.path.join(self.output_dir, '{}.{}'.format(name, extension))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(shrunk)
+        os.replace(path + '.tmp', path)
+        self.log.info('Shrunk %s from %.1f MiB to %.1f MiB', url,
+                      len(data) / MIB, len(shrunk) / MIB)
+        self.results.set(url, path)
+        self.prune()
+        return path
+
+    def prune(self) -> None:
+        """Delete the oldest shrunk images, past keep_files."""
+        paths = [os.path.join(self.output_dir, name) for name in os.listdir(self.output_dir)]
+        if len(paths) <= self.keep_files:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.keep_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        """Stop the worker processes."""
+        self.pool.terminate()
+
+# END OF LINE.
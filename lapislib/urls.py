@@ -0,0 +1,135 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Turning the many spellings of a URL into one.
+
+The same image reaches us as http and https links, through mobile and
+SFW mirrors of a site, HTML-escaped by Reddit, with tracking parameters
+tacked on, with and without a trailing slash. `Canonicalizer` turns all
+of those into one canonical URL, which is what caches and duplicate
+checks should be keyed by. It is a key, not a link to fetch: the scheme
+is always https, for one thing, even for sites that don't support it.
+
+In order, a canonical URL:
+- is HTML-unescaped and stripped of whitespace,
+- uses https, a lowercase host with no default port, and no fragment,
+- has its host replaced if it is an alias in `HOST_ALIASES`,
+- has percent-escapes of unreserved characters decoded, and the rest in
+  upper case,
+- has tracking parameters (`TRACKING_PARAMS`, and `SITE_TRACKING_PARAMS`
+  for its host) removed, and the remaining parameters sorted,
+- has no trailing slash.
+Then each rule, a function taking and returning a canonical URL, gets a
+go, to handle site-specific forms like short links. A rule returns None
+to leave the URL alone.
+"""
+
+import html
+import logging
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+HOST_ALIASES = {
+    'mobile.twitter.com': 'twitter.com',
+    'm.twitter.com': 'twitter.com',
+    'www.twitter.com': 'twitter.com',
+    'x.com': 'twitter.com',
+    'furaffinity.net': 'www.furaffinity.net',
+    'sfw.furaffinity.net': 'www.furaffinity.net',
+    'www.sfw.furaffinity.net': 'www.furaffinity.net',
+    'm.imgur.com': 'imgur.com',
+    'www.imgur.com': 'imgur.com',
+    'deviantart.com': 'www.deviantart.com',
+    'www.fav.me': 'fav.me',
+    'm.tumblr.com': 'www.tumblr.com',
+}
+
+TRACKING_PARAMS = re.compile(
+    r'^(utm_\w+|fbclid|gclid|dclid|igshid|mc_cid|mc_eid|ref|ref_src|ref_url|si)$')
+
+SITE_TRACKING_PARAMS = {
+    'twitter.com': re.compile(r'^(s|t|cxt)$'),
+}
+
+DEFAULT_PORTS = (':80', ':443')
+
+_ESCAPE = re.compile(r'%([0-9a-fA-F]{2})')
+_UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+
+def _normalize_escape(match) -> str:
+    char = chr(int(match.group(1), 16))
+    return char if char in _UNRESERVED else '%' + match.group(1).upper()
+
+
+class Canonicalizer:
+    """Canonicalizes URLs, with site-specific rules on top of the general ones."""
+
+    def __init__(self, rules=(), host_aliases: dict=None):
+        """Set up a canonicalizer.
+
+        :param rules: Site-specific rules, tried in order.
+        :param host_aliases: Host aliases, in addition to `HOST_ALIASES`.
+        """
+        self.log = logging.getLogger('lapis.urls')
+        self.rules = list(rules)
+        self.host_aliases = dict(HOST_ALIASES, **(host_aliases or {}))
+
+    def add_rule(self, rule) -> None:
+        """:param rule: A function taking a canonical URL, and returning another or None."""
+        self.rules.append(rule)
+
+    def __call__(self, url: str) -> str:
+        """Canonicalize a URL.
+
+        :param url: The URL, possibly HTML-escaped.
+        :return: The canonical URL.
+        """
+        canonical = self.normalize(url)
+        for rule in self.rules:
+            try:
+                rewritten = rule(canonical)
+            except Exception:
+                self.log.exception('URL rule %r failed on %s', rule, canonical)
+                continue
+            if rewritten:
+                canonical = rewritten
+        return canonical
+
+    def normalize(self, url: str) -> str:
+        """Apply only the general steps, no site-specific rules."""
+        split_url = urlsplit(html.unescape(url).strip())
+        host = split_url.netloc.lower()
+        if '@' in host:
+            host = host.rpartition('@')[2]
+        if host.endswith(DEFAULT_PORTS):
+            host = host.rsplit(':', 1)[0]
+        host = self.host_aliases.get(host, host)
+        path = _ESCAPE.sub(_normalize_escape, split_url.path).rstrip('/')
+        site_params = SITE_TRACKING_PARAMS.get(host)
+        query = sorted((name, value) for name, value in parse_qsl(split_url.query, keep_blank_values=True)
+                       if not TRACKING_PARAMS.match(name) and
+                       not (site_params and site_params.match(name)))
+        return urlunsplit(('https', host, path, urlencode(query), ''))
+
+# END OF LINE.
@@ -0,0 +1,66 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""The shared HTTP layer.
+
+Plugins should make their requests through `session` instead of the
+module-level `requests` functions. That way connections are pooled
+between plugins, and every request passes through the same transport,
+which is where cassettes (see `lapislib.cassette`) hook in.
+"""
+
+import requests
+from requests.utils import get_encoding_from_headers
+
+# The one session every plugin shares.
+session = requests.Session()
+
+
+def declared_encoding(response: requests.Response) -> str:
+    """The charset in a response's Content-Type header, if it has one.
+
+    Unlike `Response.encoding`, this doesn't fall back to Latin-1 for text
+    that doesn't say, so the page itself gets a say.
+
+    :param response: The response.
+    :return: The charset, or None.
+    """
+    content_type = response.headers.get('Content-Type', '')
+    if 'charset' not in content_type.lower():
+        return None
+    return get_encoding_from_headers(response.headers)
+
+
+def markup(response: requests.Response):
+    """The body of a page, ready for `lapislib.extract`.
+
+    :param response: The response.
+    :return: The raw bytes, unless the server declared an encoding other
+    than UTF-8, in which case the text decoded with it.
+    """
+    encoding = declared_encoding(response)
+    if encoding and encoding.lower().replace('-', '') != 'utf8':
+        response.encoding = encoding
+        return response.text
+    return response.content
+
+# END OF LINE.
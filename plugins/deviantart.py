@@ -20,16 +20,44 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import json
+import html
 import re
 import logging
-from urllib.parse import urlencode, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import traceback
 
-import mimeparse
-import requests
 import praw
-from bs4 import BeautifulSoup
+
+from lapislib import extract, parsing, web
+from lapislib.cache import TTLCache
+from lapislib.embed import EmbedEngine, DIRECT_IMAGE
+from lapislib.extract import has_class
+
+# A deviation URL ends in its ID: /art/Some-Title-123456789
+DEVIATION_ID = re.compile(r'/art/(?:[^/]*-)?(?P<id>\d+)/?$')
+# A fav.me short link is the same ID in base 36: fav.me/d21i3v9
+SHORT_LINK_HOSTS = re.compile(r'^(www\.)?fav\.me$', re.IGNORECASE)
+SHORT_LINK = re.compile(r'^/d(?P<id>[0-9a-z]+)/?$', re.IGNORECASE)
+
+# How many deviation pages to load at once, across parallel imports.
+PAGE_WORKERS = 4
+
+# The deviantArt oEmbed backend, as an embed provider.
+# It isn't in the shared registry, since we do more than oEmbed here.
+PROVIDER = {
+    'name': 'deviantart',
+    'hosts': r'^(.*?\.)?((deviantart\.(com|net))|(fav\.me))$',
+    'oembed': 'https://backend.deviantart.com/oembed',
+    'oembed_params': {'format': 'json'},
+    'direct': False,
+    'defaults': {'author': 'an unknown DA author'},
+    'fields': {'image': ['fullsize_url', 'url'],
+               'author': 'author_name',
+               'author_url': 'author_url'},
+    'display_header': 'Mirrored [deviantArt image]({url}) by the '
+                      '[author "{author}"]({author_url}):\n\n',
+}
 
 
 class DeviantArtPlugin:
@@ -47,18 +75,25 @@ class DeviantArtPlugin:
         :param options: Other options in the configuration. Ignored.
         """
         self.log = logging.getLogger('lapis.da')
-        self.regex = re.compile(r'^(.*?\.)?((deviantart\.(com|net))|(fav\.me))$')
         self.regex_direct = re.compile(r'^((www\.)|(orig.*\.))?(deviantart\.net)$')
         self.useragent = useragent
         self.headers = {'User-Agent': self.useragent}
+        self.engine = EmbedEngine([PROVIDER], useragent)
+        # deviation ID: what we found out about the deviation
+        self.deviations = TTLCache(1024, 24 * 60 * 60)
+        # Loads deviation pages while the backend is asked about them.
+        self.executor = ThreadPoolExecutor(max_workers=PAGE_WORKERS)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
 
-    def read_url(self, url: str) -> str:
-        """Download text from a URL.
+    def read_url(self, url: str):
+        """Download a page.
 
         :param url: The URL to download from.
-        :return: The data downloaded, as a Unicode string.
+        :return: The page, as from `lapislib.web.markup`.
         """
-        return requests.get(url, headers=self.headers).text
+        return web.markup(web.session.get(url, headers=self.headers))
 
     def import_submission(self, submission: praw.objects.Submission) -> dict:
         """Import a submission from deviantArt. Ignores flash content.
@@ -76,75 +111,131 @@ class DeviantArtPlugin:
         :return: None if no import, an import info dictionary otherwise.
         """
         try:
-            if self.regex_direct.match(urlsplit(submission.url).netloc):
-                r = requests.head(submission.url, headers=self.headers)
-                mime_text = r.headers.get('Content-Type')
-                mime = mimeparse.parse_mime_type(mime_text)
-                if mime[0] == 'image':
-                    self.log.debug('DA link is a direct image')
-                    data = {'author': 'An unknown DA author',
-                            'source': submission.url,
-                            'import_urls': [submission.url],
-                            'importer_display':
-                                {'header': 'Mirrored deviantArt image '
-                                           'by an unknown author:\n\n'}}
-                    return data
-            if not self.regex.match(urlsplit(submission.url).netloc):
+            # Reddit hands us HTML-escaped URLs.
+            url = html.unescape(submission.url)
+            split_url = urlsplit(url)
+            if (self.regex_direct.match(split_url.netloc) and
+                    DIRECT_IMAGE.search(split_url.path)):
+                self.log.debug('DA link is a direct image')
+                data = {'author': 'An unknown DA author',
+                        'source': submission.url,
+                        'import_urls': [submission.url],
+                        'importer_display':
+                            {'header': 'Mirrored deviantArt image '
+                                       'by an unknown author:\n\n'}}
+                return data
+            if not self.engine.match(url):
+                return None
+            key = self.deviation_key(url)
+            deviation = self.deviations.get(key)
+            if deviation is None:
+                deviation = self.resolve(url, key)
+                if deviation is None:
+                    return None
+            # Mirroring a preview for a flash animation is stupid
+            if deviation['is_flash']:
+                self.log.info('DA url is flash, no preview needed.')
                 return None
-            query_url = 'http://backend.deviantart.com/oembed?{}'.format(
-                urlencode({'format': 'json', 'url': submission.url}))
-            self.log.debug('%s is valid DA url.', submission.url)
-            self.log.debug('Querying DA API %s', query_url)
+            self.log.debug('Author name: %s', deviation['author'])
+            return {'author': deviation['author'],
+                    'source': submission.url,
+                    'import_urls': [deviation['full_url'] or deviation['image']],
+                    'importer_display': {'header': PROVIDER['display_header'].format(
+                        url=url, author=deviation['author'],
+                        author_url=deviation['author_url'])}}
 
-            response = json.loads(self.read_url(query_url))
+        except Exception as e:
+            self.log.error('Deviantart Error: %s', traceback.format_exc())
+            return None
 
-            if response['type'] not in ('link', 'photo'):
-                self.log.debug('Response is not link or photo')
-                return None
-            self.log.debug('Author name: %s', response['author_name'])
+    def resolve(self, url: str, key: str) -> dict:
+        """Look up a deviation with the DA backend and its page at the same time.
 
-            # Using the official DA API
-            data = {'author': response['author_name'],
-                    'source': submission.url,
-                    'importer_display':
-                        {'header': 'Mirrored [deviantArt image]({post_url}) by the [author "{author_name}"]({author_url}):\n\n'.format(
-                            post_url=submission.url, 
-                            author_name=response['author_name'], 
-                            author_url=response['author_url'])}}
-            if response['type'] == 'link':
-                data['import_urls'] = [response['fullsize_url']]
-                self.log.debug('Found DA API url %s', data['import_urls'])
+        The result is cached under `key`, unless the page couldn't be scraped.
 
+        :param url: The deviation's URL.
+        :param key: The deviation's key, from `deviation_key`.
+        :return: A dictionary with author, author_url, image (from the backend),
+        is_flash and full_url (from the page), or None if the backend
+        doesn't know the deviation.
+        """
+        page = self.executor.submit(self.read_url, url)
+        try:
+            # Using the official DA API
+            response = self.engine.resolve(PROVIDER, url)
+            if response is None:
+                return None
+            deviation = {'author': response['author'],
+                         'author_url': response.get('author_url', ''),
+                         'image': response['image'],
+                         'is_flash': False,
+                         'full_url': None}
             try:
                 # Trying to scrape manually
-                bs = BeautifulSoup(self.read_url(submission.url), "html.parser")
-
-                # Checking for flash animation, because mirroring a preview
-                # for a flash animation is stupid
-                is_flash = bool(bs.select('iframe[class~=flashtime]'))
-                is_madefire = bool(bs.select('iframe[class~=madefire-player]'))
-                if is_flash or is_madefire:
-                    self.log.info('DA url is flash, no preview needed.')
-                    return None
-                # Seems to alternate between the two
-                full_view = (bs.select('img[class~=fullview]') or
-                             bs.select('img[class~=dev-content-full]'))
-                if full_view:
-                    full_url = full_view[0]['src']
-                    self.log.debug('Found full DA image url: %s', full_url)
-                    data['import_urls'] = [full_url]
+                deviation.update(parsing.parse(self.parse_deviation_page, page.result()))
             except Exception as e:
                 self.log.error(traceback.format_exc())
+                return deviation
+            if deviation['full_url']:
+                self.log.debug('Found full DA image url: %s', deviation['full_url'])
+            self.deviations.set(key, deviation)
+            return deviation
+        finally:
+            # Don't leave the page loading past this import. Any error it
+            # had has been logged already, or doesn't matter.
+            if not page.cancel():
+                page.exception()
+
+    def canonicalize_url(self, url: str, **_) -> str:
+        """Give fav.me short links and every form of deviation page the same canonical URL.
+
+        :param url: A canonical URL, as from `lapislib.urls`.
+        :return: The deviation's canonical URL, or None if it isn't one.
+        """
+        host = urlsplit(url).netloc
+        if not (SHORT_LINK_HOSTS.match(host) or host.endswith('deviantart.com')):
+            return None
+        key = self.deviation_key(url)
+        if key == url:
+            return None
+        return 'https://www.deviantart.com/deviation/{}'.format(key)
 
-            if 'import_urls' not in data:
-                self.log.debug('No url found for DA image.')
-                return None
-
-            return data
+    @staticmethod
+    def deviation_key(url: str) -> str:
+        """Work out a deviation's ID from its URL, so every link to it shares a cache entry.
 
-        except Exception as e:
-            self.log.error('Deviantart Error: %s', traceback.format_exc())
-            return None
+        :param url: A deviation page or fav.me short link.
+        :return: The deviation ID, or the URL itself if there isn't one.
+        """
+        split_url = urlsplit(url)
+        if SHORT_LINK_HOSTS.match(split_url.netloc):
+            match = SHORT_LINK.match(split_url.path)
+            if match:
+                return str(int(match.group('id'), 36))
+        else:
+            match = DEVIATION_ID.search(split_url.path)
+            if match:
+                return match.group('id')
+        return url
+
+    @staticmethod
+    def parse_deviation_page(markup) -> dict:
+        """Scrape what we need out of a deviation page.
+
+        :param markup: The HTML of the deviation page, as text or bytes.
+        :return: A dictionary with is_flash, whether the deviation is a Flash
+        or Madefire animation, and full_url, the full-size image URL or None.
+        """
+        page = extract.document(markup)
+        if page is None:
+            return {'is_flash': False, 'full_url': None}
+        is_flash = bool(page.xpath('//iframe[{} or {}]'.format(
+            has_class('flashtime'), has_class('madefire-player'))))
+        # Seems to alternate between the two
+        full_view = (page.xpath('//img[{}]/@src'.format(has_class('fullview'))) or
+                     page.xpath('//img[{}]/@src'.format(has_class('dev-content-full'))))
+        return {'is_flash': is_flash,
+                'full_url': full_view[0] if full_view else None}
 
 
 __plugin__ = DeviantArtPlugin
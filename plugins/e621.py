@@ -23,13 +23,13 @@
 import logging
 import re
 import html
-from urllib.parse import urlsplit
 import traceback
 
-import requests
-import mimeparse
 import praw
 
+from lapislib import web
+from lapislib.store import Store
+
 
 class E621Plugin:
     """
@@ -38,14 +38,17 @@ class E621Plugin:
 
     """
 
-    def __init__(self, useragent: str, **options):
+    def __init__(self, useragent: str, cache_dir: str=None, **options):
         """Initialize the e621 importer.
 
         :param useragent: The useragent to use for querying e621.
+        :param cache_dir: Where to remember the posts we've looked up.
         :param options: Other options in the configuration. Ignored.
         """
         self.log = logging.getLogger('lapis.e621')
         self.headers = {'User-Agent': useragent}
+        # md5:<md5>: post ID, and post:<post ID>: the post's file_url and artist
+        self.cache = Store.in_dir(cache_dir, 'e621')
         self.regex = re.compile(
             r'^https?://(((?:www\.)?(?:static1\.)?'
             r'(?P<service>(e621)|(e926))\.net/(data/.+/(?P<md5>\w+))?'
@@ -74,29 +77,20 @@ class E621Plugin:
             match = self.regex.match(submission.url)
             if not match:
                 return None
-            r = requests.head(url, headers=self.headers)
-            mime_text = r.headers.get('Content-Type')
-            mime = mimeparse.parse_mime_type(mime_text)
-            if mime[0] == 'image':
-                md5 = match.group('md5')
-                service = match.group('service')
-                endpoint = 'http://e926.net/post/check_md5.json?md5=' + md5
-                self.log.debug('Will use MD5 checker endpoint at %s', endpoint)
-                callapi = requests.get(endpoint)
-                json = callapi.json()
-                post_id = json['post_id']
-                post_id = str(post_id)
+            # A CDN link has the image's MD5 in it, and a post link its ID.
+            # Either way, there's no need to ask e621 which it is.
+            md5 = match.group('md5')
+            if md5:
+                post_id = self.post_id_from_md5(md5)
             else:
                 self.log.debug('No CDN used, md5 retrieval not neccesary.')
-                # For non-CDN links, the plugin attempts to get the post_id
-                # out of the URL using regex.
                 post_id = match.group('post_id')
-            endpoint = 'http://e926.net/post/show.json?id=' + post_id
+            if not post_id:
+                return None
             service = match.group('service')
-            self.log.debug('Will use API endpoint at %s', endpoint)
-            # We will use the e621 API to get the image URL.
-            callapi = requests.get(endpoint)
-            json = callapi.json()
+            json = self.get_post(post_id)
+            if json is None:
+                return None
             img = json['file_url']
             author = json['artist']
             author = ''.join(author)  # Converts the list into a string to be used later.
@@ -114,6 +108,44 @@ class E621Plugin:
                            submission.url, traceback.format_exc())
             return None
 
+    def post_id_from_md5(self, md5: str) -> str:
+        """Find the post an image on the CDN belongs to.
+
+        :param md5: The MD5 from the CDN URL.
+        :return: The post ID, or None if there is no such post.
+        """
+        post_id = self.cache.get('md5:' + md5)
+        if post_id is None:
+            endpoint = 'http://e926.net/post/check_md5.json?md5=' + md5
+            self.log.debug('Will use MD5 checker endpoint at %s', endpoint)
+            json = web.session.get(endpoint, headers=self.headers).json()
+            if not json.get('post_id'):
+                return None
+            post_id = str(json['post_id'])
+            self.cache.set('md5:' + md5, post_id)
+        return post_id
+
+    def get_post(self, post_id: str) -> dict:
+        """Look up a post with the e621 API, or in the cache if we've seen it before.
+
+        :param post_id: The post ID.
+        :return: A dictionary with the post's file_url and artist, or None.
+        """
+        post = self.cache.get('post:' + post_id)
+        if post is None:
+            endpoint = 'http://e926.net/post/show.json?id=' + post_id
+            self.log.debug('Will use API endpoint at %s', endpoint)
+            # We will use the e621 API to get the image URL.
+            r = web.session.get(endpoint, headers=self.headers)
+            if not r.ok:
+                return None
+            json = r.json()
+            post = {'file_url': json['file_url'], 'artist': json['artist']}
+            self.cache.set('post:' + post_id, post)
+            if json.get('md5'):
+                self.cache.set('md5:' + json['md5'], post_id)
+        return post
+
 
 __plugin__ = E621Plugin
 
@@ -0,0 +1,82 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 kupiakos
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import traceback
+
+import praw
+
+from lapislib.embed import EmbedEngine, PROVIDERS
+
+
+class EmbedPlugin:
+    """An import plugin for every site that offers oEmbed or OpenGraph data.
+
+    The sites themselves are entries in `lapislib.embed.PROVIDERS`.
+    More can be added, or built-in ones overridden, from the configuration
+    with embed_providers, a list of entries in the same format.
+    """
+
+    def __init__(self, useragent: str, embed_providers: list=None, **options):
+        """Initialize the embed importer.
+
+        :param useragent: The useragent to use for querying the sites.
+        :param embed_providers: Provider entries to add to the built-in ones.
+        Entries with the same name as a built-in provider replace it.
+        :param options: Other options in the configuration. Ignored.
+        """
+        self.log = logging.getLogger('lapis.embed')
+        extra = embed_providers or []
+        names = {provider['name'] for provider in extra}
+        providers = extra + [p for p in PROVIDERS if p['name'] not in names]
+        self.engine = EmbedEngine(providers, useragent)
+
+    def import_submission(self, submission: praw.objects.Submission) -> dict:
+        """Import a submission from any registered provider.
+
+        This function will define the following values in its return data:
+        - author: The author, if the provider knows, or the provider's default.
+        - source: The url of the submission
+        - importer_display/header
+        - import_urls
+
+        :param submission: A reddit submission to parse.
+        :return: None if no import, an import info dictionary otherwise.
+        """
+        try:
+            result = self.engine.lookup(submission.url)
+            if result is None:
+                return None
+            self.log.debug('Imported %s image %s', result['provider'], result['image'])
+            return {'author': result.get('author', 'an unknown author'),
+                    'source': submission.url,
+                    'importer_display': {'header': result['display_header']},
+                    'import_urls': [result['image']]}
+        except Exception:
+            self.log.error('Could not import URL %s (%s)',
+                           submission.url, traceback.format_exc())
+            return None
+
+
+__plugin__ = EmbedPlugin
+
+# END OF LINE.
@@ -26,10 +26,11 @@ import html
 from urllib.parse import urlsplit
 import traceback
 
-import requests
 import mimeparse
 import praw
 
+from lapislib import web
+
 
 class FourChanPlugin:
     """
@@ -70,7 +71,7 @@ class FourChanPlugin:
                     'source': url,
                     'importer_display':
                         {'header': 'Mirrored 4chan image, as it will inevitably 404:\n\n'}}
-            r = requests.head(url, headers=self.headers)
+            r = web.session.head(url, headers=self.headers)
             mime_text = r.headers.get('Content-Type')
             mime = mimeparse.parse_mime_type(mime_text)
             if mime[0] == 'image':
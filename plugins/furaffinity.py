@@ -22,16 +22,23 @@
 
 import logging
 import re
-from typing import Iterable, Optional
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional, Tuple
 from urllib.parse import urljoin
 import traceback
 
-import requests
-import bs4
 import praw
 
+from lapislib import extract, parsing, web
+from lapislib.extract import has_class
+from lapislib.store import Store
+
 # The maximum number of pages to search in a gallery
 MAX_PAGES = 20
+# How many gallery pages to load at once
+GALLERY_WORKERS = 4
+THUMBNAIL_REGEX = re.compile(r'.*/(?P<id>\d+)@\d+-(?P<cdn_id>\d+)\.\w+$')
 
 
 class FurAffinityPlugin:
@@ -40,23 +47,31 @@ class FurAffinityPlugin:
     FurAffinity has no API, so HTML hacks had to be used.
     """
 
-    def __init__(self, useragent: str, **_):
+    def __init__(self, useragent: str, cache_dir: str=None,
+                 furaffinity_workers: int=GALLERY_WORKERS, **_):
         """Initialize the FA import API.
 
         :param useragent: The useragent to use for querying FA.
+        :param cache_dir: Where to keep the index of gallery thumbnails.
+        :param furaffinity_workers: How many gallery pages to load at once.
         :param options: Other options in the configuration. Ignored.
         """
         self.log = logging.getLogger('lapis.furaffinity')
         self.headers = {'User-Agent': useragent}
+        self.workers = furaffinity_workers
+        # artist: {'thumbnails': {cdn_id: submission_id}, 'complete': bool}
+        self.index = Store.in_dir(cache_dir, 'furaffinity')
+        # Imports run in parallel, and may look up the same artist at once.
+        self.index_lock = threading.Lock()
         self.regex = re.compile(
             r'^https?://('
             r'((?:www\.)?(?:sfw\.)?furaffinity\.net/view/(?P<id>\d+).*)|'
             r'(d\.facdn\.net/art/(?P<artist>[^/]+)/(?P<cdn_id>\d+)/.*)'
             r')$')
 
-    def get(self, url: str) -> Optional[str]:
-        r = requests.get(url, headers=self.headers)
-        return r.text if r.ok else None
+    def get(self, url: str):
+        r = web.session.get(url, headers=self.headers)
+        return web.markup(r) if r.ok else None
 
     def import_submission(self, submission: praw.objects.Submission) -> dict:
         """Import a submission from FA. Uses raw HTML scraping.
@@ -110,30 +125,13 @@ class FurAffinityPlugin:
             if not markup:
                 raise IOError('Page could not be loaded')
             data['source'] = submission_url
-            submission_page = bs4.BeautifulSoup(markup, 'lxml')
-            artist = submission_page.select_one('td.cat a')
-            artist = artist and artist.text.strip()
+            page = parsing.parse(self.parse_submission_page, markup, submission_url)
+            artist = page['artist']
             data['author'] = artist or 'an Unknown FA artist'
-            title = submission_page.select_one('td.cat b')
-            title = title.text.strip() if title else 'an Unknown title'
-
-            # One may be convinced to always use #submissionImg,
-            # but it's possible for it to contain a small thumbnail URL.
-            image_url = None
-            url_script = submission_page.select_one('#page-submission .alt1 script')
-            if url_script:
-                m = re.search(r'var\s+full_url\s*=\s*"(?P<url>[^"]+)"\s*;', url_script.text)
-                if m:
-                    image_url = m.group('url')
-            # If we couldn't find the image url through the script, go with the more rigorous way.
-            if image_url is None:
-                image_element = submission_page.find(id='submissionImg')
-                if image_element is None or 'src' not in image_element:
-                    raise ValueError('Image URL could not be found')
-                image_url = image_element['src']
-            # Make sure the image URL is absolute.
-            image_url = urljoin(submission_url, image_url)
-            assert image_url
+            title = page['title'] or 'an Unknown title'
+            image_url = page['image_url']
+            if not image_url:
+                raise ValueError('Image URL could not be found')
             data['import_urls'] = [image_url]
             data['importer_display']['header'] = (
                 'Mirrored "[{}]({})" by FA artist "{}":\n\n'.format(
@@ -153,54 +151,189 @@ class FurAffinityPlugin:
 
         While there's no simple reverse-lookup that can be done a la DeviantArt,
         the thumbnail on a user's gallery page does contain the CDN ID.
-        This will search through the user's gallery page looking for a matching thumbnail.
+        Every thumbnail we see is kept in a persistent index for each artist,
+        so a repeat lookup costs at most a reload of the first gallery page,
+        where new uploads appear. Only if that doesn't settle it are the rest
+        of the gallery pages searched, several at a time.
 
         :param artist: The artist name, extracted from the image URL.
         :param cdn_id: The CDN ID, extracted from the image URL.
         :return: A submission ID if found, None if not.
         """
         self.log.debug('Finding submission from CDN with artist %s, cdn_id, %s', artist, cdn_id)
+        key = artist.lower()
+        entry = self.index.get(key) or {'thumbnails': {}, 'complete': False}
+        thumbnails = entry['thumbnails']
+        submission_id = thumbnails.get(cdn_id)
+        if submission_id is not None:
+            self.log.debug('Found submission ID in the index: %s', submission_id)
+            return submission_id
         try:
-            for gallery_page in self.enum_user_gallery(artist):
-                thumbnail = gallery_page.select_one('.t-image img[src*="{}"]'.format(cdn_id))
-                if thumbnail is not None:
-                    break
-            else:
-                # No matching thumbnail was found
+            first_page = self.load_gallery_page(artist, 1)
+            if first_page is None:
                 return None
-            m = re.match(r'.*/(?P<id>\d+)@\d+-\d+\.\w+$', thumbnail['src'])
-            submission_id = m and m.group('id')
-            self.log.debug('Found submission ID: %s', submission_id)
-            return submission_id
-        except Exception as e:
+            # If the first page reaches back to thumbnails we already know about,
+            # it has every upload since the index was last complete.
+            caught_up = entry['complete'] and not thumbnails.keys().isdisjoint(
+                first_page['thumbnails'])
+            thumbnails.update(first_page['thumbnails'])
+            submission_id = thumbnails.get(cdn_id)
+            if not first_page['has_next']:
+                entry['complete'] = True
+            elif submission_id is None and not caught_up:
+                submission_id, complete = self.search_gallery(artist, cdn_id, thumbnails)
+                entry['complete'] = entry['complete'] or complete
+        except Exception:
             self.log.warning('Could not import direct URL, artist: %s, cdn_id: %s',
                              artist, cdn_id)
             self.log.warning('Reason: %s', traceback.format_exc())
             return None
+        finally:
+            self.save_index_entry(key, entry)
+        if submission_id is None:
+            # No matching thumbnail was found
+            return None
+        self.log.debug('Found submission ID: %s', submission_id)
+        return submission_id
+
+    def save_index_entry(self, key: str, entry: dict) -> None:
+        """Merge what one lookup learned into the index.
 
-    def enum_user_gallery(self, artist: str) -> Iterable[bs4.BeautifulSoup]:
-        """Enumerate through `MAX_PAGES` pages of a user's FA profile.
+        Whatever other lookups saved for the same artist in the meantime is kept.
+        """
+        with self.index_lock:
+            current = self.index.get(key)
+            if current is not None:
+                thumbnails = dict(current['thumbnails'])
+                thumbnails.update(entry['thumbnails'])
+                entry = {'thumbnails': thumbnails,
+                         'complete': current['complete'] or entry['complete']}
+            self.index.set(key, entry)
+
+    def search_gallery(self, artist: str, cdn_id: str,
+                       thumbnails: dict) -> Tuple[Optional[str], bool]:
+        """Search the gallery pages after the first for a CDN ID.
+
+        Up to `workers` pages are loaded at once. Pages that haven't started
+        loading are cancelled as soon as a match is found.
+
+        :param artist: The name of the FA user.
+        :param cdn_id: The CDN ID to look for.
+        :param thumbnails: The artist's known thumbnails. Every page loaded
+        is added to it.
+        :return: The submission ID, or None if not found, and whether every
+        page (up to `MAX_PAGES`) was loaded.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = {}
+        next_page = 2
+        last_page = MAX_PAGES
+        complete = True
+        try:
+            while True:
+                while len(pending) < self.workers and next_page <= last_page:
+                    future = executor.submit(self.load_gallery_page, artist, next_page)
+                    pending[future] = next_page
+                    next_page += 1
+                if not pending:
+                    return None, complete
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = pending.pop(future)
+                    try:
+                        gallery_page = future.result()
+                    except Exception:
+                        self.log.warning('Could not load page %d of %s\'s gallery: %s',
+                                         page, artist, traceback.format_exc())
+                        gallery_page = None
+                    if gallery_page is None:
+                        complete = False
+                        continue
+                    thumbnails.update(gallery_page['thumbnails'])
+                    if not gallery_page['has_next']:
+                        last_page = min(last_page, page)
+                if cdn_id in thumbnails:
+                    return thumbnails[cdn_id], False
+                for future, page in list(pending.items()):
+                    if page > last_page and future.cancel():
+                        del pending[future]
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def load_gallery_page(self, artist: str, page: int) -> Optional[dict]:
+        """Load and parse one page of a user's FA gallery.
 
         :param artist: The name of the FA user.
-        :return: A generator that returns BeautifulSoup pages for each gallery page.
+        :param page: The page number, starting at 1.
+        :return: The parsed page, as from `parse_gallery_page`, or None if
+        it couldn't be loaded.
+        """
+        gallery_url = (
+            'https://www.furaffinity.net/gallery/'
+            '{artist}/{page}?perpage=72'.format(artist=artist, page=page))
+        self.log.debug('Loading gallery page %s', gallery_url)
+        markup = self.get(gallery_url)
+        if not markup:
+            return None
+        return parsing.parse(self.parse_gallery_page, markup)
+
+    @staticmethod
+    def parse_submission_page(markup, submission_url: str) -> dict:
+        """Scrape the artist, title and full image URL from a submission page.
+
+        :param markup: The HTML of the submission page, as text or bytes.
+        :param submission_url: The URL of the page, to resolve relative links.
+        :return: A dictionary with artist, title and image_url, any of which may be None.
+        """
+        submission_page = extract.document(markup)
+        if submission_page is None:
+            return {'artist': None, 'title': None, 'image_url': None}
+        artist = submission_page.xpath('string(//td[{}]//a)'.format(has_class('cat'))).strip()
+        title = submission_page.xpath('string(//td[{}]//b)'.format(has_class('cat'))).strip()
+
+        # One may be convinced to always use #submissionImg,
+        # but it's possible for it to contain a small thumbnail URL.
+        image_url = None
+        url_script = submission_page.xpath('string(//*[@id="page-submission"]//td[{}]//script)'.format(
+            has_class('alt1')))
+        m = re.search(r'var\s+full_url\s*=\s*"(?P<url>[^"]+)"\s*;', url_script)
+        if m:
+            image_url = m.group('url')
+        # If we couldn't find the image url through the script, go with the more rigorous way.
+        if image_url is None:
+            image_element = submission_page.xpath('//*[@id="submissionImg"]/@src')
+            if image_element:
+                image_url = image_element[0]
+        return {'artist': artist or None,
+                'title': title or None,
+                # Make sure the image URL is absolute.
+                'image_url': image_url and urljoin(submission_url, image_url)}
+
+    @staticmethod
+    def parse_gallery_page(markup) -> dict:
+        """Scrape the thumbnails from a gallery page.
+
+        A thumbnail URL looks like //t.facdn.net/<submission id>@<size>-<cdn id>.jpg,
+        which is what lets us map a CDN image back to its submission.
+
+        :param markup: The HTML of the gallery page, as text or bytes.
+        :return: A dictionary with thumbnails, a dictionary of CDN IDs to
+        submission IDs, and has_next, whether there is another page.
         """
-        page = 1
-        more_pages = True
-        while more_pages:
-            gallery_url = (
-                'https://www.furaffinity.net/gallery/'
-                '{artist}/{page}?perpage=72'.format(artist=artist, page=page))
-            self.log.debug('Loading gallery page %s', gallery_url)
-            page = self.get(gallery_url)
-            if not page:
-                break
-            bs = bs4.BeautifulSoup(page, 'lxml')
-            yield bs
-            next_page_link = bs.select_one('.pagination .button-link.right')
-            more_pages = next_page_link is not None and 'href' in next_page_link
-            page += 1
-            if page > MAX_PAGES:
-                break
+        gallery_page = extract.document(markup)
+        if gallery_page is None:
+            return {'thumbnails': {}, 'has_next': False}
+        thumbnails = {}
+        # Only thumbnails match the regex, so there's no need to select them any further.
+        for src in gallery_page.xpath('//img/@src'):
+            m = THUMBNAIL_REGEX.match(src)
+            if m:
+                thumbnails[m.group('cdn_id')] = m.group('id')
+        next_page_link = gallery_page.xpath('//div[{}]//a[{} and {}]/@href'.format(
+            has_class('pagination'), has_class('button-link'), has_class('right')))
+        return {'thumbnails': thumbnails, 'has_next': bool(next_page_link)}
 
     @staticmethod
     def user_page(artist: str) -> str:
@@ -21,14 +21,14 @@
 # THE SOFTWARE.
 
 import logging
-import urllib.request
-import urllib.error
+import re
 import traceback
 import mimeparse
-import requests
 
 import imgurpython
-from imgurpython.helpers.error import ImgurClientRateLimitError
+from imgurpython.helpers.error import ImgurClientError, ImgurClientRateLimitError
+
+from lapislib import web
 
 
 class ImgurPlugin:
@@ -70,6 +70,8 @@ class ImgurPlugin:
                           author: str='an Unknown Author',
                           source: str='an Unknown Source',
                           video: bool=False,
+                          media: dict=None,
+                          local_files: dict=None,
                           **import_info) -> dict:
         """Upload one or multiple images to Imgur. Cannot support videos.
 
@@ -78,11 +80,16 @@ class ImgurPlugin:
         This function will define the following values in the export data:
         - exporter
         - link_display
+        - delete_info: The deletehashes of the album, if any, and of the images.
 
         :param import_urls: A set of direct links to images to upload.
         :param author: The author to note in the description.
         :param source: The source to note in the description.
         :param video: Whether the imported data is a video or not.
+        :param media: What the preflight stage found out about each URL, if it ran.
+        Images it found to be oversize are left out, unless they were shrunk.
+        :param local_files: Import URLs to shrunk copies of their images on disk,
+        which are uploaded instead.
         :param import_info: Other importing information passed. Ignored.
         :return: None if no export, an export info dictionary otherwise.
         """
@@ -97,6 +104,15 @@ class ImgurPlugin:
         results = {'exporter': self.__class__.__name__}
         config = {}
         album = {}
+        local_files = local_files or {}
+        if media:
+            # Imgur would only fail on these, and take its time doing it.
+            oversize = [url for url in import_urls
+                        if media.get(url, {}).get('oversize') and url not in local_files]
+            if oversize:
+                self.log.warning('Skipping %d images over the size limits: %s',
+                                 len(oversize), ', '.join(oversize))
+                import_urls = [url for url in import_urls if url not in oversize]
 
         # Should we do an album?
         if len(import_urls) == 0:
@@ -119,19 +135,25 @@ class ImgurPlugin:
             config['album'] = album['deletehash']
             is_album = True
 
+        images = []
         try:
             # Try to upload each image given.
-            images = []
             for import_url in import_urls:
-                self.log.debug('Uploading URL "%s" to imgur', import_url)
-                image = self.client.upload_from_url(import_url, config)
+                if import_url in local_files:
+                    self.log.debug('Uploading a shrunk copy of "%s" to imgur', import_url)
+                    image = self.client.upload_from_path(local_files[import_url], config)
+                else:
+                    self.log.debug('Uploading URL "%s" to imgur', import_url)
+                    image = self.client.upload_from_url(import_url, config)
                 self.log.debug('Uploaded image: %s', str(image))
                 images.append(image)
+            results['delete_info'] = {'album': album.get('deletehash'),
+                                      'images': [image['deletehash'] for image in images]}
             if is_album:
                 results['link_display'] = '[Imgur Album](https://imgur.com/a/%s)  \n' % album['id']
             else:
                 picture_url = images[0]['link'].replace('http://', 'https://')
-                r = requests.head(picture_url)
+                r = web.session.head(picture_url)
                 mime_text = r.headers.get('Content-Type')
                 mime = mimeparse.parse_mime_type(mime_text)
                 if mime[1] == 'gif':
@@ -140,21 +162,53 @@ class ImgurPlugin:
 
         except ImgurClientRateLimitError:
             self.log.error('Ran into imgur rate limit! %s', self.client.credits)
-            return None
+            return self.failed_export(album, images)
         except Exception:
             self.log.error('Broken exception catch %s', traceback.format_exc())
-            if is_album:
-                self.log.error('Try to delete album!')
-                self.delete_export(album['deletehash'])
+            return self.failed_export(album, images)
         return results
 
-    @staticmethod
-    def delete_export(delete_info: str) -> bool:
-        """Will delete an export if given the image deletehash"""
-        try:
-            urllib.request.urlopen('https://api.imgur.com/2/delete/' + delete_info)
-        except urllib.error.URLError:
+    def failed_export(self, album: dict, images: list) -> dict:
+        """What to return when an export fails partway.
+
+        :param album: The album created for it, if any.
+        :param images: The images uploaded before it failed.
+        :return: An export info dictionary marked failed, so that Lapis
+        queues what was uploaded for deletion, or None if nothing was.
+        """
+        if not album and not images:
+            return None
+        self.log.error('Leaving the uploads made so far to be deleted')
+        return {'exporter': self.__class__.__name__,
+                'failed': True,
+                'delete_info': {'album': album.get('deletehash'),
+                                'images': [image['deletehash'] for image in images]}}
+
+    def delete_export(self, delete_info: dict, **_) -> bool:
+        """Delete an upload, given its deletehashes.
+
+        :param delete_info: The album deletehash, if any, and the image deletehashes.
+        :return: Whether everything was deleted. Uploads that are already
+        gone count as deleted, so that this can be retried.
+        """
+        if not self.client:
             return False
+        deletions = [(self.client.delete_image, deletehash)
+                     for deletehash in delete_info.get('images', [])]
+        if delete_info.get('album'):
+            deletions.append((self.client.album_delete, delete_info['album']))
+        for delete, deletehash in deletions:
+            try:
+                delete(deletehash)
+            except ImgurClientRateLimitError:
+                self.log.warning('Ran into imgur rate limit while deleting! %s',
+                                 self.client.credits)
+                return False
+            except ImgurClientError as e:
+                if e.status_code != 404:
+                    self.log.warning('Could not delete %s: %s', deletehash, e)
+                    return False
+            self.log.debug('Deleted %s', deletehash)
         return True
 
 
@@ -26,10 +26,11 @@ import html
 from urllib.parse import urlsplit
 import traceback
 
-import requests
 import mimeparse
 import praw
 
+from lapislib import web
+
 
 class PuushPlugin:
     """
@@ -70,7 +71,7 @@ class PuushPlugin:
                     'source': url,
                     'importer_display':
                         {'header': 'Mirrored puush image:\n\n'}}
-            r = requests.head(url, headers=self.headers)
+            r = web.session.head(url, headers=self.headers)
             mime_text = r.headers.get('Content-Type')
             mime = mimeparse.parse_mime_type(mime_text)
             if mime[0] == 'image':
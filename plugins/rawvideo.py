@@ -22,9 +22,10 @@
 
 import logging
 
-import requests
 import mimeparse
 
+from lapislib import web
+
 
 class RawVideoPlugin:
     """An export plugin that only tries to post the raw source of a video.
@@ -61,7 +62,7 @@ class RawVideoPlugin:
         self.log.debug('Attempting to upload raw video URL.')
         links = []
         for url in import_urls:
-            req = requests.head(url, headers=self.headers)
+            req = web.session.head(url, headers=self.headers)
             if not req.ok:
                 self.log.debug('URL %s was not valid.', url)
                 continue
@@ -26,11 +26,11 @@ import html
 from urllib.parse import urlsplit
 import traceback
 
-import requests
 import mimeparse
-import bs4
 import praw
 
+from lapislib import extract, parsing, web
+
 
 class TinypicPlugin:
     """A tiny import plugin for tinypic
@@ -71,7 +71,7 @@ class TinypicPlugin:
                     'source': url,
                     'importer_display':
                         {'header': '~~Liberated~~Mirrored tinypic image:\n\n'}}
-            r = requests.head(url, headers=self.headers)
+            r = web.session.head(url, headers=self.headers)
             if r.status_code == 301:  # Moved Permanently
                 return None
             mime_text = r.headers.get('Content-Type')
@@ -79,13 +79,11 @@ class TinypicPlugin:
             if mime[0] == 'image':
                 image_url = url
             else:
-                r = requests.get(url, headers=self.headers)
-                bs = bs4.BeautifulSoup(r.content.decode('utf-8'))
-                matched = bs.select('div#imgFrame img')
-                if not matched:
+                r = web.session.get(url, headers=self.headers)
+                image_url = parsing.parse(self.parse_page, web.markup(r))
+                if not image_url:
                     self.log.warning('Could not find locate Tinypic image to scrape.')
                     return None
-                image_url = matched[0]['src']
             assert image_url
             data['import_urls'] = [image_url]
             return data
@@ -94,6 +92,16 @@ class TinypicPlugin:
                            submission.url, traceback.format_exc())
             return None
 
+    @staticmethod
+    def parse_page(markup) -> str:
+        """Scrape the image URL from a tinypic page.
+
+        :param markup: The HTML of the page, as text or bytes.
+        :return: The image URL, or None if it couldn't be found.
+        """
+        matched = extract.xpath(markup, '//div[@id="imgFrame"]//img/@src')
+        return matched[0] if matched else None
+
 
 __plugin__ = TinypicPlugin
 
@@ -26,9 +26,17 @@ import json
 from urllib.parse import urlencode
 import traceback
 
-import bs4
 import praw
-import requests
+
+from lapislib import extract, parsing, web
+from lapislib.cache import TTLCache
+
+API_URL = 'http://api.tumblr.com/v2/blog/{blog_name}/{method}?{query}'
+# Posts can be edited, but blogs rarely change their title,
+# and where a reblog came from never changes at all.
+POST_TTL = 60 * 60
+BLOG_TTL = 24 * 60 * 60
+SOURCE_TTL = 7 * 24 * 60 * 60
 
 
 class TumblrPlugin:
@@ -59,6 +67,12 @@ class TumblrPlugin:
             re.IGNORECASE)
         self.api_key = tumblr_api_key
         self.headers = {'User-Agent': self.useragent}
+        # (blog name, post ID): post
+        self.posts = TTLCache(1024, POST_TTL)
+        # blog name: blog info
+        self.blogs = TTLCache(1024, BLOG_TTL)
+        # (blog name, post ID) of a reblog: (source blog name, source post URL)
+        self.sources = TTLCache(4096, SOURCE_TTL)
 
     def read_url(self, url: str) -> str:
         """Download text from a URL.
@@ -66,7 +80,7 @@ class TumblrPlugin:
         :param url: The URL to download from.
         :return: The data downloaded, as a Unicode string.
         """
-        return requests.get(url, headers=self.headers).text
+        return web.session.get(url, headers=self.headers).text
 
     def import_submission(self, submission: praw.objects.Submission) -> dict:
         """Import a submission from Tumblr. Does not parse videos yet.
@@ -89,49 +103,38 @@ class TumblrPlugin:
             if not match:
                 return None
             blog_name, post_id = match.groups()
+            blog_name = blog_name.lower()
             self.log.debug('%s is a valid Tumblr url.', submission.url)
-            # Query the Tumblr API directly. The Python wrapper sucks.
-            query_url = 'http://api.tumblr.com/v2/blog/{blog_name}/posts?{query}'.format(
-                blog_name=blog_name,
-                query=urlencode({'filter': 'raw', 'id': post_id, 'api_key': self.api_key}))
-            self.log.debug('Querying Tumblr API %s', query_url)
-            response = json.loads(self.read_url(query_url))
+            post = self.get_post(blog_name, post_id)
+            if post is None:
+                return None
             data = {'source': submission.url, 'importer_display': {}}
-            # response['response']['blog']['title']
-            # response['response']['posts'][0]['photos'][i]['original_size']['url']
 
-            if not response:
-                self.log.error('No response returned')
-                return None
-            elif response['meta']['status'] != 200:
-                self.log.error('Non-success status returned')
-
-            try:
-	            source_url = response['response']['posts'][0]['source_url']
-            except KeyError:
-	            source_url = response['response']['posts'][0]['post_url']
-            match = self.regex.match(source_url)
-            if not match:
+            source = self.sources.get((blog_name, post_id))
+            if source is None:
+                source_url = post.get('source_url') or post['post_url']
+                match = self.regex.match(source_url)
+                if not match:
+                    return None
+                source = (match.group(1).lower(), source_url)
+                self.sources.set((blog_name, post_id), source)
+            source_blog_name, source_url = source
+            blog = self.get_blog(source_blog_name)
+            if blog is None:
                 return None
-            source_blog_name, post_id = match.groups()
-            query_url = 'http://api.tumblr.com/v2/blog/{blog_name}/posts?{query}'.format(
-                blog_name=source_blog_name,
-                query=urlencode({'filter': 'raw', 'id': post_id, 'api_key': self.api_key}))
-            source_response = json.loads(self.read_url(query_url))
-            
-            data['author'] = source_response['response']['blog']['title']
+
+            data['author'] = blog['title']
             data['importer_display']['header'] = 'Mirrored [post]({post_url}) from the tumblr blog "[{author}]({blog_url})":\n\n'.format(
                     post_url=source_url,
                     blog_url='http://' + source_blog_name,
                     author=data['author'])
 
-            video_url = response['response']['posts'][0].get('video_url')
+            video_url = post.get('video_url')
             if video_url:
                 data['video'] = True
                 data['import_urls'] = [video_url]
                 return data
 
-            post = response['response']['posts'][0]
             data['import_urls'] = [photo['original_size']['url']
                                    for photo in
                                    post.get('photos', [])]
@@ -152,8 +155,7 @@ class TumblrPlugin:
                 else:
                     self.log.warning('Unknown post format!')
                     return None
-                bs = bs4.BeautifulSoup(html)
-                data['import_urls'] = [img['src'] for img in bs.select('img')]
+                data['import_urls'] = parsing.parse(self.find_inline_images, html)
                 if not data['import_urls']:
                     self.log.info('Could not find any URLs to import!')
                     return None
@@ -166,11 +168,10 @@ class TumblrPlugin:
                     # It's already been downloaded anyways.
                     # In the case that an extra images is copied, no harm no foul;
                     # it's better for more data to be captured than less.
-                    bs = bs4.BeautifulSoup(response['response']['posts'][0].get(
-                        'caption', ''))
-                    other_urls = [img['src']
-                                  for img in bs.find_all('img')
-                                  if img['src'] not in data['import_urls']]
+                    other_urls = [url
+                                  for url in parsing.parse(self.find_inline_images,
+                                                             post.get('caption', ''))
+                                  if url not in data['import_urls']]
                     self.log.debug('Found %d additional images in the caption',
                                    len(other_urls))
                     data['import_urls'].extend(other_urls)
@@ -183,6 +184,67 @@ class TumblrPlugin:
             self.log.error('Error in tumlbr: %s', traceback.format_exc())
             return None
 
+    def query(self, blog_name: str, method: str, **params) -> dict:
+        """Call the Tumblr API.
+
+        :param blog_name: The blog's host name, like staff.tumblr.com.
+        :param method: The API method, like posts or info.
+        :param params: The query parameters, other than the API key.
+        :return: The response, or None if it wasn't a success.
+        """
+        # Query the Tumblr API directly. The Python wrapper sucks.
+        query_url = API_URL.format(blog_name=blog_name, method=method,
+                                   query=urlencode(dict(params, api_key=self.api_key)))
+        self.log.debug('Querying Tumblr API %s', query_url)
+        response = json.loads(self.read_url(query_url))
+        if not response:
+            self.log.error('No response returned')
+            return None
+        elif response['meta']['status'] != 200:
+            self.log.error('Non-success status returned')
+            return None
+        return response['response']
+
+    def get_post(self, blog_name: str, post_id: str) -> dict:
+        """Get a post, from the cache if we've seen it recently.
+
+        The response also tells us about the blog, which is cached too.
+
+        :return: The post, or None if it couldn't be loaded.
+        """
+        post = self.posts.get((blog_name, post_id))
+        if post is None:
+            response = self.query(blog_name, 'posts', filter='raw', id=post_id)
+            if not response or not response.get('posts'):
+                return None
+            post = response['posts'][0]
+            self.posts.set((blog_name, post_id), post)
+            self.blogs.set(blog_name, response['blog'])
+        return post
+
+    def get_blog(self, blog_name: str) -> dict:
+        """Get a blog's info, such as its title, from the cache if possible.
+
+        :return: The blog info, or None if it couldn't be loaded.
+        """
+        blog = self.blogs.get(blog_name)
+        if blog is None:
+            response = self.query(blog_name, 'info')
+            if not response:
+                return None
+            blog = response['blog']
+            self.blogs.set(blog_name, blog)
+        return blog
+
+    @staticmethod
+    def find_inline_images(html: str) -> list:
+        """Find the images embedded in a post body or caption.
+
+        :param html: The HTML of the body or caption.
+        :return: The source URL of every image, in order.
+        """
+        return extract.img_sources(html)
+
 
 __plugin__ = TumblrPlugin
 
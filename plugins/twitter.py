@@ -27,6 +27,13 @@ import re
 import tweepy
 import praw
 
+from lapislib.cache import TTLCache
+
+# statuses/lookup takes at most this many IDs at a time
+LOOKUP_BATCH = 100
+# How long to remember a tweet, in seconds
+TWEET_TTL = 10 * 60
+
 
 class TwitterPlugin:
     """An Twitter import plugin.
@@ -57,6 +64,19 @@ class TwitterPlugin:
         self.access_token_secret = twitter_access_token_secret
         self.regex = re.compile(
             r'https?://(mobile\.)?twitter.com/(?P<user>\w+?)/status/(?P<id>\d+)/?')
+        # tweet ID: tweet info, or False if the tweet couldn't be loaded
+        self.tweets = TTLCache(1024, TWEET_TTL)
+
+    def canonicalize_url(self, url: str, **_) -> str:
+        """Give every link to a tweet the same canonical URL, whatever user it's under.
+
+        :param url: A canonical URL, as from `lapislib.urls`.
+        :return: The tweet's canonical URL, or None if it isn't one.
+        """
+        match = self.regex.match(url)
+        if not match:
+            return None
+        return 'https://twitter.com/i/status/{}'.format(match.group('id'))
 
     def login(self):
         """Attempt to log into the Twitter API."""
@@ -65,6 +85,38 @@ class TwitterPlugin:
         self.auth.set_access_token(self.access_token, self.access_token_secret)
         self.client = tweepy.API(self.auth)
 
+    def prepare_submissions(self, submissions: list, **_) -> None:
+        """Look up every tweet in a batch of submissions at once.
+
+        Uses statuses/lookup, which takes up to 100 tweets per request,
+        instead of a request per tweet. `import_submission` is then served
+        from the results.
+
+        :param submissions: The new submissions of a scan.
+        """
+        if not self.client:
+            return
+        tweet_ids = []
+        for submission in submissions:
+            match = self.regex.match(submission.url)
+            if match and match.group('id') not in tweet_ids:
+                if self.tweets.get(match.group('id')) is None:
+                    tweet_ids.append(match.group('id'))
+        for start in range(0, len(tweet_ids), LOOKUP_BATCH):
+            batch = tweet_ids[start:start + LOOKUP_BATCH]
+            self.log.debug('Looking up %d tweets', len(batch))
+            try:
+                statuses = self.client.statuses_lookup(batch)
+            except Exception:
+                self.log.error('Could not look up tweets: %s', traceback.format_exc())
+                continue
+            for status in statuses:
+                self.tweets.set(status.id_str, self.tweet_info(status))
+            # Deleted and protected tweets are left out of the response.
+            for tweet_id in batch:
+                if self.tweets.get(tweet_id) is None:
+                    self.tweets.set(tweet_id, False)
+
     def import_submission(self, submission: praw.objects.Submission) -> dict:
         """Import a submission from Twitter. Uses the Twitter API 1.1.
 
@@ -83,21 +135,16 @@ class TwitterPlugin:
             if not match:
                 return None
 
-            status = self.client.get_status(id=int(match.groupdict()['id']))
-            author = status.author.name
-            handle = status.author.screen_name
-            body = status.text
-
-            image_urls = []
-            for medium in status.entities['media']:
-                if medium['type'] != 'photo':
-                    continue
-                url_base = medium['media_url']
-                # Find the largest size available
-                size = max(medium['sizes'],
-                           key=lambda x: medium['sizes'][x]['w'])
-                url = '{}:{}'.format(url_base, size)
-                image_urls.append(url)
+            tweet_id = match.group('id')
+            tweet = self.tweets.get(tweet_id)
+            if tweet is None:
+                # Not part of a batch, so look it up on its own.
+                tweet = self.tweet_info(self.client.get_status(id=int(tweet_id)))
+                self.tweets.set(tweet_id, tweet)
+            if not tweet or not tweet['image_urls']:
+                return None
+            author = tweet['author']
+            handle = tweet['handle']
 
             data = {'author': 'the Twitter user {0} (@{1})'.format(author, handle),
                     'source': submission.url,
@@ -106,7 +153,7 @@ class TwitterPlugin:
                             author, handle)},
                     # For some reason, Reddit is marking posts as spam with this enabled
                         # 'footer': 'Body:  \n{}'.format(body)},
-                    'import_urls': image_urls}
+                    'import_urls': list(tweet['image_urls'])}
 
             return data
         except Exception:
@@ -114,6 +161,28 @@ class TwitterPlugin:
                            submission.url, traceback.format_exc())
             return None
 
+    @staticmethod
+    def tweet_info(status) -> dict:
+        """Pull what we need out of a tweet.
+
+        :param status: The tweet, as a tweepy Status.
+        :return: A dictionary with author, handle, body and image_urls.
+        """
+        image_urls = []
+        for medium in status.entities.get('media', []):
+            if medium['type'] != 'photo':
+                continue
+            url_base = medium['media_url']
+            # Find the largest size available
+            size = max(medium['sizes'],
+                       key=lambda x: medium['sizes'][x]['w'])
+            url = '{}:{}'.format(url_base, size)
+            image_urls.append(url)
+        return {'author': status.author.name,
+                'handle': status.author.screen_name,
+                'body': status.text,
+                'image_urls': image_urls}
+
 
 __plugin__ = TwitterPlugin
 